@@ -1,11 +1,12 @@
 import asyncio
 
 import aiohttp
-import redis.asyncio as redis
 import typer
 from rich.progress import Progress, SpinnerColumn, TextColumn
 
+from dnsdig.appdnsdigd.cache import BLOCKLIST_PREFIX, blocklist_key
 from dnsdig.appdnsdigd.settings import dnsdigd_settings
+from dnsdig.libshared.redisring import ShardedRedis
 
 """
 Shoutout to these Github repos for the blacklist files:
@@ -22,22 +23,26 @@ async def download_hosts_file(url: str) -> str:
             return await response.text()
 
 
-def get_redis_client(redis_url: str | None = None) -> redis.Redis:
-    _redis_url = redis_url
-    if not _redis_url:
-        _redis_url = dnsdigd_settings.redis_url
-    return redis.from_url(_redis_url, encoding="utf-8", decode_responses=True)
+def get_redis_client(redis_url: str | None = None) -> ShardedRedis:
+    _redis_urls = [redis_url]
+    if not redis_url:
+        _redis_urls = dnsdigd_settings.redis_nodes
+    return ShardedRedis(
+        urls=_redis_urls, vnodes=dnsdigd_settings.redis_ring_vnodes, pinned_prefixes=(BLOCKLIST_PREFIX,)
+    )
 
 
-async def process_hosts(hosts: str, redis_client: redis.Redis):
+async def process_hosts(hosts: str, redis_client: ShardedRedis, batch_size: int = 1000):
     parsed_hosts = [x for x in hosts.split("\n") if not x.startswith("#") and x != ""]
-    for host in parsed_hosts:
-        ns = "dnsdigd-blacklist"
-        ip, hn = host.split(" ")
-        await redis_client.hset(ns, hn, ip)
+    for offset in range(0, len(parsed_hosts), batch_size):
+        commands = []
+        for host in parsed_hosts[offset : offset + batch_size]:
+            ip, hn = host.split(" ")
+            commands.append((blocklist_key(hn), "hset", (hn, ip)))
+        await redis_client.execute_many(commands)
 
 
-async def _run(redis_url: str, progress: Progress):
+async def _run(redis_url: str | None, progress: Progress):
     redis_client = get_redis_client(redis_url)
 
     task_id = progress.add_task("Downloading hosts files...")
@@ -49,7 +54,9 @@ async def _run(redis_url: str, progress: Progress):
 
 
 @app.command()
-def main(redis_url: str = typer.Option(..., allow_dash=True, help='Redis URL')):
+def main(
+    redis_url: str | None = typer.Option(None, allow_dash=True, help='Redis URL, defaults to every node in settings')
+):
     with Progress(SpinnerColumn(), TextColumn("[progress.description]{task.description}"), transient=False) as progress:
         typer.echo("CLI utility to import DB IP City database")
         typer.echo(f"Redis URL: {redis_url}")
@@ -0,0 +1,91 @@
+import asyncio
+from typing import AsyncIterator, Callable, List, Tuple
+
+import ujson
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+from starlette.types import Message
+
+from dnsdig.appdnsdigapi.cache import ResponseCache, response_cache
+from dnsdig.libdns.constants import RecordTypes
+from dnsdig.libdns.domains.resolver import Resolver
+from dnsdig.libdns.models.resolver import BatchLookup
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.settings import settings
+
+
+class LimitedBodyRoute(APIRoute):
+    # The body is parsed as a whole before validation, too large a batch is refused while it is being read
+    max_body_bytes = settings.resolver_batch_max_body_bytes
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        max_body_bytes = self.max_body_bytes
+
+        def too_large() -> HTTPException:
+            return HTTPException(status_code=413, detail=f"The request body is at most {max_body_bytes} bytes")
+
+        async def limited_handler(request: Request) -> Response:
+            if int(request.headers.get("content-length") or 0) > max_body_bytes:
+                raise too_large()
+            received = 0
+
+            async def receive() -> Message:
+                nonlocal received
+                message = await request.receive()
+                received += len(message.get("body", b""))
+                if received > max_body_bytes:
+                    raise too_large()
+                return message
+
+            return await handler(Request(request.scope, receive))
+
+        return limited_handler
+
+
+def unique_lookups(lookups: List[BatchLookup]) -> List[Tuple[str, RecordTypes]]:
+    # Names are case insensitive, a name and type asked for twice is resolved once
+    pairs = (
+        (lookup.name.lower().rstrip("."), RecordTypes(record_type))
+        for lookup in lookups
+        for record_type in lookup.types
+    )
+    return list(dict.fromkeys(pairs))
+
+
+async def resolve_line(name: str, record_type: RecordTypes) -> bytes:
+    key = ResponseCache.key(name, record_type.value, use_ipv6=False)
+    try:
+        _, _, body = await response_cache.fetch(
+            key, lambda: Resolver.resolve_record(hostname=name, record_type=record_type)
+        )
+    except Exception as exc:
+        logger.error(
+            "Failed to resolve batch lookup", extra={"qname": name, "qtype": record_type.value, "error": repr(exc)}
+        )
+        return ujson.dumps({"name": name, "type": record_type.value, "error": repr(exc)}).encode() + b"\n"
+    # The body is the JSON of the single record endpoint, cached or not, and is embedded as it is
+    return b'{"name":%s,"type":"%s","result":%s}\n' % (ujson.dumps(name).encode(), record_type.value.encode(), body)
+
+
+async def stream_lookups(lookups: List[Tuple[str, RecordTypes]], concurrency: int) -> AsyncIterator[bytes]:
+    # At most `concurrency` lookups run and at most `concurrency` finished lines wait for the client,
+    # whatever the size of the batch
+    pending = iter(lookups)
+    lines: asyncio.Queue[bytes | None] = asyncio.Queue(maxsize=concurrency)
+
+    async def worker():
+        for name, record_type in pending:
+            await lines.put(await resolve_line(name, record_type))
+
+    async def run():
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        await lines.put(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while (line := await lines.get()) is not None:
+            yield line
+    finally:
+        # The client went away, lookups nobody will read are not started
+        task.cancel()
@@ -0,0 +1,108 @@
+import hashlib
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+import pydantic_core
+import redis.asyncio as redis
+from fastapi import Request, Response
+from redis.exceptions import ConnectionError, TimeoutError
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import Counter
+from dnsdig.libshared.settings import settings
+from dnsdig.libshared.tracing import tracer
+
+response_cache_lookups = Counter("dnsdig_response_cache_lookups", "Resolver response cache lookups", ["result"])
+
+
+def minimum_ttl(results: Any) -> int | None:
+    # Every record model carries the TTL of its answer, the response is only as fresh as the shortest one
+    ttls = []
+    pending = [results]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+        elif hasattr(value, "ttl"):
+            ttls.append(value.ttl)
+    return min(ttls) if ttls else None
+
+
+class ResponseCache:
+    def __init__(self, redis_url: str, max_ttl: int = 3600, negative_ttl: int = 30):
+        self.redis_url = redis_url
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.redis_client: redis.Redis | None = None
+
+    def get_redis_client(self) -> redis.Redis:
+        if self.redis_client is None:
+            # Bodies are stored and returned as bytes, never decoded
+            self.redis_client = redis.from_url(self.redis_url)
+        return self.redis_client
+
+    @classmethod
+    def key(cls, name: str, record_type: str, use_ipv6: bool) -> str:
+        return f"dnsdig-api-response#{name.lower().rstrip('.')}#{record_type}#{6 if use_ipv6 else 4}"
+
+    @classmethod
+    def pack(cls, etag: str, expires_at: float, body: bytes) -> bytes:
+        return b"%s %d\n%s" % (etag.encode(), int(expires_at), body)
+
+    @classmethod
+    def unpack(cls, value: bytes) -> Tuple[str, float, bytes]:
+        header, body = value.split(b"\n", 1)
+        etag, expires_at = header.split(b" ")
+        return etag.decode(), float(expires_at), body
+
+    async def get(self, key: str) -> Tuple[str, float, bytes] | None:
+        try:
+            value = await self.get_redis_client().get(key)
+        except (ConnectionError, TimeoutError, OSError) as exc:
+            logger.error("Response cache unavailable", extra={"key": key, "error": repr(exc)})
+            return None
+        return self.unpack(value) if value else None
+
+    async def set(self, key: str, etag: str, expires_at: float, body: bytes, ttl: int):
+        try:
+            await self.get_redis_client().set(key, self.pack(etag, expires_at, body), ex=ttl)
+        except (ConnectionError, TimeoutError, OSError) as exc:
+            logger.error("Response cache unavailable", extra={"key": key, "error": repr(exc)})
+
+    async def build(self, key: str, resolve: Callable[[], Awaitable[Dict]]) -> Tuple[str, float, bytes]:
+        return await self.store(key, await resolve())
+
+    async def store(self, key: str, results: Dict) -> Tuple[str, float, bytes]:
+        with tracer.span("response.serialize"):
+            body = pydantic_core.to_json(results, by_alias=True)
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+        ttl = minimum_ttl(results)
+        ttl = self.negative_ttl if ttl is None else min(ttl, self.max_ttl)
+        expires_at = time.time() + ttl
+        if ttl > 0:
+            await self.set(key, etag, expires_at, body, ttl)
+        return etag, expires_at, body
+
+    async def fetch(self, key: str, resolve: Callable[[], Awaitable[Dict]]) -> Tuple[str, float, bytes]:
+        cached = await self.get(key)
+        response_cache_lookups.inc("hit" if cached else "miss")
+        return cached or await self.build(key, resolve)
+
+    async def respond(self, request: Request, key: str, resolve: Callable[[], Awaitable[Dict]]) -> Response:
+        etag, expires_at, body = await self.fetch(key, resolve)
+
+        headers = {"ETag": etag, "Cache-Control": f"max-age={max(0, round(expires_at - time.time()))}"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if "*" in tags or etag in tags:
+                return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+
+response_cache = ResponseCache(
+    settings.redis_url, max_ttl=settings.response_cache_max_ttl, negative_ttl=settings.response_cache_negative_ttl
+)
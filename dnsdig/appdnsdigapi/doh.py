@@ -0,0 +1,139 @@
+import base64
+import binascii
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import ujson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
+
+from dnsdig.appdnsdigapi.batch import LimitedBodyRoute
+from dnsdig.appdnsdigd.settings import dnsdigd_settings
+from dnsdig.appdnsdigd.utils import from_doh_simple, to_doh_simple
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.ratelimit import RateLimiter, doh_limiter
+
+if TYPE_CHECKING:
+    from dnsdig.appdnsdigd.engine import DNSEngine
+
+DNS_MESSAGE = "application/dns-message"
+DNS_JSON = "application/dns-json"
+
+
+class DNSMessageRoute(LimitedBodyRoute):
+    # A POST body is a single DNS message, those are at most 65535 bytes
+    max_body_bytes = 65535
+
+
+router = APIRouter(route_class=DNSMessageRoute)
+
+
+@lru_cache()
+def get_doh_engine() -> "DNSEngine":
+    # Same near cache, Redis cache, coalescing and upstreams as the daemon, built from a startup hook
+    from dnsdig.appdnsdigd.engine import DNSEngine
+
+    return DNSEngine(use_cache=True, use_adblocker=dnsdigd_settings.use_adblocker)
+
+
+def message_ttl(message: dns.message.Message) -> int:
+    # RFC 8484 section 5.1, a response is fresh for the smallest TTL of its answer and authority records
+    ttls = [rrset.ttl for rrset in message.answer + message.authority]
+    return min(ttls) if ttls else 0
+
+
+def parse_wire(wire: bytes) -> dns.message.Message:
+    try:
+        query = dns.message.from_wire(wire)
+    except dns.exception.DNSException as exc:
+        raise HTTPException(status_code=400, detail=f"Malformed DNS query: {exc}")
+    if len(query.question) != 1:
+        raise HTTPException(status_code=400, detail="DNS query must have exactly one question")
+    return query
+
+
+def parse_base64url(value: str) -> dns.message.Message:
+    # The dns parameter is base64url without padding
+    try:
+        wire = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="The dns parameter is not base64url encoded")
+    return parse_wire(wire)
+
+
+def parse_json(body: bytes) -> dns.message.Message:
+    try:
+        query = from_doh_simple(ujson.loads(body))
+    except (dns.exception.DNSException, KeyError, TypeError, ValueError) as exc:
+        raise HTTPException(status_code=400, detail=f"Malformed DNS JSON query: {exc!r}")
+    if len(query.question) != 1:
+        raise HTTPException(status_code=400, detail="DNS query must have exactly one question")
+    return query
+
+
+def parse_name(name: str, record_type: str) -> dns.message.Message:
+    try:
+        rdtype = dns.rdatatype.RdataType.make(int(record_type)) if record_type.isdigit() else record_type
+        return dns.message.make_query(name, rdtype)
+    except (dns.exception.DNSException, ValueError) as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid DNS question: {exc!r}")
+
+
+async def answer(query: dns.message.Message) -> dns.message.Message:
+    try:
+        response = await get_doh_engine().resolve(query)
+    except Exception as exc:
+        logger.error("Failed to resolve query", extra={"qname": query.question[0].name, "error": repr(exc)})
+        response = dns.message.make_response(query)
+        response.set_rcode(dns.rcode.SERVFAIL)
+    response.id = query.id
+    return response
+
+
+def render(response: dns.message.Message, as_json: bool) -> Response:
+    headers = {"Cache-Control": f"max-age={message_ttl(response)}"}
+    if as_json:
+        return JSONResponse(to_doh_simple(response), media_type=DNS_JSON, headers=headers)
+    return Response(content=response.to_wire(), media_type=DNS_MESSAGE, headers=headers)
+
+
+def accepts_json(request: Request) -> bool:
+    return DNS_JSON in request.headers.get("accept", "")
+
+
+@router.get(
+    "/dns-query",
+    summary="DNS over HTTPS - RFC 8484 wire format or JSON",
+    tags=["DoH", "Throttled"],
+    dependencies=[Depends(RateLimiter(doh_limiter))],
+)
+async def dns_query_get(
+    request: Request,
+    dns_param: str | None = Query(None, alias="dns"),
+    name: str | None = None,
+    record_type: str = Query("A", alias="type"),
+):
+    if dns_param:
+        return render(await answer(parse_base64url(dns_param)), as_json=accepts_json(request))
+    if name:
+        return render(await answer(parse_name(name, record_type)), as_json=True)
+    raise HTTPException(status_code=400, detail="Either the dns or the name parameter is required")
+
+
+@router.post(
+    "/dns-query",
+    summary="DNS over HTTPS - RFC 8484 wire format or JSON",
+    tags=["DoH", "Throttled"],
+    dependencies=[Depends(RateLimiter(doh_limiter))],
+)
+async def dns_query_post(request: Request):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type == DNS_MESSAGE:
+        return render(await answer(parse_wire(await request.body())), as_json=accepts_json(request))
+    if content_type == DNS_JSON:
+        return render(await answer(parse_json(await request.body())), as_json=True)
+    raise HTTPException(status_code=415, detail=f"Content type must be {DNS_MESSAGE} or {DNS_JSON}")
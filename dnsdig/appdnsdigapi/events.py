@@ -0,0 +1,32 @@
+from typing import AsyncIterator, List
+
+import pydantic_core
+
+from dnsdig.appdnsdigapi.cache import ResponseCache, response_cache, response_cache_lookups
+from dnsdig.libdns.constants import RecordTypes
+from dnsdig.libdns.domains.resolver import Resolver
+
+ALL_RECORD_TYPES = [RecordTypes.A, RecordTypes.AAAA, RecordTypes.MX, RecordTypes.TXT, RecordTypes.SOA]
+
+
+def server_sent_event(event: str, data: bytes) -> bytes:
+    return b"event: %s\ndata: %s\n\n" % (event.encode(), data)
+
+
+async def stream_resolve(name: str, record_types: List[RecordTypes] = ALL_RECORD_TYPES) -> AsyncIterator[bytes]:
+    key = ResponseCache.key(name, "ALL", use_ipv6=False)
+    cached = await response_cache.get(key)
+    response_cache_lookups.inc("hit" if cached else "miss")
+    if cached:
+        yield server_sent_event("result", cached[2])
+        return
+
+    async for event, data in Resolver.stream_records(hostname=name, record_types=record_types):
+        if event == "result":
+            # The last event is the body /resolve/{name} answers with, and is cached for it
+            _, _, body = await response_cache.store(key, data)
+            yield server_sent_event(event, body)
+        elif event == "incomplete":
+            yield server_sent_event("result", pydantic_core.to_json(data, by_alias=True))
+        else:
+            yield server_sent_event(event, pydantic_core.to_json(data, by_alias=True))
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+from typing import Dict, List
+
+import ujson
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import Counter, Histogram, Registry, REGISTRY
+from dnsdig.libshared.settings import settings
+from dnsdig.libshared.utils import cancel_tasks
+
+http_requests = Counter("dnsdig_http_requests", "HTTP requests handled", ["method", "route", "status"])
+http_request_duration = Histogram("dnsdig_http_request_duration_seconds", "HTTP request latency", ["route"])
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def _send(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            # Label by route template instead of the raw path to keep cardinality bounded
+            route = scope.get("route")
+            path = route.path if route else "unmatched"
+            http_requests.inc(scope["method"], path, str(status))
+            http_request_duration.observe(time.perf_counter() - start, path)
+
+
+class WorkerMetrics:
+    def __init__(self, registry: Registry, directory: str | None, interval: float = 5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.task: asyncio.Task | None = None
+
+    def path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def write(self, body: str):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(os.getpid())
+        with open(f"{path}.tmp", "w") as snapshot:
+            snapshot.write(body)
+        os.replace(f"{path}.tmp", path)
+
+    def read_others(self) -> List[Dict]:
+        snapshots = []
+        for entry in os.scandir(self.directory):
+            pid, _, extension = entry.name.partition(".")
+            if extension != "json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                # A worker that is gone takes its numbers with it, like a restarted single process would
+                os.unlink(entry.path)
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(entry.path) as snapshot:
+                    snapshots.append(ujson.loads(snapshot.read()))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    async def render(self) -> str:
+        # Snapshots are taken on the event loop, the only thread that records metrics
+        if not self.directory:
+            return self.registry.render()
+        own = self.registry.snapshot()
+        try:
+            others = await asyncio.to_thread(self.read_others)
+        except OSError:
+            others = []
+        return self.registry.merged([own, *others]).render()
+
+    async def sync_forever(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.write, ujson.dumps(self.registry.snapshot()))
+            except OSError as exc:
+                logger.warning("Failed to share worker metrics", extra={"error": repr(exc)})
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.directory and self.task is None:
+            self.task = asyncio.create_task(self.sync_forever())
+
+    async def stop(self):
+        await cancel_tasks(self.task)
+        self.task = None
+
+
+# uvicorn runs a worker per core, /metrics answers for all of them whichever one is scraped
+worker_metrics = WorkerMetrics(REGISTRY, settings.metrics_dir, interval=settings.metrics_sync_interval)
@@ -0,0 +1,32 @@
+import re
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from dnsdig.libshared.logging import request_id, set_request_id
+
+# Ids from callers end up in every log line of the request, anything else gets a fresh one
+VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+
+class RequestIdMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        given = Headers(scope=scope).get("x-request-id")
+        token = set_request_id(given if given and VALID_REQUEST_ID.fullmatch(given) else None)
+        current = request_id.get().encode()
+
+        async def _send(message: Message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", current)]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            request_id.reset(token)
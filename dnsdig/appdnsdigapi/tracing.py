@@ -0,0 +1,33 @@
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from dnsdig.libshared.tracing import tracer, Span
+
+
+class TracingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not tracer.enabled:
+            return await self.app(scope, receive, send)
+
+        traceparent = Headers(scope=scope).get("traceparent")
+        root: Span = tracer.root("http.request", traceparent, method=scope["method"])
+
+        async def _send(message: Message):
+            if message["type"] == "http.response.start":
+                root.set("status", message["status"])
+                root.error = message["status"] >= 500
+                # Callers can find the trace of their request when it was kept
+                traceparent = f"00-{root.trace.trace_id}-{root.span_id}-01".encode()
+                message["headers"] = [*message.get("headers", []), (b"traceparent", traceparent)]
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, receive, _send)
+        finally:
+            route = scope.get("route")
+            root.name = f"{scope['method']} {route.path if route else 'unmatched'}"
+            tracer.finish(root)
@@ -1,10 +1,13 @@
 import asyncio
 from typing import Dict, List
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from fastapi_limiter.depends import RateLimiter
 
+from dnsdig.appdnsdigapi.batch import LimitedBodyRoute, stream_lookups, unique_lookups
+from dnsdig.appdnsdigapi.cache import ResponseCache, response_cache
+from dnsdig.appdnsdigapi.events import ALL_RECORD_TYPES, stream_resolve
 from dnsdig.libaccount.domains.account import Account
 from dnsdig.libaccount.models.auth import (
     LoginUrlRequest,
@@ -13,14 +16,30 @@ from dnsdig.libaccount.models.auth import (
     ClientCredentialsRequest,
     RefreshTokenExchangeRequest,
 )
-from dnsdig.libaccount.models.responses import LoginUrlResponse, AccessTokenResponse, UserApplicationResponse
+from dnsdig.libaccount.models.responses import (
+    LoginUrlResponse,
+    AccessTokenResponse,
+    UserApplicationResponse,
+    RevokeTokensResponse,
+)
 from dnsdig.libdns.constants import RecordTypes
 from dnsdig.libdns.domains.resolver import ResolverResult, Resolver
+from dnsdig.libdns.models.resolver import BatchResolveRequest
 from dnsdig.libshared.context import Context
-from dnsdig.libshared.models import MongoClient, MongoClientDependency
+from dnsdig.libshared.models import MongoClient, MongoClientDependency, ModelJSONResponse
+from dnsdig.libshared.ratelimit import RateLimiter, public_limiter
 from dnsdig.libshared.settings import settings
 
 router = APIRouter()
+# Batches are refused by size while their body is read, before it is parsed
+batch_router = APIRouter(route_class=LimitedBodyRoute)
+
+
+async def resolve_all(name: str) -> Dict[RecordTypes, ResolverResult]:
+    group_results = await asyncio.gather(
+        *[Resolver.resolve_record(hostname=name, record_type=record_type) for record_type in ALL_RECORD_TYPES]
+    )
+    return dict(zip(ALL_RECORD_TYPES, group_results))
 
 
 @router.get(
@@ -28,32 +47,34 @@ router = APIRouter()
     summary="Resolve multiple DNS records",
     tags=["Resolver"],
     response_model=Dict[RecordTypes, ResolverResult],
+    response_class=ModelJSONResponse,
 )
 async def resolve_dns_records(
-    name: str,
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
-    mongo_client: MongoClient = Depends(MongoClientDependency()),
+    name: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))
 ):
     permissions = [Permissions.ReadResolver]
 
-    async with mongo_client.transaction():
-        async with Context.protected(authorization=credentials, permissions=permissions):
-            group = [
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.A),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.AAAA),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.MX),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.TXT),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.SOA),
-            ]
-            group_results = await asyncio.gather(*group)
-            results = {
-                RecordTypes.A: group_results[0],
-                RecordTypes.AAAA: group_results[1],
-                RecordTypes.MX: group_results[2],
-                RecordTypes.TXT: group_results[3],
-                RecordTypes.SOA: group_results[4],
-            }
-            return results
+    async with Context.protected(authorization=credentials, permissions=permissions):
+        key = ResponseCache.key(name, "ALL", use_ipv6=False)
+        return await response_cache.respond(request, key, lambda: resolve_all(name))
+
+
+# Registered before /resolve/{name}/{record_type}, which would take "stream" for a record type
+@router.get(
+    "/resolve/{name}/stream",
+    summary="Resolve multiple DNS records, streamed as Server-Sent Events as each provider answers",
+    tags=["Resolver"],
+    response_class=StreamingResponse,
+)
+async def resolve_dns_records_stream(
+    name: str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))
+):
+    permissions = [Permissions.ReadResolver]
+
+    async with Context.protected(authorization=credentials, permissions=permissions):
+        # Proxies must not buffer the stream, the first provider's answer is the point of it
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return StreamingResponse(stream_resolve(name), media_type="text/event-stream", headers=headers)
 
 
 @router.get(
@@ -61,43 +82,35 @@ async def resolve_dns_records(
     summary="Resolve multiple DNS records - Throttled",
     tags=["Resolver", "Throttled"],
     response_model=Dict[RecordTypes, ResolverResult],
-    dependencies=[Depends(RateLimiter(times=settings.throttler_times, seconds=settings.throttler_seconds))],
+    response_class=ModelJSONResponse,
+    dependencies=[Depends(RateLimiter(public_limiter))],
 )
-async def freesolve_dns_records(name: str, mongo_client: MongoClient = Depends(MongoClientDependency())):
-    async with mongo_client.transaction():
-        async with Context.public():
-            group = [
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.A),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.AAAA),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.MX),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.TXT),
-                Resolver.resolve_record(hostname=name, record_type=RecordTypes.SOA),
-            ]
-            group_results = await asyncio.gather(*group)
-            results = {
-                RecordTypes.A: group_results[0],
-                RecordTypes.AAAA: group_results[1],
-                RecordTypes.MX: group_results[2],
-                RecordTypes.TXT: group_results[3],
-                RecordTypes.SOA: group_results[4],
-            }
-            return results
+async def freesolve_dns_records(name: str, request: Request):
+    async with Context.public():
+        key = ResponseCache.key(name, "ALL", use_ipv6=False)
+        return await response_cache.respond(request, key, lambda: resolve_all(name))
 
 
 @router.get(
-    "/resolve/{name}/{record_type}", summary="Resolve a DNS record", tags=["Resolver"], response_model=ResolverResult
+    "/resolve/{name}/{record_type}",
+    summary="Resolve a DNS record",
+    tags=["Resolver"],
+    response_model=ResolverResult,
+    response_class=ModelJSONResponse,
 )
 async def resolve_dns_record(
     name: str,
+    request: Request,
     record_type: RecordTypes = RecordTypes.A,
     credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
-    mongo_client: MongoClient = Depends(MongoClientDependency()),
 ):
     permissions = [Permissions.ReadResolver]
 
-    async with mongo_client.transaction():
-        async with Context.protected(authorization=credentials, permissions=permissions):
-            return await Resolver.resolve_record(hostname=name, record_type=record_type)
+    async with Context.protected(authorization=credentials, permissions=permissions):
+        key = ResponseCache.key(name, record_type.value, use_ipv6=False)
+        return await response_cache.respond(
+            request, key, lambda: Resolver.resolve_record(hostname=name, record_type=record_type)
+        )
 
 
 @router.get(
@@ -105,14 +118,42 @@ async def resolve_dns_record(
     summary="Resolve a DNS record",
     tags=["Resolver", "Throttled"],
     response_model=ResolverResult,
-    dependencies=[Depends(RateLimiter(times=settings.throttler_times, seconds=settings.throttler_seconds))],
+    response_class=ModelJSONResponse,
+    dependencies=[Depends(RateLimiter(public_limiter))],
+)
+async def freesolve_dns_record(name: str, request: Request, record_type: RecordTypes = RecordTypes.A):
+    async with Context.public():
+        key = ResponseCache.key(name, record_type.value, use_ipv6=False)
+        return await response_cache.respond(
+            request, key, lambda: Resolver.resolve_record(hostname=name, record_type=record_type)
+        )
+
+
+@batch_router.post(
+    "/resolve/batch",
+    summary="Resolve many DNS records, streamed back as NDJSON in completion order",
+    tags=["Resolver"],
+    response_class=StreamingResponse,
 )
-async def freesolve_dns_record(
-    name: str, record_type: RecordTypes = RecordTypes.A, mongo_client: MongoClient = Depends(MongoClientDependency())
+async def resolve_dns_records_batch(
+    payload: BatchResolveRequest, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))
 ):
-    async with mongo_client.transaction():
-        async with Context.public():
-            return await Resolver.resolve_record(hostname=name, record_type=record_type)
+    permissions = [Permissions.ReadResolver]
+
+    # Callers learn nothing about the limits before they are authenticated
+    async with Context.protected(authorization=credentials, permissions=permissions, cost=0) as context:
+        lookups = unique_lookups(payload.lookups)
+        if len(lookups) > settings.resolver_batch_max_lookups:
+            raise HTTPException(
+                status_code=413,
+                detail=f"A batch resolves at most {settings.resolver_batch_max_lookups} name and type pairs",
+            )
+
+        # A batch counts as one request per lookup against the application's rate limit
+        await context.charge(max(1, len(lookups)))
+        return StreamingResponse(
+            stream_lookups(lookups, concurrency=settings.resolver_batch_concurrency), media_type="application/x-ndjson"
+        )
 
 
 @router.get(
@@ -120,18 +161,17 @@ async def freesolve_dns_record(
     summary="Resolve a DNS record using IPv6 resolvers",
     tags=["Resolver"],
     response_model=ResolverResult,
+    response_class=ModelJSONResponse,
 )
 async def resolve6_dns_record(
     name: str,
     record_type: RecordTypes = RecordTypes.A,
     credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
-    mongo_client: MongoClient = Depends(MongoClientDependency()),
 ):
     permissions = [Permissions.ReadResolver]
 
-    async with mongo_client.transaction():
-        async with Context.protected(authorization=credentials, permissions=permissions):
-            return await Resolver.resolve_record(hostname=name, record_type=record_type)
+    async with Context.protected(authorization=credentials, permissions=permissions):
+        return ModelJSONResponse(await Resolver.resolve_record(hostname=name, record_type=record_type))
 
 
 @router.post("/me/login-url", summary="Get the login URL for a user", tags=["Me"], response_model=LoginUrlResponse)
@@ -207,12 +247,29 @@ async def create_app(
     tags=["Me", "Applications"],
     response_model=List[UserApplicationResponse],
 )
-async def list_app(
+async def list_app(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))):
+    permissions = [Permissions.ReadApplication]
+
+    async with Context.protected(authorization=credentials, permissions=permissions) as ctx:
+        return await Account.list_applications(context=ctx)
+
+
+@router.delete(
+    "/me/applications/{client_id}/tokens",
+    summary="Revoke every token issued to one of my applications",
+    tags=["Me", "Applications"],
+    response_model=RevokeTokensResponse,
+)
+async def revoke_app_tokens(
+    client_id: str,
     mongo_client: MongoClient = Depends(MongoClientDependency()),
     credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
 ):
-    permissions = [Permissions.ReadApplication]
+    permissions = [Permissions.WriteApplication]
 
     async with mongo_client.transaction():
         async with Context.protected(authorization=credentials, permissions=permissions) as ctx:
-            return await Account.list_applications(context=ctx)
+            return await Account.revoke_application_tokens(client_id=client_id, context=ctx)
+
+
+router.include_router(batch_router)
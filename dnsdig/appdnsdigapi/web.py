@@ -1,16 +1,31 @@
-import redis.asyncio as redis
-import sentry_sdk
+import asyncio
+
 from beanie import init_beanie
 from fastapi import FastAPI
 from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi_limiter import FastAPILimiter
+from fastapi.responses import Response, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 
+from dnsdig.appdnsdigapi.doh import router as doh_router, get_doh_engine
+from dnsdig.appdnsdigapi.metrics import MetricsMiddleware, worker_metrics
+from dnsdig.appdnsdigapi.requestid import RequestIdMiddleware
+from dnsdig.appdnsdigapi.tracing import TracingMiddleware
 from dnsdig.appdnsdigapi.views import router as dnsdig_router
 from dnsdig.libaccount.models.mongo import User, OAuthSession, Token
-from dnsdig.libshared.logging import logger
-from dnsdig.libshared.models import mongo_client
+from dnsdig.libshared.jwks import jwks_manager
+from dnsdig.libshared.logging import logger, start_log_listener
+from dnsdig.libshared.metrics import CONTENT_TYPE
+from dnsdig.libshared.models import get_mongo_client
+from dnsdig.libshared.principals import principal_cache
+from dnsdig.libshared.ratelimit import rate_limiters
 from dnsdig.libshared.settings import settings, Environments
+from dnsdig.libshared.tracing import tracer
+from dnsdig.libshared.utils import cancel_tasks
+
+
+async def logging_setup():
+    # Log lines are written from a thread of their own, never from the event loop
+    start_log_listener()
 
 
 async def beanie_setup():
@@ -18,16 +33,53 @@ async def beanie_setup():
         logger.info(f"Mongo URL: {settings.mongo_url} - {settings.db_name}")
     logger.info("Initializing MongoDB - Start")
     collections = [User, OAuthSession, Token]
-    await init_beanie(database=mongo_client[settings.db_name], document_models=collections)
+    await init_beanie(database=get_mongo_client()[settings.db_name], document_models=collections)
     logger.info("Initializing MongoDB - End")
 
 
 async def limiter_setup():
-    if settings.env == Environments.Dev:
-        logger.info(f"Redis URL: {settings.mongo_url} - {settings.db_name}")
-    redis_client = redis.from_url(settings.redis_url, encoding="utf-8", decode_responses=True)
-    await FastAPILimiter.init(redis_client)
-    logger.info("Initializing Redis - End")
+    # Counters live in each worker and are reconciled with Redis in the background
+    for limiter in rate_limiters:
+        limiter.start()
+    logger.info("Initializing rate limiters - End")
+
+
+async def principals_setup():
+    # Blocked users and changed applications are dropped from the principal cache as soon as they change
+    app.state.principal_listener = asyncio.create_task(principal_cache.listen_forever())
+
+
+async def doh_setup():
+    # The near cache of the DoH engine follows the Redis invalidations like the daemon does
+    app.state.doh_trackers = await get_doh_engine().start_tracking()
+
+
+async def metrics_setup():
+    # Every worker shares its metrics with the others of the host
+    worker_metrics.start()
+
+
+async def tracing_setup():
+    # Kept traces are exported in batches from the background, requests only queue them
+    tracer.start()
+
+
+async def jwks_setup():
+    # Keys are fetched before the first request and refreshed in the background, never on the request path
+    await jwks_manager.start()
+
+
+async def background_shutdown():
+    # Background loops stop first, the limiters still flush their last counts to Redis
+    await cancel_tasks(app.state.principal_listener, *app.state.doh_trackers)
+    for limiter in rate_limiters:
+        await limiter.stop()
+    await jwks_manager.stop()
+    await worker_metrics.stop()
+    await tracer.stop()
+    await principal_cache.close()
+    await get_doh_engine().close()
+    logger.info("Background tasks stopped")
 
 
 app_params = {
@@ -37,11 +89,39 @@ app_params = {
     'docs_url': None,
     'redoc_url': None,
 }
-app = FastAPI(**app_params, on_startup=[beanie_setup, limiter_setup])
+
+
+async def warm_up():
+    # The OpenAPI schema is built on first request otherwise, one slow request per worker
+    app.openapi()
+    app.state.ready = True
+    logger.info("Warm up - End")
+
+
+app = FastAPI(
+    **app_params,
+    on_startup=[
+        logging_setup,
+        beanie_setup,
+        limiter_setup,
+        principals_setup,
+        jwks_setup,
+        doh_setup,
+        metrics_setup,
+        tracing_setup,
+        warm_up,
+    ],
+    on_shutdown=[background_shutdown],
+)
+app.state.ready = False
 
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+# Outermost, every other middleware logs with the id of the request
+app.add_middleware(RequestIdMiddleware)
 
 
 @app.get("/healthcheck", status_code=200, tags=['System'])
@@ -49,6 +129,19 @@ def health_check():
     return "OK"
 
 
+@app.get("/ready", include_in_schema=False)
+def ready():
+    if not app.state.ready:
+        return PlainTextResponse("Warming up", status_code=503)
+    return PlainTextResponse("Ready")
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # On the event loop, the thread that records metrics, so the label dicts never change while being rendered
+    return Response(content=await worker_metrics.render(), media_type=CONTENT_TYPE)
+
+
 @app.get('/openapi.json', include_in_schema=False)
 async def openapi():
     return app.openapi()
@@ -64,9 +157,12 @@ async def swagger():
 
 
 app.include_router(dnsdig_router, prefix="/v1")
+app.include_router(doh_router)
 
 # Sentry setup
-if settings.sentry_dsn == Environments.Production and settings.sentry_dsn:
+if settings.env == Environments.Production and settings.sentry_dsn:
+    import sentry_sdk
+
     sentry_sdk.init(
         dsn=settings.sentry_dsn,
         traces_sample_rate=settings.sentry_sample_rate,
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+import typer
+import ujson
+import uvloop
+from rich.console import Console
+from rich.table import Table
+
+from dnsdig.appdnsdigbench.loadgen import QueryMix, LoadGenerator, HttpLoadGenerator
+from dnsdig.appdnsdigbench.report import BenchmarkReport, scrape_metrics, cache_summary
+from dnsdig.appdnsdigbench.stubupstream import (
+    StubUpstream,
+    StubUpstreamConfig,
+    LatencyDistributions,
+    serve_udp,
+    serve_tls,
+)
+
+app = typer.Typer()
+
+
+async def _serve_stub(config: StubUpstreamConfig, host: str, udp_port: int, tls_port: int):
+    upstream = StubUpstream(config)
+    if udp_port:
+        await serve_udp(upstream, host=host, port=udp_port)
+    if tls_port:
+        await serve_tls(upstream, host=host, port=tls_port)
+    await asyncio.Event().wait()
+
+
+async def _run(
+    host: str, port: int, qps: int, duration: float, mix: QueryMix, metrics_url: str | None, output: str | None
+) -> BenchmarkReport:
+    before = await scrape_metrics(metrics_url) if metrics_url else {}
+    result = await LoadGenerator(host=host, port=port, qps=qps, duration=duration, mix=mix).run()
+    after = await scrape_metrics(metrics_url) if metrics_url else {}
+
+    report = BenchmarkReport.from_result(
+        result,
+        target=f"{host}:{port}",
+        qps_target=qps,
+        cache=cache_summary(before, after),
+        config={"mix": mix.model_dump()},
+    )
+    if output:
+        report.save(output)
+    return report
+
+
+async def _run_http(
+    base_url: str, path: str, rps: int, duration: float, connections: int, mix: QueryMix, output: str | None
+) -> BenchmarkReport:
+    generator = HttpLoadGenerator(
+        base_url=base_url, path=path, rps=rps, duration=duration, mix=mix, connections=connections
+    )
+    result = await generator.run()
+
+    report = BenchmarkReport.from_result(
+        result, target=f"{base_url}{path}", qps_target=rps, config={"mix": mix.model_dump(), "connections": connections}
+    )
+    if output:
+        report.save(output)
+    return report
+
+
+def _spawn(args: List[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen(args, env={**os.environ, **env})
+
+
+@app.command()
+def stub(
+    host: str = typer.Option("127.0.0.1", help="Host to listen"),
+    udp_port: int = typer.Option(5300, help="UDP port to listen, 0 to disable"),
+    tls_port: int = typer.Option(8853, help="DoT port to listen, 0 to disable"),
+    latency_ms: float = typer.Option(20.0, help="Median upstream latency"),
+    latency_jitter_ms: float = typer.Option(5.0, help="Latency spread"),
+    latency_distribution: LatencyDistributions = typer.Option(LatencyDistributions.LogNormal),
+    loss: float = typer.Option(0.0, help="Ratio of queries left unanswered"),
+    ttls: List[int] = typer.Option([30, 300, 3600], help="TTLs handed out to names"),
+    seed: int = typer.Option(42, help="Random seed"),
+):
+    config = StubUpstreamConfig(
+        latency_ms=latency_ms,
+        latency_jitter_ms=latency_jitter_ms,
+        latency_distribution=latency_distribution,
+        loss=loss,
+        ttls=ttls,
+        seed=seed,
+    )
+    uvloop.run(_serve_stub(config, host=host, udp_port=udp_port, tls_port=tls_port))
+
+
+@app.command()
+def run(
+    target: str = typer.Option("127.0.0.1:5053", help="dnsdigd host:port to load"),
+    qps: int = typer.Option(1000, help="Target queries per second"),
+    duration: float = typer.Option(30.0, help="Seconds to run"),
+    names: int = typer.Option(10000, help="Number of distinct names"),
+    zipf_exponent: float = typer.Option(1.1, help="Zipf exponent of name popularity"),
+    seed: int = typer.Option(42, help="Random seed"),
+    metrics_url: Optional[str] = typer.Option("http://127.0.0.1:9153/metrics", help="dnsdigd metrics URL"),
+    output: Optional[str] = typer.Option(None, help="Write the JSON report to this file"),
+    spawn: bool = typer.Option(False, help="Start a stub upstream and dnsdigd before running"),
+    stub_protocol: str = typer.Option("tls", help="Protocol dnsdigd uses to reach the spawned stub, tls or udp"),
+):
+    host, port = target.rsplit(":", 1)
+    processes = []
+    if spawn:
+        stub_port = "8853" if stub_protocol == "tls" else "5300"
+        stub_args = ["--udp-port", "0", "--tls-port", stub_port]
+        if stub_protocol == "udp":
+            stub_args = ["--udp-port", stub_port, "--tls-port", "0"]
+        processes.append(_spawn([sys.executable, "-m", "dnsdig.appdnsdigbench.bench", "stub", *stub_args], env={}))
+        processes.append(
+            _spawn(
+                [sys.executable, "dnsdigd.py", "--host", host, "--port", port],
+                env={
+                    "UPSTREAMS": ujson.dumps(["127.0.0.1"]),
+                    "UPSTREAM_PORT": stub_port,
+                    "UPSTREAM_PROTOCOL": stub_protocol,
+                    "UPSTREAM_TLS_VERIFY": "false",
+                    "LOG_LEVEL": "WARNING",
+                },
+            )
+        )
+        time.sleep(3)
+
+    try:
+        mix = QueryMix(names=names, zipf_exponent=zipf_exponent, seed=seed)
+        report = uvloop.run(_run(host, int(port), qps, duration, mix, metrics_url, output))
+    finally:
+        for process in processes:
+            process.terminate()
+
+    typer.echo(report.model_dump_json(indent=2))
+
+
+@app.command()
+def http(
+    base_url: str = typer.Option("http://127.0.0.1:8000", help="DNSDig API base URL"),
+    path: str = typer.Option("/v1/freesolve/{name}", help="Path to request, {name} is replaced by each name"),
+    rps: int = typer.Option(200, help="Target requests per second"),
+    duration: float = typer.Option(30.0, help="Seconds to run"),
+    connections: int = typer.Option(100, help="Maximum open connections"),
+    names: int = typer.Option(1000, help="Number of distinct names"),
+    zipf_exponent: float = typer.Option(1.1, help="Zipf exponent of name popularity"),
+    zone: str = typer.Option("bench.test", help="Zone the names are generated under"),
+    seed: int = typer.Option(42, help="Random seed"),
+    output: Optional[str] = typer.Option(None, help="Write the JSON report to this file"),
+):
+    mix = QueryMix(names=names, zipf_exponent=zipf_exponent, zone=zone, seed=seed)
+    report = uvloop.run(_run_http(base_url, path, rps, duration, connections, mix, output))
+    typer.echo(report.model_dump_json(indent=2))
+
+
+@app.command()
+def compare(baseline: str, candidate: str):
+    base, cand = BenchmarkReport.load(baseline), BenchmarkReport.load(candidate)
+
+    def _row(label: str, a: float | None, b: float | None):
+        change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "-"
+        return label, f"{a:.2f}" if a is not None else "-", f"{b:.2f}" if b is not None else "-", change
+
+    table = Table("Metric", base.commit or baseline, cand.commit or candidate, "Change", title="dnsdig benchmark")
+    table.add_row(*_row("Throughput (qps)", base.throughput_qps, cand.throughput_qps))
+    table.add_row(*_row("p50 (ms)", base.latency_ms.p50, cand.latency_ms.p50))
+    table.add_row(*_row("p99 (ms)", base.latency_ms.p99, cand.latency_ms.p99))
+    table.add_row(*_row("p99.9 (ms)", base.latency_ms.p999, cand.latency_ms.p999))
+    table.add_row(*_row("Timeouts", base.timeouts, cand.timeouts))
+    table.add_row(*_row("Errors", base.errors, cand.errors))
+    table.add_row(*_row("Cache hit ratio", base.cache.hit_ratio, cand.cache.hit_ratio))
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,190 @@
+import asyncio
+import itertools
+import random
+import struct
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+import aiohttp
+import dns.message
+import dns.rdatatype
+from pydantic import BaseModel, Field
+
+
+class QueryMix(BaseModel):
+    names: int = 10000
+    zipf_exponent: float = 1.1
+    zone: str = "bench.test"
+    qtypes: Dict[str, float] = Field(default_factory=lambda: {"A": 0.7, "AAAA": 0.2, "MX": 0.05, "TXT": 0.05})
+    seed: int = 42
+
+
+class LoadResult(BaseModel):
+    sent: int = 0
+    received: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    latencies_ms: List[float] = Field(default_factory=list)
+
+
+class QueryStream:
+    def __init__(self, mix: QueryMix):
+        self.mix = mix
+        self.rng = random.Random(mix.seed)
+
+        # Rank 1 is the most popular name, weights follow 1 / rank^s
+        weights = [1 / (rank**mix.zipf_exponent) for rank in range(1, mix.names + 1)]
+        self.name_cdf = list(itertools.accumulate(weights))
+        self.qtypes = [dns.rdatatype.from_text(qtype) for qtype in mix.qtypes]
+        self.qtype_cdf = list(itertools.accumulate(mix.qtypes.values()))
+        self.templates: Dict[Tuple[int, int], bytes] = {}
+
+    def _pick(self, cdf: List[float]) -> int:
+        return min(bisect_left(cdf, self.rng.random() * cdf[-1]), len(cdf) - 1)
+
+    def next_name(self) -> str:
+        return f"host{self._pick(self.name_cdf)}.{self.mix.zone}"
+
+    def next_query(self, query_id: int) -> bytes:
+        key = (self._pick(self.name_cdf), self._pick(self.qtype_cdf))
+        template = self.templates.get(key)
+        if template is None:
+            name = f"host{key[0]}.{self.mix.zone}"
+            template = self.templates[key] = dns.message.make_query(name, self.qtypes[key[1]]).to_wire()
+        # Only the 16 bit message id changes between queries for the same question
+        return struct.pack("!H", query_id) + template[2:]
+
+
+class LoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pending: Dict[int, float], result: LoadResult):
+        self.pending = pending
+        self.result = result
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        (query_id,) = struct.unpack("!H", data[:2])
+        sent_at = self.pending.pop(query_id, None)
+        if sent_at is None:
+            return
+        self.result.received += 1
+        self.result.latencies_ms.append((time.perf_counter() - sent_at) * 1000)
+
+
+class LoadGenerator:
+    def __init__(self, host: str, port: int, qps: int, duration: float, mix: QueryMix, timeout: float = 2.0):
+        self.host = host
+        self.port = port
+        self.qps = qps
+        self.duration = duration
+        self.timeout = timeout
+        self.stream = QueryStream(mix)
+
+    def _expire(self, pending: Dict[int, float], result: LoadResult, now: float):
+        expired = [query_id for query_id, sent_at in pending.items() if now - sent_at > self.timeout]
+        for query_id in expired:
+            del pending[query_id]
+        result.timeouts += len(expired)
+
+    async def run(self) -> LoadResult:
+        loop = asyncio.get_running_loop()
+        result = LoadResult()
+        pending: Dict[int, float] = {}
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: LoadProtocol(pending, result), remote_addr=(self.host, self.port)
+        )
+
+        ids = itertools.cycle(range(65536))
+        started = time.perf_counter()
+        next_expiry = started + self.timeout
+        try:
+            # Open loop: the send schedule is fixed by the target rate, never by how fast answers come back
+            while (now := time.perf_counter()) - started < self.duration:
+                due = int((now - started) * self.qps) - result.sent
+                for _ in range(due):
+                    query_id = next(ids)
+                    if query_id in pending:
+                        result.timeouts += 1
+                    pending[query_id] = time.perf_counter()
+                    transport.sendto(self.stream.next_query(query_id))
+                    result.sent += 1
+                if now > next_expiry:
+                    self._expire(pending, result, now)
+                    next_expiry = now + self.timeout / 4
+                await asyncio.sleep(0.001)
+
+            result.elapsed = time.perf_counter() - started
+
+            # Drain answers still in flight
+            deadline = time.perf_counter() + self.timeout
+            while pending and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+            result.timeouts += len(pending)
+        finally:
+            transport.close()
+
+        return result
+
+
+class HttpLoadGenerator:
+    def __init__(
+        self,
+        base_url: str,
+        path: str,
+        rps: int,
+        duration: float,
+        mix: QueryMix,
+        timeout: float = 2.0,
+        connections: int = 100,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.path = path
+        self.rps = rps
+        self.duration = duration
+        self.timeout = timeout
+        self.connections = connections
+        self.stream = QueryStream(mix)
+
+    async def request(self, session: aiohttp.ClientSession, url: str, result: LoadResult):
+        sent_at = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+        except asyncio.TimeoutError:
+            result.timeouts += 1
+            return
+        except aiohttp.ClientError:
+            result.errors += 1
+            return
+        # Rate limited or failed requests are not answers, a throttled run shows up as errors
+        if response.status != 200:
+            result.errors += 1
+            return
+        result.received += 1
+        result.latencies_ms.append((time.perf_counter() - sent_at) * 1000)
+
+    async def run(self) -> LoadResult:
+        result = LoadResult()
+        requests = set()
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            started = time.perf_counter()
+            # Open loop like the UDP generator, requests waiting for a free connection count towards their latency
+            while (now := time.perf_counter()) - started < self.duration:
+                due = int((now - started) * self.rps) - result.sent
+                for _ in range(due):
+                    url = f"{self.base_url}{self.path.format(name=self.stream.next_name())}"
+                    task = asyncio.create_task(self.request(session, url, result))
+                    requests.add(task)
+                    task.add_done_callback(requests.discard)
+                    result.sent += 1
+                await asyncio.sleep(0.001)
+
+            result.elapsed = time.perf_counter() - started
+
+            # Requests in flight finish or time out on their own
+            if requests:
+                await asyncio.gather(*requests)
+
+        return result
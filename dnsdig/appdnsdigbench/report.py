@@ -0,0 +1,126 @@
+import re
+import subprocess
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Any, Tuple
+
+import aiohttp
+from pydantic import BaseModel, Field
+
+from dnsdig.appdnsdigbench.loadgen import LoadResult
+
+_sample = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{[^}]*\})?\s+(?P<value>\S+)$')
+_label = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+Samples = Dict[str, List[Tuple[Dict[str, str], float]]]
+
+
+def parse_metrics(text: str) -> Samples:
+    samples: Samples = defaultdict(list)
+    for line in text.splitlines():
+        match = _sample.match(line)
+        if not line or line.startswith("#") or not match:
+            continue
+        labels = dict(_label.findall(match.group("labels") or ""))
+        samples[match.group("name")].append((labels, float(match.group("value"))))
+    return samples
+
+
+async def scrape_metrics(url: str) -> Samples:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            return parse_metrics(await response.text())
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LatencySummary(BaseModel):
+    p50: float
+    p99: float
+    p999: float
+    average: float
+    maximum: float
+
+
+class CacheSummary(BaseModel):
+    hit_ratio: float | None = None
+    tiers: Dict[str, float] = Field(default_factory=dict)
+
+
+class BenchmarkReport(BaseModel):
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    commit: str | None = Field(default_factory=git_commit)
+    target: str
+    qps_target: int
+    duration: float
+    sent: int
+    received: int
+    timeouts: int
+    errors: int = 0
+    throughput_qps: float
+    latency_ms: LatencySummary
+    cache: CacheSummary = Field(default_factory=CacheSummary)
+    config: Dict[str, Any] = Field(default_factory=dict)
+
+    @classmethod
+    def from_result(cls, result: LoadResult, target: str, qps_target: int, **kwargs) -> "BenchmarkReport":
+        latencies = result.latencies_ms
+        return cls(
+            target=target,
+            qps_target=qps_target,
+            duration=result.elapsed,
+            sent=result.sent,
+            received=result.received,
+            timeouts=result.timeouts,
+            errors=result.errors,
+            throughput_qps=result.received / result.elapsed if result.elapsed else 0.0,
+            latency_ms=LatencySummary(
+                p50=percentile(latencies, 0.5),
+                p99=percentile(latencies, 0.99),
+                p999=percentile(latencies, 0.999),
+                average=sum(latencies) / len(latencies) if latencies else 0.0,
+                maximum=max(latencies, default=0.0),
+            ),
+            **kwargs,
+        )
+
+    def save(self, path: str | Path):
+        Path(path).write_text(self.model_dump_json(indent=2))
+
+    @classmethod
+    def load(cls, path: str | Path) -> "BenchmarkReport":
+        return cls.model_validate_json(Path(path).read_text())
+
+
+def cache_summary(before: Samples, after: Samples) -> CacheSummary:
+    def _delta(name: str, **match: str) -> float:
+        def _total(samples: Samples) -> float:
+            return sum(v for labels, v in samples.get(name, []) if all(labels.get(k) == x for k, x in match.items()))
+
+        return _total(after) - _total(before)
+
+    queries = _delta("dnsdigd_queries_total")
+    upstream = _delta("dnsdigd_upstream_rtt_seconds_count") + _delta("dnsdigd_upstream_errors_total")
+
+    tiers = {}
+    for tier in sorted({labels.get("tier") for labels, _ in after.get("dnsdigd_cache_requests_total", [])}):
+        hits = _delta("dnsdigd_cache_requests_total", tier=tier, result="hit")
+        lookups = hits + _delta("dnsdigd_cache_requests_total", tier=tier, result="miss")
+        if lookups:
+            tiers[tier] = hits / lookups
+
+    return CacheSummary(hit_ratio=1 - upstream / queries if queries else None, tiers=tiers)
@@ -0,0 +1,95 @@
+import asyncio
+from typing import List, Tuple
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.zone
+from dns.rdatatype import RdataType
+
+from dnsdig.libshared.logging import logger
+
+
+class StubAuthority:
+    def __init__(self, zones: List[dns.zone.Zone]):
+        # Deepest origin first so the most specific zone a server hosts answers
+        self.zones = sorted(zones, key=lambda zone: len(zone.origin.labels), reverse=True)
+        self.queries = 0
+
+    @classmethod
+    def from_text(cls, *zones: Tuple[str, str]) -> "StubAuthority":
+        return cls([dns.zone.from_text(text, origin=origin, relativize=False) for origin, text in zones])
+
+    def _zone_for(self, qname: dns.name.Name) -> dns.zone.Zone | None:
+        return next((zone for zone in self.zones if qname.is_subdomain(zone.origin)), None)
+
+    def _add_glue(self, zone: dns.zone.Zone, response: dns.message.Message, targets: List[dns.name.Name]):
+        for target in targets:
+            if target.is_subdomain(zone.origin):
+                for rdtype in (RdataType.A, RdataType.AAAA):
+                    rdataset = zone.get_rdataset(target, rdtype)
+                    if rdataset:
+                        response.find_rrset(response.additional, target, rdataset.rdclass, rdtype, create=True).update(
+                            rdataset
+                        )
+
+    def answer(self, wire: bytes) -> bytes:
+        self.queries += 1
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        qname, rdtype = question.name, question.rdtype
+
+        zone = self._zone_for(qname)
+        if zone is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response.to_wire()
+
+        # A cut between the apex and the name means the answer lives in a child zone
+        for depth in range(len(zone.origin.labels) + 1, len(qname.labels) + 1):
+            cut = dns.name.Name(qname.labels[-depth:])
+            nameservers = zone.get_rdataset(cut, RdataType.NS)
+            if nameservers:
+                response.find_rrset(response.authority, cut, nameservers.rdclass, RdataType.NS, create=True).update(
+                    nameservers
+                )
+                self._add_glue(zone, response, [rdata.target for rdata in nameservers])
+                return response.to_wire()
+
+        response.flags |= dns.flags.AA
+        node = zone.get_node(qname)
+        if node is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        else:
+            for rdataset in node.rdatasets:
+                if rdataset.rdtype == rdtype or rdataset.rdtype == RdataType.CNAME:
+                    response.find_rrset(response.answer, qname, rdataset.rdclass, rdataset.rdtype, create=True).update(
+                        rdataset
+                    )
+        if not response.answer:
+            soa = zone.get_rdataset(zone.origin, RdataType.SOA)
+            response.find_rrset(response.authority, zone.origin, soa.rdclass, RdataType.SOA, create=True).update(soa)
+        return response.to_wire()
+
+
+class StubAuthorityProtocol(asyncio.DatagramProtocol):
+    def __init__(self, authority: StubAuthority):
+        self.authority = authority
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.transport.sendto(self.authority.answer(data), addr)
+
+
+async def serve_authority(authority: StubAuthority, host: str, port: int) -> asyncio.DatagramTransport:
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: StubAuthorityProtocol(authority), local_addr=(host, port)
+    )
+    logger.info("Stub authoritative server listening", extra={"host": host, "port": port})
+    return transport
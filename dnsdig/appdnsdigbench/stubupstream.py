@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import ipaddress
+import random
+import ssl
+import struct
+import tempfile
+import zlib
+from enum import Enum
+from pathlib import Path
+from typing import List, Tuple
+
+import dns.message
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from pydantic import BaseModel, Field
+
+from dnsdig.libshared.logging import logger
+
+
+class LatencyDistributions(str, Enum):
+    Fixed = "fixed"
+    Uniform = "uniform"
+    LogNormal = "lognormal"
+
+
+class StubUpstreamConfig(BaseModel):
+    latency_ms: float = 20.0
+    latency_jitter_ms: float = 5.0
+    latency_distribution: LatencyDistributions = LatencyDistributions.LogNormal
+    loss: float = 0.0
+    ttls: List[int] = Field(default_factory=lambda: [30, 300, 3600])
+    ttl_weights: List[float] | None = None
+    seed: int | None = 42
+
+
+class StubUpstream:
+    def __init__(self, config: StubUpstreamConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.queries = 0
+        self.dropped = 0
+
+    def delay(self) -> float:
+        config = self.config
+        match config.latency_distribution:
+            case LatencyDistributions.Fixed:
+                latency = config.latency_ms
+            case LatencyDistributions.Uniform:
+                latency = self.rng.uniform(
+                    config.latency_ms - config.latency_jitter_ms, config.latency_ms + config.latency_jitter_ms
+                )
+            case _:
+                # Median of latency_ms with a long right tail, like real upstreams
+                sigma = config.latency_jitter_ms / config.latency_ms if config.latency_ms else 0
+                latency = config.latency_ms * self.rng.lognormvariate(0, sigma)
+        return max(latency, 0) / 1000
+
+    def ttl_for(self, name: str) -> int:
+        # TTLs are stable per name so cache behaviour is reproducible between runs
+        rng = random.Random(zlib.crc32(name.encode()))
+        return rng.choices(self.config.ttls, weights=self.config.ttl_weights, k=1)[0]
+
+    def answer(self, wire: bytes) -> bytes | None:
+        self.queries += 1
+        if self.config.loss and self.rng.random() < self.config.loss:
+            self.dropped += 1
+            return None
+
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        name = question.name.to_text()
+        digest = zlib.crc32(name.encode())
+
+        match question.rdtype:
+            case dns.rdatatype.A:
+                rdata = str(ipaddress.IPv4Address(0x0A000000 | (digest & 0x00FFFFFF)))
+            case dns.rdatatype.AAAA:
+                rdata = str(ipaddress.IPv6Address((0xFD00 << 112) | digest))
+            case dns.rdatatype.MX:
+                rdata = f"10 mail.{name}"
+            case dns.rdatatype.TXT:
+                rdata = f'"dnsdig-bench {digest}"'
+            case _:
+                rdata = None
+
+        if rdata:
+            rrset = dns.rrset.from_text(question.name, self.ttl_for(name), dns.rdataclass.IN, question.rdtype, rdata)
+            response.answer.append(rrset)
+        return response.to_wire()
+
+
+class StubUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, upstream: StubUpstream):
+        self.upstream = upstream
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        wire = self.upstream.answer(data)
+        if wire is None:
+            return
+        asyncio.get_running_loop().call_later(self.upstream.delay(), self.transport.sendto, wire, addr)
+
+
+def self_signed_context(hostname: str = "localhost") -> ssl.SSLContext:
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname)]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+
+    directory = Path(tempfile.mkdtemp(prefix="dnsdig-bench-"))
+    cert_file, key_file = directory / "cert.pem", directory / "key.pem"
+    cert_file.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_file.write_bytes(
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    )
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+async def serve_udp(upstream: StubUpstream, host: str, port: int) -> asyncio.DatagramTransport:
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: StubUDPProtocol(upstream), local_addr=(host, port))
+    logger.info("Stub UDP upstream listening", extra={"host": host, "port": port})
+    return transport
+
+
+async def serve_tls(upstream: StubUpstream, host: str, port: int) -> asyncio.AbstractServer:
+    async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                wire = upstream.answer(await reader.readexactly(length))
+                if wire is None:
+                    # A lost answer on a stream looks like a stalled connection to the client
+                    continue
+                await asyncio.sleep(upstream.delay())
+                writer.write(struct.pack("!H", len(wire)) + wire)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(_handle, host=host, port=port, ssl=self_signed_context())
+    logger.info("Stub DoT upstream listening", extra={"host": host, "port": port})
+    return server
@@ -0,0 +1,55 @@
+import asyncio
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import REGISTRY, CONTENT_TYPE
+
+Route = Callable[[Dict[str, str]], Awaitable[Tuple[int, str, bytes]]]
+
+
+class AdminServer:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes: Dict[str, Route] = {"/metrics": self.metrics}
+        self.server: asyncio.AbstractServer | None = None
+
+    def add_route(self, path: str, route: Route):
+        self.routes[path] = route
+
+    @classmethod
+    async def metrics(cls, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        return 200, CONTENT_TYPE, REGISTRY.render().encode()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain headers, requests carry no body
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) < 2 or parts[0] != "GET":
+                status, content_type, body = 405, "text/plain", b"Method not allowed"
+            else:
+                url = urlsplit(parts[1])
+                route = self.routes.get(url.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if route:
+                    status, content_type, body = await route(query)
+                else:
+                    status, content_type, body = 404, "text/plain", b"Not found"
+
+            head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            writer.write(head.encode() + b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, host=self.host, port=self.port)
+        logger.info("Admin server listening", extra={"host": self.host, "port": self.port})
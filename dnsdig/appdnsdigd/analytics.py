@@ -1,16 +1,24 @@
 from __future__ import annotations
 
 import asyncio
+from datetime import datetime, timedelta
+from typing import Tuple
 
-from beanie import init_beanie
 from dns.rdatatype import RdataType
-from motor import motor_asyncio
 
+from dnsdig.appdnsdigd import metrics
 from dnsdig.appdnsdigd.settings import dnsdigd_settings
-from dnsdig.appdnsdigd.analyticsmongo import Analytics
+from dnsdig.libshared.logging import logger
+
+# Beanie and Motor are imported on first use, queued rows stay plain tuples until they are written
+Row = Tuple[datetime, str, RdataType, float, int]
 
 
 class DNSAnalytics:
+    def __init__(self):
+        self.queue: asyncio.Queue[Row] = asyncio.Queue(maxsize=dnsdigd_settings.analytics_queue_size)
+        metrics.analytics_queue_depth.set_function(self.queue.qsize)
+
     @classmethod
     async def create_instance(cls):
         instance = cls()
@@ -19,14 +27,75 @@ class DNSAnalytics:
 
     @classmethod
     async def init_beanie(cls):
+        from beanie import init_beanie
+        from motor import motor_asyncio
+
+        from dnsdig.appdnsdigd.analyticsmongo import Analytics, AnalyticsMinuteRollup, AnalyticsHourRollup
+
         client_options = {'appname': dnsdigd_settings.app_name}
         mongo_client = motor_asyncio.AsyncIOMotorClient(dnsdigd_settings.mongo_url, **client_options)
         mongo_client.get_io_loop = asyncio.get_running_loop
 
-        collections = [Analytics]
+        collections = [Analytics, AnalyticsMinuteRollup, AnalyticsHourRollup]
         await init_beanie(database=mongo_client[dnsdigd_settings.db_name], document_models=collections)
 
-    async def log_resolver(self, name: str, record_type: RdataType, resolve_time: float, ttl: int) -> Analytics:
-        row = Analytics(name=name, record_type=record_type, resolve_time=resolve_time, ttl=ttl)
-        await row.save()
-        return row
+    def log_resolver(self, name: str, record_type: RdataType, resolve_time: float, ttl: int):
+        try:
+            self.queue.put_nowait((datetime.utcnow(), name, record_type, resolve_time, ttl))
+        except asyncio.QueueFull:
+            metrics.analytics_dropped.inc()
+
+    async def write_forever(self):
+        from dnsdig.appdnsdigd.analyticsmongo import Analytics, AnalyticsMeta
+
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < dnsdigd_settings.analytics_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            rows = [
+                Analytics(
+                    created_at=created_at,
+                    meta=AnalyticsMeta(name=name, record_type=record_type),
+                    resolve_time=resolve_time,
+                    ttl=ttl,
+                )
+                for created_at, name, record_type, resolve_time, ttl in batch
+            ]
+            try:
+                await Analytics.insert_many(rows)
+            except Exception as exc:
+                logger.error("Failed to write analytics", extra={"rows": len(rows), "error": str(exc)})
+
+    @classmethod
+    async def catch_up(cls, until: datetime):
+        from dnsdig.appdnsdigd.analyticsmongo import Analytics, AnalyticsMinuteRollup
+
+        # Minutes missed while the daemon was down, or every imported row on a first start, an hour at a time
+        since = await AnalyticsMinuteRollup.newest() or await Analytics.oldest()
+        if since is None:
+            return
+        since = since.replace(minute=0, second=0, microsecond=0)
+        while since < until:
+            end = min(since + timedelta(hours=1), until)
+            await Analytics.rollup(since=since, until=end)
+            await AnalyticsMinuteRollup.rollup(since=since, until=end)
+            since = end
+
+    @classmethod
+    async def rollup_forever(cls, interval: int = 60):
+        from dnsdig.appdnsdigd.analyticsmongo import Analytics, AnalyticsMinuteRollup
+
+        caught_up = False
+        while True:
+            # Only complete minutes are rolled up, recent ones are redone to pick up late writes
+            until = datetime.utcnow().replace(second=0, microsecond=0)
+            hour = until.replace(minute=0)
+            try:
+                if not caught_up:
+                    await cls.catch_up(until)
+                    caught_up = True
+                await Analytics.rollup(since=until - timedelta(minutes=5), until=until)
+                await AnalyticsMinuteRollup.rollup(since=hour - timedelta(hours=1), until=until)
+            except Exception as exc:
+                logger.error("Failed to roll up analytics", extra={"error": str(exc)})
+            await asyncio.sleep(interval)
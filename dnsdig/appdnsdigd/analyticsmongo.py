@@ -1,24 +1,17 @@
+import math
 from datetime import datetime, timedelta
 from decimal import Decimal
 from enum import Enum
-from typing import List
+from typing import List, Dict, Any, Tuple
 
-from beanie import Document, ValidateOnSave, Update, before_event
+import pymongo
+from beanie import Document, TimeSeriesConfig, Granularity
 from dns.rdatatype import RdataType
 from humps import camelize
 from pydantic import BaseModel, Field, ConfigDict
+from pymongo import IndexModel
 
-
-class BaseDatetimeMeta(BaseModel):
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime | None = None
-    deleted_at: datetime | None = None
-
-
-class BaseMongoDocument(Document, BaseDatetimeMeta):
-    @before_event(ValidateOnSave, Update)
-    async def update_timestamps(self):
-        self.updated_at = datetime.utcnow()
+from dnsdig.appdnsdigd.settings import dnsdigd_settings
 
 
 class BaseRequestResponse(BaseModel):
@@ -40,6 +33,11 @@ class StatsTimeframes(int, Enum):
     Month1 = 30 * 24 * 60
 
 
+class RollupUnits(str, Enum):
+    Minute = "minute"
+    Hour = "hour"
+
+
 class AnalyticsResults(BaseRequestResponse):
     average: float
     median: float
@@ -48,38 +46,251 @@ class AnalyticsResults(BaseRequestResponse):
     percentiles: List[float]
 
 
-class Analytics(BaseMongoDocument):
+class LatencySketch:
+    # Log spaced bins in the style of DDSketch, any quantile is within 1% of the real value and
+    # the sketches of different minutes merge by adding up their bins, which percentiles do not
+    relative_accuracy = 0.01
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    min_value = 0.001
+
+    @classmethod
+    def index(cls, value: float) -> int:
+        return math.ceil(math.log(max(value, cls.min_value)) / math.log(cls.gamma))
+
+    @classmethod
+    def index_expression(cls, field: str) -> Dict[str, Any]:
+        return {"$ceil": {"$divide": [{"$ln": {"$max": [field, cls.min_value]}}, math.log(cls.gamma)]}}
+
+    @classmethod
+    def value(cls, index: int) -> float:
+        return 2 * cls.gamma**index / (cls.gamma + 1)
+
+    @classmethod
+    def quantiles(cls, bins: Dict[int, int], qs: List[float]) -> List[float]:
+        ranked = sorted(bins.items())
+        samples = sum(bins.values())
+        values = []
+        for q in qs:
+            rank, cumulative = q * (samples - 1), 0
+            for index, count in ranked:
+                cumulative += count
+                if cumulative > rank:
+                    values.append(cls.value(index))
+                    break
+        return values
+
+
+def unwind_sketch() -> Dict[str, Any]:
+    return {"$unwind": {"path": "$sketch", "includeArrayIndex": "position"}}
+
+
+def once_per_document(field: str) -> Dict[str, Any]:
+    # After unwinding the sketch, totals are only counted from the first bin of each document
+    return {"$cond": [{"$eq": ["$position", 0]}, field, 0]}
+
+
+class AnalyticsMeta(BaseModel):
     name: str
     record_type: RdataType
+
+
+class Analytics(Document):
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    meta: AnalyticsMeta
     resolve_time: float
     ttl: int
 
     @classmethod
-    async def statistics(cls, timeframe: StatsTimeframes) -> AnalyticsResults | None:
-        upper_bound = datetime.utcnow()
-        lower_bound = upper_bound - timedelta(minutes=timeframe.value)
-
+    async def rollup(cls, since: datetime, until: datetime):
+        # Raw measurements into per minute buckets, each with the sketch of its resolve times
         pipeline = [
-            {"$match": {"created_at": {"$gte": lower_bound, "$lte": upper_bound}}},
+            {"$match": {"created_at": {"$gte": since, "$lt": until}}},
             {
                 "$group": {
-                    "_id": None,
-                    "average": {"$avg": "$resolve_time"},
-                    "median": {"$median": {"input": "$resolve_time", "method": "approximate"}},
+                    "_id": {
+                        "bucket": {"$dateTrunc": {"date": "$created_at", "unit": RollupUnits.Minute.value}},
+                        "record_type": "$meta.record_type",
+                        "index": LatencySketch.index_expression("$resolve_time"),
+                    },
+                    "count": {"$sum": 1},
+                    "total": {"$sum": "$resolve_time"},
                     "minimum": {"$min": "$resolve_time"},
                     "maximum": {"$max": "$resolve_time"},
-                    "percentiles": {
-                        "$percentile": {"input": "$resolve_time", "p": [0.75, 0.99], "method": "approximate"}
-                    },
                 }
             },
-            {"$project": {"_id": False}},
+            *AnalyticsMinuteRollup.fold_stages(),
+        ]
+        await cls.aggregate(pipeline).to_list()
+
+    @classmethod
+    async def oldest(cls) -> datetime | None:
+        row = await cls.find_all().sort(+cls.created_at).first_or_none()
+        return row.created_at if row else None
+
+    @classmethod
+    async def top_names(cls, since: datetime, limit: int) -> List[Tuple[str, RdataType]]:
+        pipeline = [
+            {"$match": {"created_at": {"$gte": since}}},
+            {"$group": {"_id": {"name": "$meta.name", "record_type": "$meta.record_type"}, "queries": {"$sum": 1}}},
+            {"$sort": {"queries": pymongo.DESCENDING}},
+            {"$limit": limit},
         ]
-        result = await cls.aggregate(pipeline, projection_model=AnalyticsResults).to_list(1)
-        if len(result) == 0:
+        rows = await cls.aggregate(pipeline).to_list()
+        return [(row["_id"]["name"], RdataType(row["_id"]["record_type"])) for row in rows]
+
+    @classmethod
+    async def statistics(cls, timeframe: StatsTimeframes) -> AnalyticsResults | None:
+        rollup = AnalyticsMinuteRollup if timeframe.value <= StatsTimeframes.Day1.value else AnalyticsHourRollup
+        return await rollup.statistics(timeframe=timeframe)
+
+    class Settings:
+        name: str = "analytics-timeseries"
+        timeseries = TimeSeriesConfig(
+            time_field="created_at",
+            meta_field="meta",
+            granularity=Granularity.seconds,
+            expire_after_seconds=dnsdigd_settings.analytics_retention_days * 24 * 60 * 60,
+        )
+
+
+class SketchBin(BaseModel):
+    index: int
+    count: int
+
+
+class BaseAnalyticsRollup(Document):
+    bucket: datetime
+    record_type: RdataType
+    samples: int
+    total: float
+    minimum: float
+    maximum: float
+    sketch: List[SketchBin]
+
+    @classmethod
+    def merge_stage(cls) -> Dict[str, Any]:
+        return {
+            "$merge": {
+                "into": cls.Settings.name,
+                "on": ["bucket", "record_type"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        }
+
+    @classmethod
+    def fold_stages(cls) -> List[Dict[str, Any]]:
+        # Sketch bins grouped by bucket, record type and bin index are folded back into one document per bucket
+        return [
+            {
+                "$group": {
+                    "_id": {"bucket": "$_id.bucket", "record_type": "$_id.record_type"},
+                    "samples": {"$sum": "$count"},
+                    "total": {"$sum": "$total"},
+                    "minimum": {"$min": "$minimum"},
+                    "maximum": {"$max": "$maximum"},
+                    "sketch": {"$push": {"index": "$_id.index", "count": "$count"}},
+                }
+            },
+            {
+                "$project": {
+                    "_id": False,
+                    "bucket": "$_id.bucket",
+                    "record_type": "$_id.record_type",
+                    "samples": True,
+                    "total": True,
+                    "minimum": True,
+                    "maximum": True,
+                    "sketch": True,
+                }
+            },
+            cls.merge_stage(),
+        ]
+
+    @classmethod
+    async def newest(cls) -> datetime | None:
+        row = await cls.find_all().sort(-cls.bucket).first_or_none()
+        return row.bucket if row else None
+
+    @classmethod
+    async def statistics(cls, timeframe: StatsTimeframes) -> AnalyticsResults | None:
+        lower_bound = datetime.utcnow() - timedelta(minutes=timeframe.value)
+
+        # The sketches of every bucket are added up bin by bin, quantiles are read from the merged sketch
+        pipeline = [
+            {"$match": {"bucket": {"$gte": lower_bound}}},
+            unwind_sketch(),
+            {
+                "$group": {
+                    "_id": "$sketch.index",
+                    "count": {"$sum": "$sketch.count"},
+                    "total": {"$sum": once_per_document("$total")},
+                    "minimum": {"$min": "$minimum"},
+                    "maximum": {"$max": "$maximum"},
+                }
+            },
+        ]
+        rows = await cls.aggregate(pipeline).to_list()
+        if len(rows) == 0:
             return None
 
-        return result[0]
+        bins = {int(row["_id"]): row["count"] for row in rows}
+        minimum, maximum = min(row["minimum"] for row in rows), max(row["maximum"] for row in rows)
+        # Bin values are the middle of their bin, never report past the values actually seen
+        median, p75, p99 = [
+            min(max(value, minimum), maximum) for value in LatencySketch.quantiles(bins, [0.5, 0.75, 0.99])
+        ]
+        return AnalyticsResults(
+            average=sum(row["total"] for row in rows) / sum(bins.values()),
+            median=median,
+            minimum=minimum,
+            maximum=maximum,
+            percentiles=[p75, p99],
+        )
 
+
+class AnalyticsMinuteRollup(BaseAnalyticsRollup):
     class Settings:
-        name: str = "analytics"
+        name: str = "analytics-rollups-minute"
+        indexes: List[IndexModel] = [
+            IndexModel(
+                [("bucket", pymongo.ASCENDING), ("record_type", pymongo.ASCENDING)], unique=True, name="unique_buckets"
+            ),
+            IndexModel(
+                [("bucket", pymongo.ASCENDING)],
+                expireAfterSeconds=dnsdigd_settings.analytics_minute_rollup_retention_days * 24 * 60 * 60,
+                name="bucket_retention",
+            ),
+        ]
+
+    @classmethod
+    async def rollup(cls, since: datetime, until: datetime):
+        pipeline = [
+            {"$match": {"bucket": {"$gte": since, "$lt": until}}},
+            unwind_sketch(),
+            {
+                "$group": {
+                    "_id": {
+                        "bucket": {"$dateTrunc": {"date": "$bucket", "unit": RollupUnits.Hour.value}},
+                        "record_type": "$record_type",
+                        "index": "$sketch.index",
+                    },
+                    "count": {"$sum": "$sketch.count"},
+                    "total": {"$sum": once_per_document("$total")},
+                    "minimum": {"$min": "$minimum"},
+                    "maximum": {"$max": "$maximum"},
+                }
+            },
+            *AnalyticsHourRollup.fold_stages(),
+        ]
+        await cls.aggregate(pipeline).to_list()
+
+
+class AnalyticsHourRollup(BaseAnalyticsRollup):
+    class Settings:
+        name: str = "analytics-rollups-hour"
+        indexes: List[IndexModel] = [
+            IndexModel(
+                [("bucket", pymongo.ASCENDING), ("record_type", pymongo.ASCENDING)], unique=True, name="unique_buckets"
+            )
+        ]
@@ -0,0 +1,185 @@
+import asyncio
+import base64
+import gzip
+import os
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import redis.asyncio as redis
+import ujson
+
+from dnsdig.appdnsdigd.settings import dnsdigd_settings
+from dnsdig.libshared.logging import logger
+
+
+BLOCKLIST_PREFIX = "dnsdigd-blacklist#"
+
+
+def blocklist_key(host: str) -> str:
+    # The blocklist is split over many hashes so it spreads over every Redis node
+    return f"{BLOCKLIST_PREFIX}{zlib.crc32(host.encode()) % dnsdigd_settings.blocklist_buckets}"
+
+
+class NearCache:
+    def __init__(self, size: int = 10000, max_ttl: int = 60):
+        self.size = size
+        self.max_ttl = max_ttl
+        # key -> (value, expires_at), least recently used first
+        self.entries: OrderedDict[str, Tuple[bytes | str, float]] = OrderedDict()
+        self.hits: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> bytes | str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            self.delete(key)
+            return None
+        self.entries.move_to_end(key)
+        self.hits[key] = self.hits.get(key, 0) + 1
+        return value
+
+    def set(self, key: str, value: bytes | str, ttl: float, hits: int = 0):
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        self.entries[key] = (value, time.time() + ttl)
+        self.entries.move_to_end(key)
+        self.hits.setdefault(key, hits)
+        while len(self.entries) > self.size:
+            evicted, _ = self.entries.popitem(last=False)
+            self.hits.pop(evicted, None)
+
+    def delete(self, key: str):
+        self.entries.pop(key, None)
+        self.hits.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits.clear()
+
+    def hottest(self, n: int) -> List[str]:
+        return sorted(self.entries, key=lambda key: self.hits.get(key, 0), reverse=True)[:n]
+
+    def save(self, path: str | Path, limit: int):
+        now = time.time()
+        rows = []
+        for key in self.hottest(limit):
+            value, expires_at = self.entries[key]
+            if expires_at > now:
+                rows.append([key, base64.b64encode(value).decode(), expires_at, self.hits.get(key, 0)])
+
+        # Written next to the target and renamed so a crash never leaves a half written snapshot
+        path = Path(path)
+        temporary = path.with_suffix(path.suffix + ".tmp")
+        with gzip.open(temporary, "wt") as fp:
+            ujson.dump({"saved_at": now, "entries": rows}, fp)
+        os.replace(temporary, path)
+        logger.info("Saved cache snapshot", extra={"path": str(path), "entries": len(rows)})
+
+    def load(self, path: str | Path) -> int:
+        try:
+            with gzip.open(path, "rt") as fp:
+                snapshot = ujson.load(fp)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as exc:
+            logger.error("Failed to load cache snapshot", extra={"path": str(path), "error": str(exc)})
+            return 0
+
+        now = time.time()
+        loaded = 0
+        # Coldest first so the hottest entries end up most recently used
+        for key, value, expires_at, hits in reversed(snapshot["entries"]):
+            if expires_at > now:
+                self.set(key, base64.b64decode(value), expires_at - now, hits=hits)
+                loaded += 1
+        logger.info("Loaded cache snapshot", extra={"path": str(path), "entries": loaded})
+        return loaded
+
+
+class InvalidationTracker:
+    channel = "__redis__:invalidate"
+
+    def __init__(self, redis_url: str, prefixes: List[str], on_invalidate: Callable[[List[str] | None], None]):
+        self.redis_url = redis_url
+        self.prefixes = prefixes
+        self.on_invalidate = on_invalidate
+        self.active = False
+        self.established = asyncio.Event()
+        self.own_writes: Dict[str, int] = {}
+
+    def wrote(self, key: str):
+        # Our own writes are broadcast back to us too, the entry we just cached should survive them
+        if self.active:
+            self.own_writes[key] = self.own_writes.get(key, 0) + 1
+
+    def invalidate(self, keys: List[str] | None):
+        if keys is None:
+            self.on_invalidate(None)
+            return
+        stale = []
+        for key in keys:
+            pending = self.own_writes.pop(key, 0)
+            if pending > 1:
+                self.own_writes[key] = pending - 1
+            if not pending:
+                stale.append(key)
+        if stale:
+            self.on_invalidate(stale)
+
+    def reset(self):
+        # Invalidations may have been missed, nothing cached so far can be trusted
+        self.active = False
+        self.established.clear()
+        self.own_writes.clear()
+        self.on_invalidate(None)
+
+    async def run_once(self, health_interval: float):
+        subscriber = redis.from_url(self.redis_url, encoding="utf-8", decode_responses=True)
+        tracker = redis.from_url(self.redis_url, encoding="utf-8", decode_responses=True, single_connection_client=True)
+        pubsub = subscriber.pubsub()
+        try:
+            await pubsub.connect()
+            await pubsub.connection.send_command("CLIENT", "ID")
+            redirect = await pubsub.connection.read_response()
+            await pubsub.subscribe(self.channel)
+
+            # RESP2 has no push messages, BCAST tracking is redirected to the subscriber connection instead
+            prefixes = [arg for prefix in self.prefixes for arg in ("PREFIX", prefix)]
+            await tracker.execute_command("CLIENT", "TRACKING", "ON", "REDIRECT", redirect, "BCAST", *prefixes)
+            self.reset()
+            self.active = True
+            self.established.set()
+            logger.info("Tracking Redis invalidations", extra={"prefixes": self.prefixes})
+
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=health_interval)
+                if message:
+                    self.invalidate(message["data"])
+                    continue
+                # Either connection may have been silently reconnected, which ends tracking for good
+                info = await tracker.execute_command("CLIENT", "TRACKINGINFO")
+                flags = dict(zip(info[::2], info[1::2])).get("flags", [])
+                if "on" not in flags or "broken_redirect" in flags:
+                    raise ConnectionError("Tracking was interrupted")
+        finally:
+            await pubsub.close()
+            await subscriber.close()
+            await tracker.close()
+
+    async def run_forever(self, health_interval: float = 1.0, retry_interval: float = 1.0):
+        while True:
+            try:
+                await self.run_once(health_interval=health_interval)
+            except Exception as exc:
+                logger.error("Lost Redis invalidation tracking", extra={"error": repr(exc)})
+            self.reset()
+            await asyncio.sleep(retry_interval)
@@ -1,14 +1,20 @@
+import asyncio
+import signal
+
 import typer
 import uvloop
 
 from dnsdig.appdnsdigd.settings import dnsdigd_settings
 from dnsdig.appdnsdigd.udpserver import DNSDigUDPServer
+from dnsdig.libshared.logging import start_log_listener
 
 app = typer.Typer()
 
 
 async def serve_dns(host: str, port: int, use_adblocker: bool):
     server = DNSDigUDPServer(host=host, port=port, use_adblocker=use_adblocker)
+    # SIGTERM unwinds like Ctrl+C so shutdown hooks such as the cache snapshot still run
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
     await server.start()
 
 
@@ -19,6 +25,7 @@ def main(
     use_adblocker: bool = typer.Option(dnsdigd_settings.use_adblocker, allow_dash=True, help='Use adblocker'),
 ):
     typer.echo(f"DNSDig Daemon - {host}:{port} - {dnsdigd_settings.mongo_url} - {dnsdigd_settings.redis_url}")
+    start_log_listener()
     uvloop.run(serve_dns(host=host, port=port, use_adblocker=use_adblocker))
 
 
@@ -0,0 +1,331 @@
+import asyncio
+import random
+import ssl
+import struct
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+import dns.asyncquery
+import dns.exception
+import dns.message
+import dns.rdatatype
+import dns.rrset
+from dns.rdataclass import RdataClass
+from dns.rdatatype import RdataType
+
+from dnsdig.appdnsdigd import metrics
+from dnsdig.appdnsdigd.cache import NearCache, InvalidationTracker, BLOCKLIST_PREFIX, blocklist_key
+from dnsdig.appdnsdigd.settings import dnsdigd_settings
+from dnsdig.appdnsdigd.spans import QuerySpans
+from dnsdig.appdnsdigd.zones import ZoneTable
+from dnsdig.libdns.domains.iterative import IterativeResolver
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.redisring import ShardedRedis
+
+# Near cache values are the expiry of the answer followed by its wire format
+EXPIRES_AT = struct.Struct("<d")
+EXPIRES_PREFIX = ";expires="
+
+
+def age_response(response: dns.message.Message, expires_at: float) -> dns.message.Message:
+    # A cached answer is served with the TTL it has left, not the one it had when it was cached
+    remaining = max(0, int(expires_at - time.time()))
+    for rrset in response.answer + response.authority + response.additional:
+        rrset.ttl = min(rrset.ttl, remaining)
+    return response
+
+
+def encode_cached(response: dns.message.Message, expires_at: float) -> str:
+    # Stored as text with the expiry as a leading comment, dns.message.from_text skips it
+    return f"{EXPIRES_PREFIX}{expires_at}\n{response.to_text()}"
+
+
+def decode_cached(cached: str) -> Tuple[dns.message.Message, float | None]:
+    response = dns.message.from_text(cached)
+    if cached.startswith(EXPIRES_PREFIX):
+        expires_at = float(cached[len(EXPIRES_PREFIX) : cached.index("\n")])
+        return age_response(response, expires_at), expires_at
+    return response, None
+
+
+class DNSEngine:
+    def __init__(self, use_cache: bool = True, use_adblocker: bool = False):
+        self.use_adblocker = use_adblocker
+
+        # Caching
+        self.use_cache = use_cache
+        self.redis_client: ShardedRedis | None = None
+        if self.use_cache:
+            self.redis_client = ShardedRedis(
+                urls=dnsdigd_settings.redis_nodes,
+                vnodes=dnsdigd_settings.redis_ring_vnodes,
+                eject_failures=dnsdigd_settings.redis_eject_failures,
+                eject_seconds=dnsdigd_settings.redis_eject_seconds,
+                # Read from another node a blocklist bucket is empty, blocked hosts would resolve while a node is out
+                pinned_prefixes=(BLOCKLIST_PREFIX,),
+            )
+
+        self.near_cache = NearCache(size=dnsdigd_settings.near_cache_size, max_ttl=dnsdigd_settings.near_cache_max_ttl)
+        self.blocklist_cache = NearCache(
+            size=dnsdigd_settings.near_cache_size, max_ttl=dnsdigd_settings.near_cache_max_ttl
+        )
+        metrics.near_cache_entries.set_function(self.near_cache.__len__)
+        # Every Redis node broadcasts invalidations for the keys it owns
+        self.trackers: Dict[str, InvalidationTracker] = {}
+        if self.use_cache and dnsdigd_settings.near_cache_tracking:
+            self.trackers = {
+                url: InvalidationTracker(
+                    redis_url=url,
+                    prefixes=["dnsdigd-cache#", "dnsdigd-blacklist"],
+                    on_invalidate=self.invalidate_near_cache,
+                )
+                for url in dnsdigd_settings.redis_nodes
+            }
+        # Cache key -> wire format of the response being resolved, concurrent misses wait for it
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+        # Resolvers
+        self.resolvers = dnsdigd_settings.upstreams
+        self.zone_table = ZoneTable.load(dnsdigd_settings.local_zone_files, dnsdigd_settings.forward_zones)
+        self.iterative: IterativeResolver | None = None
+        if dnsdigd_settings.upstream_protocol == "iterative":
+            self.iterative = IterativeResolver(
+                root_hints=dnsdigd_settings.root_hints, port=dnsdigd_settings.upstream_port or 53
+            )
+        self.ssl_context: ssl.SSLContext | None = None
+        if not dnsdigd_settings.upstream_tls_verify:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    @property
+    def resolver(self) -> str:
+        if self.iterative:
+            return "iterative"
+        return random.choice(self.resolvers)
+
+    async def query_upstream(
+        self, message: dns.message.Message, nameserver: str, forwarded: bool = False
+    ) -> dns.message.Message:
+        timeout = dnsdigd_settings.upstream_timeout
+        port = dnsdigd_settings.upstream_port
+        if forwarded:
+            # Internal upstreams speak plain DNS, written as address or address@port
+            where, _, forward_port = nameserver.partition("@")
+            response, _ = await dns.asyncquery.udp_with_fallback(
+                message, where=where, port=int(forward_port or 53), timeout=timeout
+            )
+            return response
+        if self.iterative:
+            return await self.iterative.resolve_message(message)
+        if dnsdigd_settings.upstream_protocol == "udp":
+            return await dns.asyncquery.udp(message, where=nameserver, port=port or 53, timeout=timeout)
+        return await dns.asyncquery.tls(
+            message, where=nameserver, port=port or 853, timeout=timeout, ssl_context=self.ssl_context
+        )
+
+    async def resolve(self, message: dns.message.Message, spans: QuerySpans | None = None) -> dns.message.Message:
+        spans = spans or QuerySpans()
+        name = message.question[0].name
+        rtype = message.question[0].rdtype
+
+        # Local zones are answered from memory, before the blocklist and the caches
+        zone = self.zone_table.local_zone(name)
+        if zone:
+            response = zone.answer(message)
+            metrics.local_answers.inc()
+            spans.mark("local")
+            return response
+
+        # Ad blocker interceptor
+        if rtype == RdataType.A and self.use_adblocker:
+            host = str(name)[:-1]
+            blackholed = self.blocklist_cache.get(host)
+            if blackholed is None:
+                blackholed = await self.redis_client.hget(blocklist_key(host), host) or ""
+                self.blocklist_cache.set(host, blackholed, ttl=dnsdigd_settings.near_cache_max_ttl)
+            spans.mark("blocklist")
+            if blackholed:
+                metrics.blocklist_hits.inc()
+                logger.info("Blackholed", extra={"qname": name})
+                rrset = dns.rrset.from_text_list(
+                    name=name, ttl=86400, rdclass=RdataClass.IN, rdtype=RdataType.A, text_rdatas=[blackholed]
+                )
+                message.answer.append(rrset)
+                return message
+
+        ns = f"dnsdigd-cache#{name}#{rtype}"
+        near = self.near_cache.get(ns)
+        if near:
+            try:
+                response = dns.message.from_wire(near[EXPIRES_AT.size :])
+            except dns.exception.DNSException:
+                # Entries from a snapshot saved before answers carried their expiry
+                self.near_cache.delete(ns)
+            else:
+                metrics.cache_requests.inc("l1", "hit")
+                spans.mark("near_cache_get")
+                return age_response(response, *EXPIRES_AT.unpack_from(near))
+        metrics.cache_requests.inc("l1", "miss")
+
+        # Identical queries that miss together share one Redis lookup and one upstream query
+        pending = self.inflight.get(ns)
+        if pending:
+            metrics.coalesced_queries.inc()
+            try:
+                wire = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                return await self.resolve(message, spans)
+            spans.mark("coalesced")
+            return dns.message.from_wire(wire)
+
+        pending = self.inflight[ns] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self.resolve_uncached(message, ns, spans)
+        except Exception as exc:
+            pending.set_exception(exc)
+            # Retrieved here so a miss nobody else waited for does not warn about it
+            pending.exception()
+            raise
+        else:
+            pending.set_result(response.to_wire())
+        finally:
+            # A cancelled query still releases the queries waiting for it, they resolve on their own
+            if not pending.done():
+                pending.cancel()
+            del self.inflight[ns]
+        return response
+
+    async def resolve_uncached(self, message: dns.message.Message, ns: str, spans: QuerySpans) -> dns.message.Message:
+        name = message.question[0].name
+        rtype = message.question[0].rdtype
+
+        cached = await self.redis_client.get(ns)
+        spans.mark("cache_get")
+        if cached:
+            metrics.cache_requests.inc("l2", "hit")
+            logger.info("Cache hit", extra={"qname": name, "qtype": dns.rdatatype.to_text(rtype)})
+            try:
+                response, expires_at = decode_cached(cached)
+                spans.mark("cache_decode")
+                if len(response.answer) > 0:
+                    expires_at = expires_at or time.time() + response.answer[0].ttl
+                    ttl = expires_at - time.time()
+                    self.near_cache.set(ns, EXPIRES_AT.pack(expires_at) + response.to_wire(), ttl=ttl)
+                return response
+            except dns.message.UnknownHeaderField:
+                logger.error(
+                    "Failed to parse cached response", extra={"qname": name, "qtype": dns.rdatatype.to_text(rtype)}
+                )
+        else:
+            metrics.cache_requests.inc("l2", "miss")
+
+        group = self.zone_table.route(name)
+        nameserver = group.nameserver if group else self.resolver
+        try:
+            response = await self.query_upstream(message, nameserver=nameserver, forwarded=group is not None)
+        except Exception:
+            metrics.upstream_errors.inc(nameserver)
+            raise
+        finally:
+            spans.mark("upstream")
+        metrics.upstream_rtt.observe(spans.stages["upstream"] / 1e9, nameserver)
+
+        if len(response.answer) > 0:
+            ttl = response.answer[0].ttl
+            if not ttl:
+                return response
+            expires_at = time.time() + ttl
+            if self.trackers:
+                self.trackers[self.redis_client.node_for(ns).url].wrote(ns)
+            await self.redis_client.set(ns, encode_cached(response, expires_at), ex=ttl)
+            self.near_cache.set(ns, EXPIRES_AT.pack(expires_at) + response.to_wire(), ttl=ttl)
+            spans.mark("cache_set")
+        return response
+
+    def invalidate_near_cache(self, keys: List[str] | None):
+        if keys is None:
+            self.near_cache.clear()
+            self.blocklist_cache.clear()
+            return
+        for key in keys:
+            # The blocklist is a single hash, any change to it drops every cached lookup
+            if key.startswith("dnsdigd-blacklist"):
+                self.blocklist_cache.clear()
+            else:
+                self.near_cache.delete(key)
+
+    async def reload_zones(self):
+        try:
+            zone_table = await asyncio.to_thread(
+                ZoneTable.load, dnsdigd_settings.local_zone_files, dnsdigd_settings.forward_zones
+            )
+        except Exception as exc:
+            logger.error("Failed to reload zones, keeping the current ones", extra={"error": repr(exc)})
+            return
+        # Queries see either the old or the new table, never a mix of both
+        self.zone_table = zone_table
+        logger.info("Reloaded zones")
+
+    async def start_tracking(self) -> List[asyncio.Task]:
+        tasks = [asyncio.create_task(tracker.run_forever()) for tracker in self.trackers.values()]
+        if tasks:
+            established = [tracker.established.wait() for tracker in self.trackers.values()]
+            try:
+                await asyncio.wait_for(asyncio.gather(*established), timeout=5)
+            except asyncio.TimeoutError:
+                logger.warning("Redis invalidation tracking is not established yet")
+        return tasks
+
+    async def close(self):
+        if self.redis_client is not None:
+            await self.redis_client.close()
+
+    def save_cache_snapshot(self):
+        if not dnsdigd_settings.cache_snapshot_path:
+            return
+        try:
+            self.near_cache.save(dnsdigd_settings.cache_snapshot_path, limit=dnsdigd_settings.cache_snapshot_size)
+        except OSError as exc:
+            logger.error("Failed to save cache snapshot", extra={"error": str(exc)})
+
+    async def snapshot_cache_forever(self):
+        while True:
+            await asyncio.sleep(dnsdigd_settings.cache_snapshot_interval)
+            self.save_cache_snapshot()
+
+    async def warm_up(self):
+        if dnsdigd_settings.cache_snapshot_path:
+            self.near_cache.load(dnsdigd_settings.cache_snapshot_path)
+        if not dnsdigd_settings.warmup_names:
+            return
+
+        from dnsdig.appdnsdigd.analyticsmongo import Analytics
+
+        since = datetime.utcnow() - timedelta(hours=dnsdigd_settings.warmup_history_hours)
+        try:
+            names = await Analytics.top_names(since=since, limit=dnsdigd_settings.warmup_names)
+        except Exception as exc:
+            logger.error("Failed to load names to warm up", extra={"error": str(exc)})
+            return
+
+        semaphore = asyncio.Semaphore(dnsdigd_settings.warmup_concurrency)
+
+        async def _resolve(name: str, rtype: RdataType):
+            if self.near_cache.get(f"dnsdigd-cache#{name}#{rtype}"):
+                return
+            async with semaphore:
+                try:
+                    await self.resolve(dns.message.make_query(name, rtype))
+                except Exception as exc:
+                    logger.warning("Failed to warm up", extra={"qname": name, "error": repr(exc)})
+
+        started = datetime.utcnow()
+        await asyncio.gather(*[_resolve(name, rtype) for name, rtype in names])
+        logger.info(
+            "Warmed up cache",
+            extra={"names": len(names), "entries": len(self.near_cache), "elapsed": str(datetime.utcnow() - started)},
+        )
@@ -0,0 +1,25 @@
+from dnsdig.libshared.metrics import Counter, Gauge, Histogram
+
+queries = Counter("dnsdigd_queries", "DNS queries answered", ["qtype", "rcode"])
+query_duration = Histogram("dnsdigd_query_duration_seconds", "Time from receiving a query to sending its response")
+query_stage_duration = Histogram(
+    "dnsdigd_query_stage_duration_seconds",
+    "Time spent per stage of the query path",
+    ["stage"],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+)
+cache_requests = Counter("dnsdigd_cache_requests", "Cache lookups by tier and result", ["tier", "result"])
+near_cache_entries = Gauge("dnsdigd_near_cache_entries", "Entries held in the in-process cache")
+local_answers = Counter("dnsdigd_local_answers", "Queries answered from local zones")
+blocklist_hits = Counter("dnsdigd_blocklist_hits", "Queries answered by the adblocker")
+coalesced_queries = Counter("dnsdigd_coalesced_queries", "Cache misses that waited on an identical query in flight")
+upstream_rtt = Histogram("dnsdigd_upstream_rtt_seconds", "Round trip time to upstream resolvers", ["nameserver"])
+upstream_errors = Counter("dnsdigd_upstream_errors", "Failed queries to upstream resolvers", ["nameserver"])
+inflight_queries = Gauge("dnsdigd_inflight_queries", "Queries currently being handled")
+analytics_queue_depth = Gauge("dnsdigd_analytics_queue_depth", "Analytics rows waiting to be written")
+analytics_dropped = Counter("dnsdigd_analytics_dropped", "Analytics rows dropped because the queue was full")
+event_loop_lag = Histogram(
+    "dnsdigd_event_loop_lag_seconds",
+    "Delay between a scheduled wake up of the event loop and the actual wake up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
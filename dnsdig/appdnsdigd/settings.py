@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import socket
 from functools import lru_cache
+from typing import Dict, List
 
+from pydantic import Field
 from pydantic_settings import BaseSettings
 
 
@@ -12,8 +15,59 @@ class DNSDigdSettings(BaseSettings):
     host: str = "127.0.0.1"
     mongo_url: str | None = "mongodb://localhost:27017"
     redis_url: str | None = "redis://localhost:6379"
+    redis_urls: List[str] = []
+    redis_ring_vnodes: int = 160
+    redis_eject_failures: int = 3
+    redis_eject_seconds: float = 10.0
+    blocklist_buckets: int = 64
     use_adblocker: bool = False
 
+    # Upstreams
+    upstreams: List[str] = ['8.8.8.8', '8.8.4.4', '1.1.1.1', '1.0.0.1']
+    upstream_protocol: str = "tls"
+    upstream_port: int | None = None
+    upstream_timeout: float = 5.0
+    upstream_tls_verify: bool = True
+    root_hints: Dict[str, str] | None = None
+
+    # Local zones and conditional forwarding
+    local_zone_files: List[str] = []
+    forward_zones: Dict[str, List[str]] = {}
+
+    # Near cache
+    near_cache_size: int = 10000
+    near_cache_max_ttl: int = 60
+    near_cache_tracking: bool = False
+    cache_snapshot_path: str | None = None
+    cache_snapshot_interval: float = 300.0
+    cache_snapshot_size: int = 5000
+    warmup_names: int = 200
+    warmup_history_hours: int = 24
+    warmup_concurrency: int = 20
+
+    # Observability
+    admin_host: str = "127.0.0.1"
+    admin_port: int | None = 9153
+    analytics_queue_size: int = 10000
+    analytics_batch_size: int = 500
+    analytics_retention_days: int = 30
+    analytics_minute_rollup_retention_days: int = 90
+    slow_query_threshold_ms: float | None = None
+    slow_query_sample_rate: float = 1.0
+    slow_query_buffer_size: int = 256
+
+    # Heavy hitters
+    sketch_bucket_seconds: int = 60
+    sketch_buckets: int = 60
+    sketch_capacity: int = 64
+    sketch_width: int = 1024
+    sketch_snapshot_interval: float = 30.0
+    sketch_worker_id: str = Field(default_factory=socket.gethostname)
+
+    @property
+    def redis_nodes(self) -> List[str]:
+        return self.redis_urls or [self.redis_url]
+
     @classmethod
     @lru_cache()
     def get_settings(cls) -> DNSDigdSettings:
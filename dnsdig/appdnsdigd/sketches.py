@@ -0,0 +1,244 @@
+import heapq
+import time
+import zlib
+from array import array
+from enum import Enum
+from typing import Dict, List, Tuple, Any, Iterable, Set
+
+# Second level labels under country code TLDs that are sold like TLDs, e.g. example.co.uk
+_SECOND_LEVELS = {"co", "com", "net", "org", "gov", "edu", "ac", "or", "ne", "go"}
+
+
+class SketchDimensions(str, Enum):
+    QName = "qname"
+    Domain = "domain"
+    Client = "client"
+    QType = "qtype"
+
+
+def registrable_domain(qname: str) -> str:
+    # Approximation without the public suffix list, good enough to group subdomains together
+    labels = qname.rstrip(".").lower().split(".")
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 1024, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("q", bytes(8 * width)) for _ in range(depth)]
+
+    def _indexes(self, key: str) -> Iterable[Tuple[array, int]]:
+        # crc32 is stable across processes unlike hash(), so sketches from different workers line up
+        data = key.encode()
+        for seed, row in enumerate(self.rows):
+            yield row, zlib.crc32(data, seed) % self.width
+
+    def add(self, key: str, count: int = 1) -> int:
+        estimate = None
+        for row, index in self._indexes(key):
+            row[index] += count
+            estimate = row[index] if estimate is None else min(estimate, row[index])
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[index] for row, index in self._indexes(key))
+
+    def merge(self, other: "CountMinSketch"):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("Count-Min sketches must have the same dimensions to merge")
+        for row, other_row in zip(self.rows, other.rows):
+            for index, value in enumerate(other_row):
+                if value:
+                    row[index] += value
+
+    def dump(self) -> Dict[str, Any]:
+        return {"width": self.width, "depth": self.depth, "rows": [row.tolist() for row in self.rows]}
+
+    @classmethod
+    def load(cls, data: Dict[str, Any]) -> "CountMinSketch":
+        sketch = cls(width=data["width"], depth=data["depth"])
+        sketch.rows = [array("q", row) for row in data["rows"]]
+        return sketch
+
+
+class SpaceSaving:
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        # One entry per key holding its count when pushed, counts only grow so an entry is never above the real count
+        self.heap: List[Tuple[int, str]] = []
+
+    def _reindex(self):
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def _pop_min(self) -> str:
+        while True:
+            count, key = self.heap[0]
+            if count == self.counts[key]:
+                heapq.heappop(self.heap)
+                return key
+            heapq.heapreplace(self.heap, (self.counts[key], key))
+
+    def add(self, key: str, count: int = 1):
+        if key in self.counts:
+            self.counts[key] += count
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (count, key))
+            return
+
+        # The newcomer inherits the evicted minimum as its possible overcount
+        evicted = self._pop_min()
+        floor = self.counts.pop(evicted)
+        del self.errors[evicted]
+        self.counts[key] = floor + count
+        self.errors[key] = floor
+        heapq.heappush(self.heap, (floor + count, key))
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [(key, count, self.errors[key]) for key, count in ranked]
+
+    def floor(self) -> int:
+        # A key missing from a full summary may still have been seen, at most as often as its smallest entry
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other: "SpaceSaving"):
+        floor, other_floor = self.floor(), other.floor()
+        for key in self.counts.keys() - other.counts.keys():
+            self.counts[key] += other_floor
+            self.errors[key] += other_floor
+        for key, count in other.counts.items():
+            missing = 0 if key in self.counts else floor
+            self.counts[key] = self.counts.get(key, missing) + count
+            self.errors[key] = self.errors.get(key, missing) + other.errors[key]
+        if len(self.counts) > self.capacity:
+            keep = sorted(self.counts, key=self.counts.__getitem__, reverse=True)[: self.capacity]
+            self.counts = {key: self.counts[key] for key in keep}
+            self.errors = {key: self.errors[key] for key in keep}
+        self._reindex()
+
+    def dump(self) -> Dict[str, Any]:
+        return {"capacity": self.capacity, "counts": self.counts, "errors": self.errors}
+
+    @classmethod
+    def load(cls, data: Dict[str, Any]) -> "SpaceSaving":
+        summary = cls(capacity=data["capacity"])
+        summary.counts = dict(data["counts"])
+        summary.errors = dict(data["errors"])
+        summary._reindex()
+        return summary
+
+
+class HeavyHitters:
+    def __init__(self, capacity: int = 64, width: int = 1024, depth: int = 4):
+        self.total = 0
+        self.sketch = CountMinSketch(width=width, depth=depth)
+        self.summary = SpaceSaving(capacity=capacity)
+
+    def add(self, key: str, count: int = 1):
+        self.total += count
+        self.sketch.add(key, count)
+        self.summary.add(key, count)
+
+    def top(self, n: int) -> List[Dict[str, Any]]:
+        # Space-Saving picks the candidates, Count-Min gives the tighter upper bound
+        return [
+            {"key": key, "count": min(count, self.sketch.estimate(key)), "error": error}
+            for key, count, error in self.summary.top(n)
+        ]
+
+    def merge(self, other: "HeavyHitters"):
+        self.total += other.total
+        self.sketch.merge(other.sketch)
+        self.summary.merge(other.summary)
+
+    def dump(self) -> Dict[str, Any]:
+        return {"total": self.total, "sketch": self.sketch.dump(), "summary": self.summary.dump()}
+
+    @classmethod
+    def load(cls, data: Dict[str, Any]) -> "HeavyHitters":
+        hitters = cls()
+        hitters.total = data["total"]
+        hitters.sketch = CountMinSketch.load(data["sketch"])
+        hitters.summary = SpaceSaving.load(data["summary"])
+        return hitters
+
+
+class TrafficSketches:
+    def __init__(self, worker: str, bucket_seconds: int = 60, buckets: int = 60, capacity: int = 64, width: int = 1024):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.capacity = capacity
+        self.width = width
+        # Snapshots are stored under the worker id, it has to survive restarts for a worker to find its own
+        self.worker = worker
+        self.windows: Dict[int, Dict[str, HeavyHitters]] = {}
+        self.dirty: Set[int] = set()
+
+    def bucket_for(self, at: float | None = None) -> int:
+        at = time.time() if at is None else at
+        return int(at // self.bucket_seconds) * self.bucket_seconds
+
+    def _new_bucket(self) -> Dict[str, HeavyHitters]:
+        return {
+            dimension.value: HeavyHitters(capacity=self.capacity, width=self.width) for dimension in SketchDimensions
+        }
+
+    def record(self, qname: str, qtype: str, client: str, at: float | None = None):
+        bucket = self.bucket_for(at)
+        window = self.windows.get(bucket)
+        if window is None:
+            window = self.windows[bucket] = self._new_bucket()
+            self.expire(bucket)
+        self.dirty.add(bucket)
+
+        window[SketchDimensions.QName.value].add(qname)
+        window[SketchDimensions.Domain.value].add(registrable_domain(qname))
+        window[SketchDimensions.Client.value].add(client)
+        window[SketchDimensions.QType.value].add(qtype)
+
+    def expire(self, current: int):
+        oldest = current - (self.buckets - 1) * self.bucket_seconds
+        for bucket in [bucket for bucket in self.windows if bucket < oldest]:
+            del self.windows[bucket]
+            self.dirty.discard(bucket)
+
+    def window_buckets(self, window_seconds: int) -> List[int]:
+        current = self.bucket_for()
+        return list(range(current - window_seconds + self.bucket_seconds, current + 1, self.bucket_seconds))
+
+    def merged(
+        self, dimension: SketchDimensions, window_seconds: int, extra: Iterable[Dict[str, HeavyHitters]] = ()
+    ) -> HeavyHitters:
+        merged = HeavyHitters(capacity=self.capacity, width=self.width)
+        for bucket in self.window_buckets(window_seconds):
+            if bucket in self.windows:
+                merged.merge(self.windows[bucket][dimension.value])
+        for window in extra:
+            merged.merge(window[dimension.value])
+        return merged
+
+    def top(self, dimension: SketchDimensions, n: int = 10, window_seconds: int = 300) -> List[Dict[str, Any]]:
+        return self.merged(dimension, window_seconds).top(n)
+
+    def dump_bucket(self, bucket: int) -> Dict[str, Any]:
+        return {dimension: hitters.dump() for dimension, hitters in self.windows[bucket].items()}
+
+    def restore_bucket(self, bucket: int, data: Dict[str, Any]):
+        window = self.load_bucket(data)
+        if bucket in self.windows:
+            for dimension, hitters in window.items():
+                hitters.merge(self.windows[bucket][dimension])
+        self.windows[bucket] = window
+
+    @classmethod
+    def load_bucket(cls, data: Dict[str, Any]) -> Dict[str, HeavyHitters]:
+        return {dimension: HeavyHitters.load(hitters) for dimension, hitters in data.items()}
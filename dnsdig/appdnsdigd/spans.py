@@ -0,0 +1,55 @@
+import random
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Any
+
+from dnsdig.appdnsdigd import metrics
+
+
+class QuerySpans:
+    __slots__ = ("started", "last", "stages")
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter_ns()
+        self.stages: Dict[str, int] = {}
+
+    def mark(self, stage: str):
+        # Everything since the previous mark is attributed to this stage
+        now = time.perf_counter_ns()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.last
+        self.last = now
+
+    @property
+    def elapsed_ns(self) -> int:
+        return self.last - self.started
+
+    def record(self):
+        for stage, duration in self.stages.items():
+            metrics.query_stage_duration.observe(duration / 1e9, stage)
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: float | None, sample_rate: float = 1.0, size: int = 256):
+        self.threshold_ns = threshold_ms * 1e6 if threshold_ms is not None else None
+        self.sample_rate = sample_rate
+        self.entries: deque[Dict[str, Any]] = deque(maxlen=size)
+
+    def maybe_record(self, spans: QuerySpans, qname: str, qtype: str, rcode: str):
+        if self.threshold_ns is None or spans.elapsed_ns < self.threshold_ns:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        self.entries.append(
+            {
+                "at": datetime.utcnow().isoformat(),
+                "qname": qname,
+                "qtype": qtype,
+                "rcode": rcode,
+                "elapsed_ms": spans.elapsed_ns / 1e6,
+                "stages_ms": {stage: duration / 1e6 for stage, duration in spans.stages.items()},
+            }
+        )
+
+    def dump(self) -> List[Dict[str, Any]]:
+        return list(self.entries)
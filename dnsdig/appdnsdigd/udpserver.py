@@ -1,20 +1,25 @@
 import asyncio
-import random
-import time
+import logging
+import signal
+from typing import Dict, Set, Tuple, TYPE_CHECKING
 
 import asyncudp
 import dns.message
-import redis.asyncio as redis
-from asyncer import asyncify
-from dns.rdataclass import RdataClass
-from dns.rdatatype import RdataType
-from rich.console import Console
-from rich.table import Table
+import dns.rcode
+import dns.rdatatype
+import ujson
 
+from dnsdig.appdnsdigd import metrics
+from dnsdig.appdnsdigd.adminserver import AdminServer
 from dnsdig.appdnsdigd.analytics import DNSAnalytics
-from dnsdig.appdnsdigd.analyticsmongo import Analytics, StatsTimeframes, AnalyticsResults
+from dnsdig.appdnsdigd.engine import DNSEngine
 from dnsdig.appdnsdigd.settings import dnsdigd_settings
-from dnsdig.libshared.logging import logger
+from dnsdig.appdnsdigd.sketches import TrafficSketches, SketchDimensions
+from dnsdig.appdnsdigd.spans import QuerySpans, SlowQueryLog
+from dnsdig.libshared.logging import logger, set_request_id
+
+if TYPE_CHECKING:
+    from dnsdig.appdnsdigd.analyticsmongo import StatsTimeframes, AnalyticsResults
 
 
 class DNSDigUDPServer:
@@ -29,26 +34,32 @@ class DNSDigUDPServer:
         self.host = host
         self.port = port
         self.socket = socket
-        self.use_adblocker = use_adblocker
-
-        # Caching
-        self.use_cache = use_cache
-        self.redis_client: redis.Redis | None = None
-        if self.use_cache:
-            self.redis_client = redis.from_url(dnsdigd_settings.redis_url, encoding="utf-8", decode_responses=True)
+        # Caching, coalescing and upstreams are shared with the DoH endpoints of the API
+        self.engine = DNSEngine(use_cache=use_cache, use_adblocker=use_adblocker)
+        self.ready = False
 
         # Analytics
         self.analytics: DNSAnalytics | None = None
-
-        # Resolvers
-        self.resolvers = ['8.8.8.8', '8.8.4.4', '1.1.1.1', '1.0.0.1']
-
-    @property
-    def resolver(self) -> str:
-        return random.choice(self.resolvers)
+        self.admin_server: AdminServer | None = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.slow_queries = SlowQueryLog(
+            threshold_ms=dnsdigd_settings.slow_query_threshold_ms,
+            sample_rate=dnsdigd_settings.slow_query_sample_rate,
+            size=dnsdigd_settings.slow_query_buffer_size,
+        )
+        self.sketches = TrafficSketches(
+            worker=dnsdigd_settings.sketch_worker_id,
+            bucket_seconds=dnsdigd_settings.sketch_bucket_seconds,
+            buckets=dnsdigd_settings.sketch_buckets,
+            capacity=dnsdigd_settings.sketch_capacity,
+            width=dnsdigd_settings.sketch_width,
+        )
 
     @classmethod
-    def render_stats_table(cls, stats: AnalyticsResults, timeframe: StatsTimeframes):
+    def render_stats_table(cls, stats: "AnalyticsResults", timeframe: "StatsTimeframes"):
+        from rich.console import Console
+        from rich.table import Table
+
         print("\n")
         table = Table(
             "Average",
@@ -76,83 +87,191 @@ class DNSDigUDPServer:
 
     @classmethod
     async def output_stats(cls):
+        from dnsdig.appdnsdigd.analyticsmongo import Analytics, StatsTimeframes
+
         while True:
             stats = await Analytics.statistics(timeframe=StatsTimeframes.Minutes60)
             if stats:
                 cls.render_stats_table(stats=stats, timeframe=StatsTimeframes.Minutes60)
             await asyncio.sleep(60)
 
-    async def query_dns_tls(self, message: dns.message.Message) -> dns.message.Message:
-        name = message.question[0].name
-        rtype = message.question[0].rdtype
-
-        # Ad blocker interceptor
-        if rtype == RdataType.A and self.use_adblocker:
-            ns = "dnsdigd-blacklist"
-            blackholed = await self.redis_client.hget(ns, str(name)[:-1])
-            if blackholed:
-                logger.info("Blackholed")
-                rrset = dns.rrset.from_text_list(
-                    name=name, ttl=86400, rdclass=RdataClass.IN, rdtype=RdataType.A, text_rdatas=[blackholed]
-                )
-                message.answer.append(rrset)
-                return message
+    async def handle_query(self, wire: bytes, addr: Tuple[str, int]):
+        spans = QuerySpans()
 
-        ns = f"dnsdigd-cache#{name}#{rtype}"
-        cached = await self.redis_client.get(ns)
-        if cached:
-            logger.info(f"Cache hit for {name} {rtype}")
-            try:
-                return dns.message.from_text(cached)
-            except dns.message.UnknownHeaderField:
-                logger.error(f"Failed to parse cached response for {name} {rtype}")
-
-        response = await dns.asyncquery.tls(message, where=self.resolver)
-        if len(response.answer) > 0:
-            ttl = response.answer[0].ttl
-            if not ttl:
-                return response
-            await self.redis_client.set(ns, response.to_text(), ex=ttl)
-        return response
+        data = dns.message.from_wire(wire)
+        question = data.question[0]
+        set_request_id(data.id)
+        spans.mark("parse")
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Received query",
+                extra={"client": addr[0], "qname": question.name, "qtype": dns.rdatatype.to_text(question.rdtype)},
+            )
+        spans.mark("log")
+        try:
+            dns_response = await self.engine.resolve(data, spans=spans)
+        except Exception as exc:
+            logger.error("Failed to resolve query", extra={"qname": question.name, "error": repr(exc)})
+            dns_response = dns.message.make_response(data)
+            dns_response.set_rcode(dns.rcode.SERVFAIL)
+
+        dns_response.id = data.id
+        response_wire = dns_response.to_wire()
+        spans.mark("serialize")
+
+        self.socket.sendto(response_wire, addr)
+        spans.mark("send")
+
+        delta = spans.elapsed_ns / 1e6
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Sent response", extra={"qname": question.name, "elapsed_ms": round(delta, 2)})
+
+        qtype, rcode = dns.rdatatype.to_text(question.rdtype), dns.rcode.to_text(dns_response.rcode())
+        metrics.queries.inc(qtype, rcode)
+        self.sketches.record(qname=str(question.name), qtype=qtype, client=addr[0])
+        metrics.query_duration.observe(delta / 1000)
+        spans.record()
+        self.slow_queries.maybe_record(spans, qname=str(question.name), qtype=qtype, rcode=rcode)
+
+        if len(dns_response.answer) > 0:
+            self.analytics.log_resolver(
+                name=str(question.name), record_type=question.rdtype, resolve_time=delta, ttl=dns_response.answer[0].ttl
+            )
+
+    async def _handle_query(self, wire: bytes, addr: Tuple[str, int]):
+        metrics.inflight_queries.inc()
+        try:
+            await self.handle_query(wire, addr)
+        except Exception as exc:
+            logger.error("Failed to handle query", extra={"client": addr[0], "error": repr(exc)})
+        finally:
+            metrics.inflight_queries.dec()
 
     async def run_forever(self):
         while True:
             data, addr = await self.socket.recvfrom()
+            # Queries are handled concurrently, keep a reference so pending tasks are not garbage collected
+            task = asyncio.create_task(self._handle_query(data, addr))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
 
-            start_time = time.time()
+    async def slow_queries_route(self, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        return 200, "application/json", ujson.dumps(self.slow_queries.dump()).encode()
 
-            data = dns.message.from_wire(data)
+    async def topn_route(self, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        try:
+            dimension = SketchDimensions(query.get("dimension", SketchDimensions.QName.value))
+            n = int(query.get("n", 10))
+            window = int(query.get("window", 300))
+        except ValueError as exc:
+            return 400, "text/plain", str(exc).encode()
 
-            logger.info(f"[{data.id}] Received query from {addr} for {data.question[0].name} {data.question[0].rdtype}")
-            dns_response = await self.query_dns_tls(data)
+        # scope=cluster merges in snapshots from every worker, including earlier runs of this one
+        extra = []
+        if query.get("scope") == "cluster" and self.engine.redis_client:
+            buckets = self.sketches.window_buckets(window)
+            commands = [(f"dnsdigd-sketches#{bucket}", "hgetall", ()) for bucket in buckets]
+            for bucket, snapshots in zip(buckets, await self.engine.redis_client.execute_many(commands)):
+                for worker, snapshot in snapshots.items():
+                    if worker != self.sketches.worker or bucket not in self.sketches.windows:
+                        extra.append(TrafficSketches.load_bucket(ujson.loads(snapshot)))
 
-            end_time = time.time()
-            delta = (end_time - start_time) * 1000
-            logger.info(f"[{data.id}] Query took {int(delta)} ms")
+        hitters = self.sketches.merged(dimension, window_seconds=window, extra=extra)
+        body = {"dimension": dimension.value, "window": window, "total": hitters.total, "top": hitters.top(n)}
+        return 200, "application/json", ujson.dumps(body).encode()
 
-            dns_response.id = data.id
+    async def restore_sketches(self):
+        window = self.sketches.buckets * self.sketches.bucket_seconds
+        buckets = self.sketches.window_buckets(window)
+        commands = [(f"dnsdigd-sketches#{bucket}", "hget", (self.sketches.worker,)) for bucket in buckets]
+        for bucket, snapshot in zip(buckets, await self.engine.redis_client.execute_many(commands)):
+            if snapshot:
+                self.sketches.restore_bucket(bucket, ujson.loads(snapshot))
+
+    async def snapshot_sketches_forever(self):
+        ttl = self.sketches.buckets * self.sketches.bucket_seconds
+        while True:
+            await asyncio.sleep(dnsdigd_settings.sketch_snapshot_interval)
+            dirty, self.sketches.dirty = self.sketches.dirty, set()
+            commands = []
+            for bucket in dirty:
+                if bucket in self.sketches.windows:
+                    ns = f"dnsdigd-sketches#{bucket}"
+                    snapshot = ujson.dumps(self.sketches.dump_bucket(bucket))
+                    commands += [(ns, "hset", (self.sketches.worker, snapshot)), (ns, "expire", (ttl,))]
+            try:
+                await self.engine.redis_client.execute_many(commands)
+            except Exception as exc:
+                self.sketches.dirty |= dirty
+                logger.error("Failed to snapshot sketches", extra={"error": str(exc)})
 
-            logger.info(f"[{data.id}] Sending response for {data.question[0].name} {data.question[0].rdtype}")
-            await asyncify(self.socket.sendto)(dns_response.to_wire(), addr)
+    def schedule_reload_zones(self):
+        task = asyncio.create_task(self.engine.reload_zones())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-            if len(dns_response.answer) > 0:
-                await self.analytics.log_resolver(
-                    name=str(data.question[0].name),
-                    record_type=data.question[0].rdtype,
-                    resolve_time=delta,
-                    ttl=dns_response.answer[0].ttl,
-                )
+    async def ready_route(self, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        if self.ready:
+            return 200, "text/plain", b"Ready"
+        return 503, "text/plain", b"Warming up"
+
+    @classmethod
+    async def measure_loop_lag(cls, interval: float = 0.5):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(interval)
+            metrics.event_loop_lag.observe(max(loop.time() - scheduled - interval, 0))
 
     async def start(self):
         if not self.socket:
             try:
                 self.socket = await asyncudp.create_socket(local_addr=(self.host, self.port))
             except OSError:
-                logger.error(f"Failed to bind to {self.host}:{self.port} - Address and port already in use")
+                logger.error(
+                    "Failed to bind - Address and port already in use", extra={"host": self.host, "port": self.port}
+                )
                 return
 
         # Init analytics
         self.analytics = await DNSAnalytics.create_instance()
 
+        # Zone files are re-read on SIGHUP
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.schedule_reload_zones)
+
+        # Heavy hitters survive restarts through their snapshots
+        tasks = []
+        if self.engine.redis_client:
+            await self.restore_sketches()
+            tasks.append(self.snapshot_sketches_forever())
+
+        # Metrics endpoint
+        if dnsdigd_settings.admin_port:
+            self.admin_server = AdminServer(host=dnsdigd_settings.admin_host, port=dnsdigd_settings.admin_port)
+            self.admin_server.add_route("/debug/slow-queries", self.slow_queries_route)
+            self.admin_server.add_route("/topn", self.topn_route)
+            self.admin_server.add_route("/ready", self.ready_route)
+            await self.admin_server.start()
+
+        # Tracking starts first, anything cached before it is established gets dropped
+        tasks += await self.engine.start_tracking()
+
+        # Queries wait in the socket buffer until the hottest names are cached again
+        await self.engine.warm_up()
+        self.ready = True
+        if dnsdigd_settings.cache_snapshot_path:
+            tasks.append(self.engine.snapshot_cache_forever())
+
         # Start server
-        await asyncio.gather(self.run_forever(), DNSDigUDPServer.output_stats())
+        try:
+            await asyncio.gather(
+                self.run_forever(),
+                self.analytics.write_forever(),
+                DNSAnalytics.rollup_forever(),
+                DNSDigUDPServer.output_stats(),
+                DNSDigUDPServer.measure_loop_lag(),
+                *tasks,
+            )
+        finally:
+            self.engine.save_cache_snapshot()
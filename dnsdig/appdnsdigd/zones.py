@@ -0,0 +1,132 @@
+import random
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rrset
+import dns.zone
+from dns.rdatatype import RdataType
+from pydantic import BaseModel
+
+from dnsdig.libshared.logging import logger
+
+
+class SuffixTrie:
+    class Node:
+        __slots__ = ("children", "value")
+
+        def __init__(self):
+            self.children: Dict[bytes, "SuffixTrie.Node"] = {}
+            self.value: Any = None
+
+    def __init__(self):
+        self.root = SuffixTrie.Node()
+
+    @classmethod
+    def _labels(cls, name: dns.name.Name) -> Tuple[bytes, ...]:
+        # Walked from the TLD down, the empty root label is skipped
+        return tuple(label.lower() for label in reversed(name.labels) if label)
+
+    def insert(self, name: dns.name.Name, value: Any):
+        node = self.root
+        for label in self._labels(name):
+            node = node.children.setdefault(label, SuffixTrie.Node())
+        node.value = value
+
+    def longest_match(self, name: dns.name.Name) -> Any:
+        node, match = self.root, self.root.value
+        for label in self._labels(name):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.value is not None:
+                match = node.value
+        return match
+
+
+class UpstreamGroup(BaseModel):
+    suffix: str
+    nameservers: List[str]
+
+    @property
+    def nameserver(self) -> str:
+        return random.choice(self.nameservers)
+
+
+class LocalZone:
+    def __init__(self, zone: dns.zone.Zone):
+        self.origin = zone.origin
+        soa = zone.get_rdataset(zone.origin, RdataType.SOA)
+        self.soa = dns.rrset.from_rdata_list(zone.origin, soa.ttl, list(soa))
+        # Every answer is built once at load time, a lookup is a single dict access
+        self.rrsets: Dict[Tuple[dns.name.Name, RdataType], dns.rrset.RRset] = {}
+        self.names = set()
+        for name, node in zone.nodes.items():
+            name = name.derelativize(zone.origin)
+            # Ancestors up to the origin exist too even without records, they answer NODATA not NXDOMAIN (RFC 8020)
+            ancestor = name
+            while ancestor not in self.names and ancestor.is_subdomain(self.origin):
+                self.names.add(ancestor)
+                if ancestor == self.origin:
+                    break
+                ancestor = ancestor.parent()
+            for rdataset in node.rdatasets:
+                self.rrsets[(name, rdataset.rdtype)] = dns.rrset.from_rdata_list(name, rdataset.ttl, list(rdataset))
+
+    def answer(self, message: dns.message.Message) -> dns.message.Message:
+        question = message.question[0]
+        response = dns.message.make_response(message)
+        response.flags |= dns.flags.AA | dns.flags.RA
+
+        name, rdtype = question.name, question.rdtype
+        # Follow CNAMEs as long as they stay inside this zone
+        for _ in range(8):
+            rrset = self.rrsets.get((name, rdtype))
+            if rrset is not None:
+                response.answer.append(rrset)
+                return response
+            cname = self.rrsets.get((name, RdataType.CNAME))
+            if cname is None:
+                break
+            response.answer.append(cname)
+            name = cname[0].target
+            if not name.is_subdomain(self.origin):
+                return response
+
+        if not response.answer and name not in self.names:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        response.authority.append(self.soa)
+        return response
+
+
+class ZoneTable:
+    def __init__(self, zones: List[LocalZone], groups: List[UpstreamGroup]):
+        self.zones = SuffixTrie()
+        for zone in zones:
+            self.zones.insert(zone.origin, zone)
+        self.routes = SuffixTrie()
+        for group in groups:
+            self.routes.insert(dns.name.from_text(group.suffix), group)
+
+    def local_zone(self, name: dns.name.Name) -> LocalZone | None:
+        return self.zones.longest_match(name)
+
+    def route(self, name: dns.name.Name) -> UpstreamGroup | None:
+        return self.routes.longest_match(name)
+
+    @classmethod
+    def load(cls, zone_files: List[str], forward_zones: Dict[str, List[str]]) -> "ZoneTable":
+        zones = []
+        for zone_file in zone_files:
+            # Files without $ORIGIN are named after their zone, e.g. corp.internal.zone
+            origin = Path(zone_file).name.removesuffix(".zone")
+            zone = dns.zone.from_file(zone_file, origin=origin, relativize=False)
+            zones.append(LocalZone(zone))
+            logger.info("Loaded local zone", extra={"zone": zone.origin, "file": zone_file})
+        groups = [
+            UpstreamGroup(suffix=suffix, nameservers=nameservers) for suffix, nameservers in forward_zones.items()
+        ]
+        return cls(zones, groups)
@@ -1,6 +1,5 @@
 import urllib.parse
-from datetime import datetime, timedelta
-from functools import lru_cache
+from datetime import datetime
 from secrets import token_hex
 from typing import List
 
@@ -8,6 +7,7 @@ import aiohttp
 import jwt
 import ujson
 from fastapi import HTTPException
+from functional import seq
 
 from dnsdig.libaccount.constants import TokenTypes, TokenLifetimes
 from dnsdig.libaccount.models.auth import (
@@ -20,9 +20,16 @@ from dnsdig.libaccount.models.auth import (
     RefreshTokenExchangeRequest,
 )
 from dnsdig.libaccount.models.mongo import User, OAuthSession, UserApplication, Token
-from dnsdig.libaccount.models.responses import LoginUrlResponse, AccessTokenResponse, UserApplicationResponse
+from dnsdig.libaccount.models.responses import (
+    LoginUrlResponse,
+    AccessTokenResponse,
+    UserApplicationResponse,
+    RevokeTokensResponse,
+)
 from dnsdig.libshared.context import Context
+from dnsdig.libshared.models import after_commit, mongo_session
 from dnsdig.libshared.monq import monq_find_one
+from dnsdig.libshared.principals import principal_cache
 from dnsdig.libshared.settings import settings
 
 
@@ -47,7 +54,7 @@ class Account:
             last_name=last_name,
             avatar=avatar,
         )
-        await user.save()
+        await user.save(session=await mongo_session())
         return user
 
     @classmethod
@@ -55,7 +62,7 @@ class Account:
         state = token_hex(32) if not payload.state else payload.state
 
         session = OAuthSession(state=state, store=payload.store)
-        await session.save()
+        await session.save(session=await mongo_session())
 
         query_params = {
             "client_id": settings.auth_provider_client_id,
@@ -68,11 +75,6 @@ class Account:
         url = f"{settings.auth_provider_host}/oauth2/auth?{encoded}"
         return LoginUrlResponse(login_url=url)
 
-    @classmethod
-    @lru_cache()
-    def get_jwks_client(cls) -> jwt.PyJWKClient:
-        return jwt.PyJWKClient(settings.auth_jwks_url)
-
     @classmethod
     async def maybe_create_user(cls, id_token: str):
         payload = jwt.decode(id_token, options={"verify_signature": False})
@@ -91,7 +93,7 @@ class Account:
         user = await monq_find_one(model=User, query=query, project_to=User)
         if user and user.auth_provider_user_id != auth_provider_user_id:
             user.auth_provider_user_id.append(auth_provider_user_id)
-            await user.save()
+            await user.save(session=await mongo_session())
             return
 
         await cls.create_user(
@@ -117,7 +119,7 @@ class Account:
 
             # Mark session as deleted
             oauth_session.deleted_at = datetime.utcnow()
-            await oauth_session.save()
+            await oauth_session.save(session=await mongo_session())
 
         data = {
             "client_id": settings.auth_provider_client_id,
@@ -165,7 +167,7 @@ class Account:
             deleted_at=None,
         )
         context.current_user.applications.append(application)
-        await context.current_user.save()
+        await context.current_user.save(session=await mongo_session())
 
         return UserApplicationResponse(**application.model_dump())
 
@@ -173,6 +175,27 @@ class Account:
     async def list_applications(cls, context: Context) -> List[UserApplicationResponse]:
         return [UserApplicationResponse(**app.model_dump()) for app in context.current_user.applications]
 
+    @classmethod
+    async def revoke_application_tokens(cls, client_id: str, context: Context) -> RevokeTokensResponse:
+        if context.access_token and context.access_token.startswith("m2m"):
+            raise HTTPException(status_code=403, detail="You cannot revoke tokens using an M2M token")
+
+        app = seq(context.current_user.applications).find(lambda app: app.client_id == client_id)
+        if not app:
+            raise HTTPException(status_code=404, detail="Unknown Client ID")
+
+        revoked = await Token.revoke_tokens(owner_id=app.client_id)
+        user_id = str(context.current_user.id)
+        await after_commit(lambda: principal_cache.publish(user_id))
+        return RevokeTokensResponse(client_id=app.client_id, revoked=revoked)
+
+    @classmethod
+    async def issue_m2m_tokens(cls, client_id: str, access_token: str, refresh_token: str, now: datetime):
+        await Token.issue(access_token, TokenTypes.M2M, client_id, TokenLifetimes.M2M.value, now)
+        await Token.issue(
+            refresh_token, TokenTypes.M2MRefreshToken, client_id, TokenLifetimes.M2MRefreshToken.value, now
+        )
+
     @classmethod
     async def m2m_client_credentials_exchange(cls, payload: ClientCredentialsRequest) -> AccessTokenResponse:
         if payload.grant_type != "client_credentials":
@@ -189,20 +212,7 @@ class Account:
         _refresh_token = f"{app.client_id}-{token_hex(55)}"
 
         now = datetime.utcnow()
-        access_token = Token(
-            token=_access_token,
-            token_type=TokenTypes.M2M,
-            expires_at=now + timedelta(seconds=TokenLifetimes.M2M.value),
-            owner_id=app.client_id,
-        )
-        await access_token.save()
-        refresh_token = Token(
-            token=_refresh_token,
-            token_type=TokenTypes.M2MRefreshToken,
-            expires_at=now + timedelta(seconds=TokenLifetimes.M2MRefreshToken.value),
-            owner_id=app.client_id,
-        )
-        await refresh_token.save()
+        await cls.issue_m2m_tokens(app.client_id, _access_token, _refresh_token, now)
 
         return AccessTokenResponse(
             access_token=_access_token,
@@ -219,7 +229,8 @@ class Account:
 
         now = datetime.utcnow()
 
-        refresh_token = await Token.get_token(token=payload.refresh_token, token_type=TokenTypes.M2MRefreshToken)
+        # Refresh tokens are single use, claimed and deleted atomically so concurrent exchanges cannot both succeed
+        refresh_token = await Token.take_token(token=payload.refresh_token, token_type=TokenTypes.M2MRefreshToken)
         if not refresh_token:
             raise HTTPException(status_code=400, detail="Invalid refresh token")
 
@@ -233,24 +244,11 @@ class Account:
         _access_token = f"{app.client_id}-{token_hex(55)}-{token_hex(72)}"
         _refresh_token = f"{app.client_id}-{token_hex(55)}"
 
-        access_token = Token(
-            token=_access_token,
-            token_type=TokenTypes.M2M,
-            expires_at=now + timedelta(seconds=TokenLifetimes.M2M.value),
-            owner_id=app.client_id,
-        )
-        await access_token.save()
-        refresh_token = Token(
-            token=_refresh_token,
-            token_type=TokenTypes.M2MRefreshToken,
-            expires_at=now + timedelta(seconds=TokenLifetimes.M2MRefreshToken.value),
-            owner_id=app.client_id,
-        )
-        await refresh_token.save()
+        await cls.issue_m2m_tokens(app.client_id, _access_token, _refresh_token, now)
 
         return AccessTokenResponse(
-            access_token=access_token.token,
-            refresh_token=refresh_token.token,
+            access_token=_access_token,
+            refresh_token=_refresh_token,
             expires_in=TokenLifetimes.M2M.value,
             scope=" ".join([perm.value for perm in app.permissions]),
             token_type="bearer",
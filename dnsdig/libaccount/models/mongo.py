@@ -1,18 +1,19 @@
 from __future__ import annotations
 
-from datetime import datetime
+import hashlib
+from datetime import datetime, timedelta
 from typing import List, Dict, Any
 
 import pymongo
-from beanie import PydanticObjectId
+from beanie import PydanticObjectId, after_event, Save, Replace, SaveChanges, Update, Delete
 from functional import seq
 from pydantic import EmailStr, Field, HttpUrl, BaseModel
 from pymongo import IndexModel
 
 from dnsdig.libaccount.constants import TokenTypes
 from dnsdig.libaccount.models.auth import Permissions, Roles
-from dnsdig.libshared.models import BaseMongoDocument
-from dnsdig.libshared.monq import monq_find_one
+from dnsdig.libshared.models import BaseMongoDocument, after_commit, mongo_session
+from dnsdig.libshared.monq import monq_find_one, monq_delete_many, monq_find_one_and_delete
 
 
 class UserApplication(BaseModel):
@@ -53,6 +54,15 @@ class User(BaseMongoDocument):
         query = {"applications.client_id": client_id}
         return await monq_find_one(model=cls, query=query, project_to=cls)
 
+    @after_event(Save, Replace, SaveChanges, Update, Delete)
+    async def invalidate_principals(self):
+        # Blocking a user or changing their applications must reach every API worker's principal cache,
+        # once it is committed so no worker caches the user as it was before
+        from dnsdig.libshared.principals import principal_cache
+
+        user_id = str(self.id)
+        await after_commit(lambda: principal_cache.publish(user_id))
+
     class Settings:
         name: str = "users"
         indexes: List[IndexModel] = [
@@ -73,15 +83,50 @@ class OAuthSession(BaseMongoDocument):
 
 
 class Token(BaseMongoDocument):
-    token: str
+    # Only a digest of the token is stored, a leaked collection cannot be replayed
+    token_hash: str
     token_type: TokenTypes
     expires_at: datetime
     owner_id: str
 
+    @classmethod
+    def hash_token(cls, token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @classmethod
+    async def issue(cls, token: str, token_type: TokenTypes, owner_id: str, lifetime: int, now: datetime) -> Token:
+        instance = cls(
+            token_hash=cls.hash_token(token),
+            token_type=token_type,
+            expires_at=now + timedelta(seconds=lifetime),
+            owner_id=owner_id,
+        )
+        await instance.save(session=await mongo_session())
+        return instance
+
     @classmethod
     async def get_token(cls, token: str, token_type: TokenTypes) -> Token | None:
-        query = {"token": token, "token_type": token_type}
+        query = {"token_hash": cls.hash_token(token), "token_type": token_type}
         return await monq_find_one(model=cls, query=query, project_to=cls)
 
+    @classmethod
+    async def take_token(cls, token: str, token_type: TokenTypes) -> Token | None:
+        # Finding and deleting in one operation, of two concurrent callers only one gets the token
+        where = {"token_hash": cls.hash_token(token), "token_type": token_type}
+        return await monq_find_one_and_delete(model=cls, where=where, project_to=cls, session=await mongo_session())
+
+    @classmethod
+    async def revoke_tokens(cls, owner_id: str, token_type: TokenTypes | None = None) -> int:
+        where = {"owner_id": owner_id}
+        if token_type:
+            where["token_type"] = token_type
+        return await monq_delete_many(model=cls, where=where, session=await mongo_session())
+
     class Settings:
         name: str = "tokens"
+        indexes: List[IndexModel] = [
+            # Sparse so documents from before hashing do not collide on a missing hash until they expire
+            IndexModel([("token_hash", pymongo.ASCENDING)], unique=True, sparse=True, name="unique_token_hashes"),
+            IndexModel([("owner_id", pymongo.ASCENDING)], name="token_owners"),
+            IndexModel([("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0, name="token_expiry"),
+        ]
@@ -27,3 +27,8 @@ class UserApplicationResponse(BaseRequestResponse):
     website: str | None = None
 
     created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class RevokeTokensResponse(BaseRequestResponse):
+    client_id: str
+    revoked: int
@@ -0,0 +1,268 @@
+import asyncio
+import random
+import time
+from typing import Dict, List, Set, Tuple
+
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+from dns.rdatatype import RdataType
+
+from dnsdig.libdns.constants import ROOT_HINTS
+from dnsdig.libshared.logging import logger
+
+
+class IterationError(dns.exception.DNSException):
+    pass
+
+
+class Delegation:
+    __slots__ = ("zone", "nameservers", "addresses", "expires_at")
+
+    def __init__(
+        self,
+        zone: dns.name.Name,
+        nameservers: List[dns.name.Name],
+        addresses: Dict[dns.name.Name, List[str]],
+        expires_at: float | None = None,
+    ):
+        self.zone = zone
+        self.nameservers = nameservers
+        self.addresses = addresses
+        self.expires_at = expires_at
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and self.expires_at <= time.monotonic()
+
+    @property
+    def servers(self) -> List[str]:
+        return [address for addresses in self.addresses.values() for address in addresses]
+
+
+class DelegationCache:
+    def __init__(self, root: Delegation, size: int = 10000):
+        self.root = root
+        self.size = size
+        self.entries: Dict[dns.name.Name, Delegation] = {}
+
+    def add(self, delegation: Delegation):
+        self.entries.pop(delegation.zone, None)
+        self.entries[delegation.zone] = delegation
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
+
+    def closest(self, name: dns.name.Name) -> Delegation:
+        while name != dns.name.root:
+            delegation = self.entries.get(name)
+            if delegation and delegation.expired:
+                del self.entries[name]
+            elif delegation and delegation.servers:
+                return delegation
+            name = name.parent()
+        return self.root
+
+
+class ServerStats:
+    def __init__(self, decay: float = 0.7):
+        self.decay = decay
+        self.srtt: Dict[str, float] = {}
+
+    def order(self, servers: List[str]) -> List[str]:
+        # Untried servers sort first with a little jitter so every server gets measured once
+        return sorted(servers, key=lambda server: self.srtt.get(server, random.uniform(0, 0.001)))
+
+    def observe(self, server: str, rtt: float):
+        previous = self.srtt.get(server)
+        self.srtt[server] = rtt if previous is None else self.decay * previous + (1 - self.decay) * rtt
+
+    def penalize(self, server: str, timeout: float):
+        self.srtt[server] = max(self.srtt.get(server, 0) * 2, timeout)
+
+
+class IterativeResolver:
+    def __init__(
+        self,
+        root_hints: Dict[str, str] | None = None,
+        port: int = 53,
+        timeout: float = 1.5,
+        max_referrals: int = 30,
+        max_cnames: int = 8,
+        max_depth: int = 4,
+        use_ipv6: bool = False,
+    ):
+        hints = root_hints or ROOT_HINTS
+        root = Delegation(
+            zone=dns.name.root,
+            nameservers=[dns.name.from_text(name) for name in hints],
+            addresses={dns.name.from_text(name): [address] for name, address in hints.items()},
+        )
+        self.delegations = DelegationCache(root)
+        self.stats = ServerStats()
+        self.port = port
+        self.timeout = timeout
+        self.max_referrals = max_referrals
+        self.max_cnames = max_cnames
+        self.max_depth = max_depth
+        self.glue_types = [RdataType.A, RdataType.AAAA] if use_ipv6 else [RdataType.A]
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def _query_server(self, server: str, qname: dns.name.Name, rdtype: RdataType) -> dns.message.Message:
+        query = dns.message.make_query(qname, rdtype)
+        query.flags &= ~dns.flags.RD
+        started = time.perf_counter()
+        try:
+            response, _ = await dns.asyncquery.udp_with_fallback(query, server, timeout=self.timeout, port=self.port)
+        except (dns.exception.Timeout, OSError, dns.exception.DNSException):
+            self.stats.penalize(server, self.timeout)
+            raise
+        self.stats.observe(server, time.perf_counter() - started)
+        return response
+
+    async def _query_zone(self, delegation: Delegation, qname: dns.name.Name, rdtype: RdataType) -> dns.message.Message:
+        for server in self.stats.order(delegation.servers):
+            try:
+                response = await self._query_server(server, qname, rdtype)
+            except dns.exception.DNSException as exc:
+                logger.debug("Authoritative server failed", extra={"server": server, "error": repr(exc)})
+                continue
+            except OSError as exc:
+                logger.debug("Authoritative server unreachable", extra={"server": server, "error": repr(exc)})
+                continue
+            # Lame or broken servers are skipped in favour of the next one
+            if response.rcode() in (dns.rcode.SERVFAIL, dns.rcode.REFUSED, dns.rcode.NOTIMP):
+                self.stats.penalize(server, self.timeout)
+                continue
+            return response
+        raise IterationError(f"No authoritative server of {delegation.zone} answered for {qname}")
+
+    def _referral(self, response: dns.message.Message, zone: dns.name.Name, qname: dns.name.Name) -> Delegation | None:
+        for rrset in response.authority:
+            if rrset.rdtype != RdataType.NS or rrset.name == zone:
+                continue
+            # Only accept a delegation to a child of the zone we asked, anything else could poison the cache
+            if not (qname.is_subdomain(rrset.name) and rrset.name.is_subdomain(zone)):
+                continue
+            nameservers = [rdata.target for rdata in rrset]
+            addresses: Dict[dns.name.Name, List[str]] = {}
+            for glue in response.additional:
+                if glue.rdtype in self.glue_types and glue.name in nameservers and glue.name.is_subdomain(zone):
+                    addresses.setdefault(glue.name, []).extend(rdata.address for rdata in glue)
+            return Delegation(rrset.name, nameservers, addresses, expires_at=time.monotonic() + rrset.ttl)
+        return None
+
+    async def _glue(self, delegation: Delegation, depth: int):
+        async def _addresses(nameserver: dns.name.Name) -> Tuple[dns.name.Name, List[str]]:
+            addresses = []
+            try:
+                response = await self.resolve(nameserver, RdataType.A, depth=depth + 1)
+            except dns.exception.DNSException:
+                return nameserver, addresses
+            for rrset in response.answer:
+                if rrset.rdtype == RdataType.A:
+                    addresses.extend(rdata.address for rdata in rrset)
+            return nameserver, addresses
+
+        # Nameserver addresses are looked up in parallel, the first one found unblocks the referral
+        pending = {asyncio.ensure_future(_addresses(nameserver)) for nameserver in delegation.nameservers}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                nameserver, addresses = task.result()
+                if addresses:
+                    delegation.addresses[nameserver] = addresses
+            if delegation.servers:
+                break
+
+        def _collect(task: asyncio.Task):
+            self.tasks.discard(task)
+            if task.cancelled() or task.exception():
+                return
+            nameserver, addresses = task.result()
+            if addresses:
+                delegation.addresses[nameserver] = addresses
+
+        for task in pending:
+            self.tasks.add(task)
+            task.add_done_callback(_collect)
+
+    async def _resolve_name(
+        self, qname: dns.name.Name, rdtype: RdataType, depth: int
+    ) -> Tuple[dns.message.Message, dns.name.Name]:
+        delegation = self.delegations.closest(qname)
+        for _ in range(self.max_referrals):
+            response = await self._query_zone(delegation, qname, rdtype)
+            if response.rcode() != dns.rcode.NOERROR or response.answer:
+                return response, delegation.zone
+
+            referral = self._referral(response, delegation.zone, qname)
+            if referral is None:
+                # No data for this type, the SOA in the authority section says for how long
+                return response, delegation.zone
+            if not referral.servers:
+                await self._glue(referral, depth)
+                if not referral.servers:
+                    raise IterationError(f"No address found for any nameserver of {referral.zone}")
+            self.delegations.add(referral)
+            delegation = referral
+        raise IterationError(f"Too many referrals for {qname}")
+
+    async def resolve(self, qname: dns.name.Name | str, rdtype: RdataType, depth: int = 0) -> dns.message.Message:
+        if depth > self.max_depth:
+            raise IterationError(f"Nameserver lookups nested too deep for {qname}")
+        qname = dns.name.from_text(qname) if isinstance(qname, str) else qname
+        result = dns.message.make_response(dns.message.make_query(qname, rdtype))
+        result.flags |= dns.flags.RA
+
+        answer: List[dns.rrset.RRset] = []
+        name = qname
+        for _ in range(self.max_cnames + 1):
+            response, zone = await self._resolve_name(name, rdtype, depth)
+            # A server only speaks for its own zone, records it adds for other names could poison the cache
+            in_zone = [rrset for rrset in response.answer if rrset.name.is_subdomain(zone)]
+            answer.extend(in_zone)
+
+            # Follow the CNAME chain as far as the answers already go, then ask again for the rest,
+            # a target outside the zone is looked up from its own delegation
+            chained = True
+            while chained:
+                chained = False
+                for rrset in in_zone:
+                    if rrset.name == name and rrset.rdtype == RdataType.CNAME and rdtype != RdataType.CNAME:
+                        name = rrset[0].target
+                        chained = True
+            found = any(rrset.name == name and rrset.rdtype == rdtype for rrset in in_zone)
+            if found or response.rcode() != dns.rcode.NOERROR or not in_zone:
+                result.set_rcode(response.rcode())
+                result.answer = answer
+                if not found:
+                    result.authority = [rrset for rrset in response.authority if rrset.name.is_subdomain(zone)]
+                return result
+        raise IterationError(f"CNAME chain too long for {qname}")
+
+    async def resolve_message(self, message: dns.message.Message) -> dns.message.Message:
+        question = message.question[0]
+        resolved = await self.resolve(question.name, question.rdtype)
+        response = dns.message.make_response(message)
+        response.flags |= dns.flags.RA
+        response.set_rcode(resolved.rcode())
+        response.answer = resolved.answer
+        response.authority = resolved.authority
+        return response
+
+    async def resolve_answer(self, qname: str, rdtype: RdataType | str) -> dns.resolver.Answer:
+        # Same contract as dns.asyncresolver.resolve_at so callers can treat it as one more provider
+        qname, rdtype = dns.name.from_text(qname), dns.rdatatype.RdataType.make(rdtype)
+        response = await self.resolve(qname, rdtype)
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+        if response.resolve_chaining().answer is None:
+            raise dns.resolver.NoAnswer(response=response)
+        return dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response)
@@ -1,108 +1,266 @@
 import asyncio
-from typing import List, Dict
+import time
+from typing import AsyncIterator, Dict, List, Tuple
 
 import dns.asyncresolver
+import dns.message
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+from dns.rdtypes.ANY.CNAME import CNAME
+from dns.rdtypes.ANY.MX import MX
+from dns.rdtypes.ANY.NS import NS
+from dns.rdtypes.ANY.PTR import PTR
+from dns.rdtypes.ANY.SOA import SOA
+from dns.rdtypes.ANY.TXT import TXT
+from dns.rdtypes.IN.SRV import SRV
 
 from dnsdig.libdns.constants import RecordTypes
-from dnsdig.libdns.models.resolver import ResolverSet, MxResult, SoaResult, NSResult, TXTResult, DNSResolver
+from dnsdig.libdns.domains.iterative import IterativeResolver
+from dnsdig.libdns.models.resolver import (
+    ResolverSet,
+    MxResult,
+    SoaResult,
+    NSResult,
+    TXTResult,
+    SRVResult,
+    CNAMEResult,
+    PTRResult,
+    DNSResolver,
+)
 from dnsdig.libgeoip.domains.ip2geolocation import IP2Geo
 from dnsdig.libgeoip.models import IPLocationResult
+from dnsdig.libshared.metrics import Histogram, Counter
+from dnsdig.libshared.settings import settings
+from dnsdig.libshared.tracing import tracer
+from dnsdig.libshared.sharedcache import shared_cache
 
-ResolverResult = Dict[str, List[str | IPLocationResult | MxResult | SoaResult | NSResult | TXTResult]]
+upstream_rtt = Histogram("dnsdig_resolver_upstream_rtt_seconds", "Round trip time per DNS provider", ["provider"])
+upstream_errors = Counter("dnsdig_resolver_upstream_errors", "Failed lookups per DNS provider", ["provider"])
+
+Records = List[
+    str | IPLocationResult | MxResult | SoaResult | NSResult | TXTResult | SRVResult | CNAMEResult | PTRResult
+]
+ResolverResult = Dict[str, Records]
 
 
 class Resolver:
     resolvers: ResolverSet = ResolverSet()
+    iterative: IterativeResolver | None = IterativeResolver() if settings.resolver_iterative else None
+
+    @classmethod
+    def _hostname(cls, name: dns.name.Name) -> str:
+        # Names in answers are absolute, the empty root label is left out. Joining the labels is several times
+        # faster than Name.to_text, which escapes characters hostnames do not have
+        return b".".join(name.labels[:-1]).decode(errors="replace")
 
     @classmethod
-    def _parse_mx_result(cls, result: str, ttl: int) -> MxResult:
-        priority, hostname = result.split(" ")
-        return MxResult(priority=int(priority), hostname=hostname[0:-1], ttl=ttl)
+    def _parse_mx_result(cls, rdata: MX, ttl: int) -> MxResult:
+        return MxResult.model_construct(priority=rdata.preference, hostname=cls._hostname(rdata.exchange), ttl=ttl)
 
     @classmethod
-    def _parse_soa_result(cls, result: str, ttl: int) -> SoaResult:
-        primary_ns, email, serial, refresh, retry, expire, minimum = result.split(" ")
-        email = email.replace(".", "@", 1)
-        return SoaResult(
-            primaryNs=primary_ns,
+    def _parse_soa_result(cls, rdata: SOA, ttl: int) -> SoaResult:
+        # The first label of the responsible name is the mailbox, it may contain dots itself
+        mailbox, *domain = rdata.rname.labels
+        email = f"{mailbox.decode(errors='replace')}@{b'.'.join(domain).decode(errors='replace')}" if domain else "."
+        return SoaResult.model_construct(
+            primary_ns=f"{cls._hostname(rdata.mname)}.",
             email=email,
-            serial=int(serial),
-            refresh=int(refresh),
-            retry=int(retry),
-            expire=int(expire),
-            minimum=int(minimum),
+            serial=rdata.serial,
+            refresh=rdata.refresh,
+            retry=rdata.retry,
+            expire=rdata.expire,
+            minimum=rdata.minimum,
             ttl=ttl,
         )
 
     @classmethod
-    def _parse_txt_result(cls, result: str, ttl: int) -> TXTResult:
-        txt = result.replace('"', "")
-        return TXTResult(txt=txt, ttl=ttl)
+    def _parse_txt_result(cls, rdata: TXT, ttl: int) -> TXTResult:
+        # Long values like DKIM keys are split in strings of 255 bytes, they are one value again once joined
+        return TXTResult.model_construct(txt=b"".join(rdata.strings).decode(errors="replace"), ttl=ttl)
+
+    @classmethod
+    def _parse_ns_result(cls, rdata: NS, ttl: int) -> NSResult:
+        return NSResult.model_construct(hostname=cls._hostname(rdata.target), ttl=ttl)
+
+    @classmethod
+    def _parse_srv_result(cls, rdata: SRV, ttl: int) -> SRVResult:
+        return SRVResult.model_construct(
+            priority=rdata.priority, weight=rdata.weight, port=rdata.port, target=cls._hostname(rdata.target), ttl=ttl
+        )
+
+    @classmethod
+    def _parse_cname_result(cls, rdata: CNAME, ttl: int) -> CNAMEResult:
+        return CNAMEResult.model_construct(hostname=cls._hostname(rdata.target), ttl=ttl)
 
     @classmethod
-    def _parse_ns_result(cls, result: str, ttl: int) -> NSResult:
-        return NSResult(hostname=result, ttl=ttl)
+    def _parse_ptr_result(cls, rdata: PTR, ttl: int) -> PTRResult:
+        return PTRResult.model_construct(hostname=cls._hostname(rdata.target), ttl=ttl)
 
     @classmethod
     async def _parse_a_result(cls, result: str, ttl: int) -> IPLocationResult:
         return await IP2Geo.ip_to_location(ip=result, ttl=ttl)
 
+    @classmethod
+    def _providers(cls, use_ipv6: bool = False, nameserver: str | None = None) -> List[Tuple[str, str]]:
+        providers = [
+            (name, nameserver or (resolver.random6 if use_ipv6 else resolver.random))
+            for name, resolver in cls.resolvers.all
+        ]
+        if cls.iterative and not nameserver:
+            providers.append(("iterative", ""))
+        return providers
+
+    @classmethod
+    def _cached_answer(
+        cls, qname: str, rdtype: dns.rdatatype.RdataType, wire: bytes, expires_at: float
+    ) -> dns.resolver.Answer:
+        response = dns.message.from_wire(wire)
+        # Answered with the TTLs left, not the ones the provider answered with
+        remaining = max(0, int(expires_at - time.time()))
+        for rrset in response.answer:
+            rrset.ttl = min(rrset.ttl, remaining)
+        return dns.resolver.Answer(dns.name.from_text(qname), rdtype, dns.rdataclass.IN, response)
+
+    @classmethod
+    def _answer_key(cls, name: str, where: str, qname: str, rdtype: dns.rdatatype.RdataType) -> str:
+        # A lookup at a given nameserver or over IPv6 must not be answered from the default lookup of the provider
+        family = "6" if ":" in where else "4" if where else "-"
+        return f"answer#{name}#{where}#{family}#{qname.lower().rstrip('.')}#{rdtype:d}"
+
+    @classmethod
+    async def _query(cls, name: str, where: str, qname: str, rdtype: RecordTypes) -> dns.resolver.Answer:
+        # Every worker of the host shares one cache of provider answers
+        rdtype = dns.rdatatype.RdataType.make(rdtype)
+        key = cls._answer_key(name, where, qname, rdtype)
+        expected = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+        with tracer.span("dns.query", expected, provider=name, qname=qname, rdtype=rdtype.name) as span:
+            cached = shared_cache.get(key)
+            span.set("cached", bool(cached))
+            if cached:
+                return cls._cached_answer(qname, rdtype, *cached)
+
+            start = time.perf_counter()
+            try:
+                if name == "iterative":
+                    result = await cls.iterative.resolve_answer(qname=qname, rdtype=rdtype)
+                else:
+                    result = await dns.asyncresolver.resolve_at(where=where, qname=qname, rdtype=rdtype)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                upstream_rtt.observe(time.perf_counter() - start, name)
+                raise
+            except Exception:
+                upstream_errors.inc(name)
+                raise
+            upstream_rtt.observe(time.perf_counter() - start, name)
+            shared_cache.set(key, result.response.to_wire(), ttl=result.chaining_result.minimum_ttl)
+            return result
+
+    @classmethod
+    async def _parse_answer(cls, answer: dns.resolver.Answer, record_type: RecordTypes) -> Records:
+        records = []
+        ttl = answer.chaining_result.minimum_ttl
+
+        for rdata in answer:
+            match record_type:
+                case RecordTypes.MX:
+                    _rec = cls._parse_mx_result(rdata, ttl=ttl)
+                case RecordTypes.TXT:
+                    _rec = cls._parse_txt_result(rdata, ttl=ttl)
+                case RecordTypes.NS:
+                    _rec = cls._parse_ns_result(rdata, ttl=ttl)
+                case RecordTypes.SOA:
+                    _rec = cls._parse_soa_result(rdata, ttl=ttl)
+                case RecordTypes.SRV:
+                    _rec = cls._parse_srv_result(rdata, ttl=ttl)
+                case RecordTypes.CNAME:
+                    _rec = cls._parse_cname_result(rdata, ttl=ttl)
+                case RecordTypes.PTR:
+                    _rec = cls._parse_ptr_result(rdata, ttl=ttl)
+                case RecordTypes.A | RecordTypes.AAAA:
+                    _rec = await cls._parse_a_result(rdata.address, ttl=ttl)
+                case _:
+                    _rec = rdata.to_text()
+            records.append(_rec)
+        return records
+
     @classmethod
     async def resolve_record(
         cls, hostname: str, record_type: RecordTypes, use_ipv6: bool = False, nameserver: str | None = None
     ) -> ResolverResult:
-        func = dns.asyncresolver.resolve_at
         results = {'metadata': []}
-
-        def _nameserver(resolver: DNSResolver) -> str:
-            if nameserver:
-                return nameserver
-            return resolver.random if not use_ipv6 else resolver.random6
-
-        async def _result(name: str, where: str, qname: str, rdtype: RecordTypes):
-            result = await func(where=where, qname=qname, rdtype=rdtype)
-            return {name: result}
+        providers = cls._providers(use_ipv6=use_ipv6, nameserver=nameserver)
 
         try:
             grouped = [
-                _result(name=name, where=_nameserver(resolver), qname=hostname, rdtype=record_type)
-                for name, resolver in cls.resolvers.all
+                cls._query(name=name, where=where, qname=hostname, rdtype=record_type) for name, where in providers
             ]
             resolved = await asyncio.gather(*grouped)
         except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers) as exc:
             results.update({"metadata": [f"{hostname} - {exc}"]})
             return results
 
-        async def _parse_result(
-            _res: Dict[str, dns.resolver.Answer]
-        ) -> Dict[str, List[str | IPLocationResult | MxResult | SoaResult | NSResult | TXTResult]]:
-            name, answer = [x for x in _res.items()][0]
-
-            records = []
-            ttl = answer.chaining_result.minimum_ttl
-
-            for record in answer:
-                _rec = str(record)
-                match record_type:
-                    case RecordTypes.MX:
-                        _rec = cls._parse_mx_result(_rec, ttl=ttl)
-                    case RecordTypes.TXT:
-                        _rec = cls._parse_txt_result(_rec, ttl=ttl)
-                    case RecordTypes.NS:
-                        _rec = cls._parse_ns_result(_rec[0:-1], ttl=ttl)
-                    case RecordTypes.SOA:
-                        _rec = cls._parse_soa_result(_rec, ttl=ttl)
-                    case RecordTypes.A:
-                        _rec = await cls._parse_a_result(_rec, ttl=ttl)
-                    case RecordTypes.AAAA:
-                        _rec = await cls._parse_a_result(_rec, ttl=ttl)
-                records.append(_rec)
-            return {name: records}
-
-        [results.update(await _parse_result(x)) for x in resolved]
+        for (name, _), answer in zip(providers, resolved):
+            results[name] = await cls._parse_answer(answer, record_type=record_type)
 
         return results
 
+    @classmethod
+    async def stream_records(
+        cls, hostname: str, record_types: List[RecordTypes], use_ipv6: bool = False
+    ) -> AsyncIterator[Tuple[str, Dict]]:
+        providers = cls._providers(use_ipv6=use_ipv6)
+        events: asyncio.Queue[Tuple[str, RecordTypes, str, Records | Exception] | None] = asyncio.Queue()
+
+        async def _provider(record_type: RecordTypes, name: str, where: str):
+            try:
+                answer = await cls._query(name=name, where=where, qname=hostname, rdtype=record_type)
+                if record_type in (RecordTypes.A, RecordTypes.AAAA):
+                    # Addresses are sent as soon as they are known, their geolocation follows
+                    ttl = answer.chaining_result.minimum_ttl
+                    addresses = [IPLocationResult.model_construct(ip=rdata.address, ttl=ttl) for rdata in answer]
+                    events.put_nowait(("answer", record_type, name, addresses))
+                    events.put_nowait(("enrichment", record_type, name, await cls._parse_answer(answer, record_type)))
+                else:
+                    events.put_nowait(("answer", record_type, name, await cls._parse_answer(answer, record_type)))
+            except Exception as exc:
+                events.put_nowait(("error", record_type, name, exc))
+
+        async def _run():
+            try:
+                await asyncio.gather(
+                    *[_provider(rtype, name, where) for rtype in record_types for name, where in providers]
+                )
+            finally:
+                events.put_nowait(None)
+
+        records: Dict[RecordTypes, Dict[str, Records]] = {record_type: {} for record_type in record_types}
+        failures: Dict[RecordTypes, Exception] = {}
+        complete = True
+        runner = asyncio.create_task(_run())
+        try:
+            while (event := await events.get()) is not None:
+                kind, record_type, name, payload = event
+                if kind == "error":
+                    failures.setdefault(record_type, payload)
+                    complete = complete and isinstance(payload, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer))
+                    yield kind, {"type": record_type, "provider": name, "error": f"{hostname} - {payload}"}
+                    continue
+                records[record_type][name] = payload
+                yield kind, {"type": record_type, "provider": name, "records": payload}
+        finally:
+            runner.cancel()
+
+        # Same shape as resolve_record, a failed provider leaves only the metadata of its record type
+        results = {}
+        for record_type in record_types:
+            if record_type in failures:
+                results[record_type] = {"metadata": [f"{hostname} - {failures[record_type]}"]}
+            else:
+                results[record_type] = {"metadata": [], **{name: records[record_type][name] for name, _ in providers}}
+        # A provider that timed out or failed says nothing about the name, such a result must not be cached
+        yield "result" if complete else "incomplete", results
+
     @classmethod
     async def resolve_record6(cls, hostname: str, record_type: RecordTypes) -> ResolverResult:
         return await cls.resolve_record(hostname=hostname, record_type=record_type, use_ipv6=True)
@@ -1,7 +1,7 @@
 import random
 from typing import List, Tuple
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from dnsdig.libdns.constants import (
     GOOGLE_NAMESERVERS6,
@@ -10,8 +10,10 @@ from dnsdig.libdns.constants import (
     CLOUDFLARE_NAMESERVERS,
     OPENDNS_NAMESERVERS,
     OPENDNS_NAMESERVERS6,
+    RecordTypes,
 )
 from dnsdig.libshared.models import BaseRequestResponse
+from dnsdig.libshared.settings import settings
 
 
 class DNSResolver(BaseModel):
@@ -62,3 +64,31 @@ class NSResult(BaseRequestResponse):
 class TXTResult(BaseRequestResponse):
     txt: str
     ttl: int
+
+
+class SRVResult(BaseRequestResponse):
+    priority: int
+    weight: int
+    port: int
+    target: str
+    ttl: int
+
+
+class CNAMEResult(BaseRequestResponse):
+    hostname: str
+    ttl: int
+
+
+class PTRResult(BaseRequestResponse):
+    hostname: str
+    ttl: int
+
+
+class BatchLookup(BaseRequestResponse):
+    name: str = Field(max_length=255)
+    types: List[RecordTypes] = Field([RecordTypes.A], max_length=len(RecordTypes))
+
+
+class BatchResolveRequest(BaseRequestResponse):
+    # Validation stops at the first lookup past the limit instead of building them all
+    lookups: List[BatchLookup] = Field(max_length=settings.resolver_batch_max_lookups)
@@ -1,30 +1,42 @@
 import aiohttp
-from cache import AsyncLRU
 
 from dnsdig.libgeoip.models import IPLocationResult, IPInfoResponse, GeoObject, GeoType
 from dnsdig.libshared.settings import settings
+from dnsdig.libshared.tracing import tracer
+from dnsdig.libshared.sharedcache import shared_cache
 
 
 class IP2Geo:
     @classmethod
-    @AsyncLRU(maxsize=8192)
     async def ip_to_location(cls, ip: str, ttl: int) -> IPLocationResult:
-        async with aiohttp.ClientSession() as session:
-            url = f"{settings.ipinfo_host}/{ip}/json"
-            headers = {"Accept": "application/json", "Authorization": f"Bearer {settings.ipinfo_token}"}
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    return IPLocationResult(ip=ip, ttl=ttl)
-                location = IPInfoResponse.model_validate_json(await response.text())
-                if not location:
-                    return IPLocationResult(ip=ip, ttl=ttl)
-                coords = location.loc.split(",")
-                geo = GeoObject(type=GeoType.Point, coordinates=(float(coords[0]), float(coords[1])))
-                return IPLocationResult(
-                    ip=ip,
-                    country_iso_code=location.country,
-                    province=location.region,
-                    city=location.city,
-                    geo=geo,
-                    ttl=ttl,
-                )
+        # Shared by every worker of the host, only successful lookups are kept
+        with tracer.span("geo.lookup", ip=ip) as span:
+            key = f"geo#{ip}"
+            cached = shared_cache.get(key)
+            span.set("cached", bool(cached))
+            if cached:
+                location = IPLocationResult.model_validate_json(cached[0])
+                location.ttl = ttl
+                return location
+
+            async with aiohttp.ClientSession() as session:
+                url = f"{settings.ipinfo_host}/{ip}/json"
+                headers = {"Accept": "application/json", "Authorization": f"Bearer {settings.ipinfo_token}"}
+                async with session.get(url, headers=headers) as response:
+                    if response.status != 200:
+                        return IPLocationResult(ip=ip, ttl=ttl)
+                    location = IPInfoResponse.model_validate_json(await response.text())
+                    if not location:
+                        return IPLocationResult(ip=ip, ttl=ttl)
+                    coords = location.loc.split(",")
+                    geo = GeoObject(type=GeoType.Point, coordinates=(float(coords[0]), float(coords[1])))
+                    result = IPLocationResult(
+                        ip=ip,
+                        country_iso_code=location.country,
+                        province=location.region,
+                        city=location.city,
+                        geo=geo,
+                        ttl=ttl,
+                    )
+                    shared_cache.set(key, result.model_dump_json().encode(), ttl=settings.shared_cache_geo_ttl)
+                    return result
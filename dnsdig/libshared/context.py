@@ -1,19 +1,22 @@
 from contextlib import asynccontextmanager
 from datetime import datetime
-from functools import lru_cache
 from typing import List
 
 import jwt
-from asyncer import asyncify
 from fastapi import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials
+from functional import seq
 from motor import motor_asyncio
 
 from dnsdig.libaccount.constants import TokenTypes
 from dnsdig.libaccount.models.auth import Permissions
 from dnsdig.libaccount.models.mongo import User, Token, UserApplication
+from dnsdig.libshared.jwks import jwks_manager
 from dnsdig.libshared.monq import monq_find_one
+from dnsdig.libshared.principals import Principal, principal_cache
+from dnsdig.libshared.ratelimit import app_limiter
 from dnsdig.libshared.settings import settings
+from dnsdig.libshared.tracing import tracer
 
 
 class Context:
@@ -22,46 +25,76 @@ class Context:
         access_token: str | None = None,
         permissions: List[Permissions] | None = None,
         mongo_session: motor_asyncio.AsyncIOMotorClientSession | None = None,
+        cost: int = 1,
     ):
         self.access_token: str = access_token
         self.permissions: List[Permissions] = permissions
         self.mongo_session: motor_asyncio.AsyncIOMotorClientSession = mongo_session
+        # How many requests this one counts for against the application's rate limit
+        self.cost = cost
 
         self.current_user: User | None = None
         self.current_app: UserApplication | None = None
         self.auth_provider_user_id: str | None = None
 
-    @classmethod
-    @lru_cache()
-    def get_jwks_client(cls) -> jwt.PyJWKClient:
-        return jwt.PyJWKClient(settings.auth_jwks_url)
+    async def _m2m_principal(self) -> Principal:
+        key = f"m2m:{Token.hash_token(self.access_token)}"
+        principal = principal_cache.get(key)
+        if principal:
+            return principal
 
-    async def _authorize_m2m_token(self):
-        query = {"token": self.access_token}
-        token = await monq_find_one(model=Token, query=query, project_to=Token)
+        token = await Token.get_token(token=self.access_token, token_type=TokenTypes.M2M)
         if not token:
             raise HTTPException(status_code=401, detail="Invalid token")
-        if token.token_type != TokenTypes.M2M:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        if token.expires_at < datetime.utcnow():
+
+        # The application is embedded in its owner, one query finds both
+        user = await User.get_user_by_app_client_id(client_id=token.owner_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="Unknown token owner")
+        app = seq(user.applications).find(lambda app: app.client_id == token.owner_id)
+
+        principal = Principal(user=user, app=app, expires_at=token.expires_at)
+        principal_cache.set(key, principal, ttl=(token.expires_at - datetime.utcnow()).total_seconds())
+        return principal
+
+    async def _authorize_m2m_token(self):
+        principal = await self._m2m_principal()
+        if principal.expires_at < datetime.utcnow():
             raise HTTPException(status_code=401, detail="Token expired")
 
-        self.current_user = await User.get_user_by_app_client_id(client_id=token.owner_id)
+        self.current_user = principal.user
         if self.current_user.is_blocked:
             raise HTTPException(
                 status_code=403, detail="The owner of the application is blocked from using this service"
             )
 
-        self.current_app = await User.get_app_by_client_id(client_id=token.owner_id)
+        self.current_app = principal.app
+        await self.charge(self.cost)
 
         for permission in self.permissions:
             if permission not in self.current_app.permissions:
                 raise HTTPException(status_code=403, detail="You do not have permission to perform this action")
 
+    async def _jwt_principal(self) -> Principal:
+        key = f"sub:{self.auth_provider_user_id}"
+        principal = principal_cache.get(key)
+        if principal:
+            return principal
+
+        query = {"auth_provider_user_id": self.auth_provider_user_id}
+        user = await monq_find_one(model=User, query=query, project_to=User)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+
+        principal = Principal(user=user)
+        principal_cache.set(key, principal)
+        return principal
+
     async def _authorize_jwt_token(self):
-        jwks_client = await asyncify(Context.get_jwks_client)()
-        signing_key = jwks_client.get_signing_key_from_jwt(self.access_token)
-        payload = jwt.decode(self.access_token, signing_key.key, algorithms=[settings.auth_jwt_algo])
+        try:
+            payload = await jwks_manager.decode(self.access_token, algorithms=[settings.auth_jwt_algo])
+        except jwt.PyJWTError:
+            raise HTTPException(status_code=401, detail="Invalid token")
 
         iss = payload.get("iss")
         if iss != settings.auth_provider_host:
@@ -73,11 +106,7 @@ class Context:
 
         self.auth_provider_user_id = payload.get("sub")
 
-        query = {"auth_provider_user_id": self.auth_provider_user_id}
-        self.current_user = await monq_find_one(model=User, query=query, project_to=User)
-        if not self.current_user:
-            raise HTTPException(status_code=401, detail="User not found")
-
+        self.current_user = (await self._jwt_principal()).user
         if self.current_user.is_blocked:
             raise HTTPException(status_code=403, detail="You are blocked from using this platform")
 
@@ -85,6 +114,11 @@ class Context:
             if permission not in self.current_user.permissions:
                 raise HTTPException(status_code=403, detail="You do not have permission to perform this action")
 
+    async def charge(self, cost: int):
+        # Only applications are rate limited, a cost of 0 leaves the charge to the caller once it knows the cost
+        if cost and self.current_app and app_limiter.times:
+            await app_limiter.hit(f"app:{self.current_app.client_id}", cost=cost)
+
     async def authorize_access_token(self):
         if self.access_token.startswith("m2m"):
             return await self._authorize_m2m_token()
@@ -98,13 +132,17 @@ class Context:
         authorization: HTTPAuthorizationCredentials,
         permissions: List[Permissions] | None = None,
         mongo_session: motor_asyncio.AsyncIOMotorClientSession | None = None,
+        cost: int = 1,
     ):
         if authorization is None or authorization.credentials is None:
             raise HTTPException(status_code=401, detail="Unrecognized or missing authorization header")
 
-        instance = cls(access_token=authorization.credentials, permissions=permissions, mongo_session=mongo_session)
+        instance = cls(
+            access_token=authorization.credentials, permissions=permissions, mongo_session=mongo_session, cost=cost
+        )
 
-        await instance.authorize_access_token()
+        with tracer.span("auth.protected", cost=cost):
+            await instance.authorize_access_token()
 
         yield instance
 
@@ -0,0 +1,129 @@
+import asyncio
+import copy
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import aiohttp
+import jwt
+import ujson
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.settings import settings
+from dnsdig.libshared.utils import cancel_tasks
+
+
+class JWKSManager:
+    def __init__(
+        self,
+        url: str,
+        refresh_interval: float = 3600,
+        min_refetch_interval: float = 30,
+        claims_cache_size: int = 10000,
+        timeout: float = 5,
+    ):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.claims_cache_size = claims_cache_size
+        self.timeout = timeout
+        self.keys: Dict[str, jwt.PyJWK] = {}
+        # kid -> digest of the key material, a refetch builds new key objects for the same keys
+        self.thumbprints: Dict[str, str] = {}
+        self.fetched_at = 0.0
+        self.lock = asyncio.Lock()
+        # token digest -> kid and thumbprint of the key that verified the token and its claims, kept until it expires
+        self.claims: OrderedDict[str, Tuple[str, str, Dict[str, Any]]] = OrderedDict()
+        self.task: asyncio.Task | None = None
+
+    async def download(self) -> Dict[str, Any]:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    def load(self, jwks: Dict[str, Any]):
+        keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(jwks).keys if key.key_id}
+        thumbprints = {
+            jwk["kid"]: hashlib.sha256(ujson.dumps(jwk, sort_keys=True).encode()).hexdigest()
+            for jwk in jwks.get("keys", [])
+            if jwk.get("kid") in keys
+        }
+        # Keys that disappear from the set are dropped, tokens signed with them stop verifying
+        self.keys, self.thumbprints = keys, thumbprints
+        logger.info("Loaded JWKS", extra={"url": self.url, "kids": list(keys)})
+
+    async def fetch(self):
+        self.fetched_at = time.monotonic()
+        self.load(await self.download())
+
+    async def signing_key(self, kid: str | None) -> jwt.PyJWK:
+        key = self.keys.get(kid)
+        if key:
+            return key
+
+        # An unknown kid usually means the provider rotated its keys, but made up kids must not
+        # turn every request into a fetch, one fetch per interval is enough
+        async with self.lock:
+            key = self.keys.get(kid)
+            if not key and time.monotonic() - self.fetched_at >= self.min_refetch_interval:
+                try:
+                    await self.fetch()
+                except (aiohttp.ClientError, asyncio.TimeoutError, jwt.PyJWKSetError) as exc:
+                    logger.error("Failed to fetch JWKS", extra={"url": self.url, "error": repr(exc)})
+                key = self.keys.get(kid)
+        if not key:
+            raise jwt.PyJWKClientError(f"Unable to find a signing key that matches: {kid}")
+        return key
+
+    async def decode(self, token: str, algorithms: List[str]) -> Dict[str, Any]:
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        cached = self.claims.get(digest)
+        # A token only stays verified while the key that signed it is still in the set, and within nbf and exp
+        if cached and self.thumbprints.get(cached[0]) == cached[1]:
+            now = time.time()
+            if cached[2].get("nbf", 0) <= now < cached[2]["exp"]:
+                self.claims.move_to_end(digest)
+                return copy.deepcopy(cached[2])
+        self.claims.pop(digest, None)
+
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = await self.signing_key(kid)
+        claims = jwt.decode(token, key.key, algorithms=algorithms)
+
+        # Only tokens that expire are remembered, a repeat of one skips signature verification
+        if isinstance(claims.get("exp"), (int, float)) and isinstance(claims.get("nbf", 0), (int, float)):
+            self.claims[digest] = (kid, self.thumbprints[kid], copy.deepcopy(claims))
+            while len(self.claims) > self.claims_cache_size:
+                self.claims.popitem(last=False)
+        return claims
+
+    async def refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.fetch()
+            except (aiohttp.ClientError, asyncio.TimeoutError, jwt.PyJWKSetError) as exc:
+                logger.error("Failed to refresh JWKS", extra={"url": self.url, "error": repr(exc)})
+
+    async def start(self):
+        try:
+            await self.fetch()
+        except (aiohttp.ClientError, asyncio.TimeoutError, jwt.PyJWKSetError) as exc:
+            # Not fatal, the first token with a kid we do not know triggers another fetch
+            logger.error("Failed to prefetch JWKS", extra={"url": self.url, "error": repr(exc)})
+        if self.task is None:
+            self.task = asyncio.create_task(self.refresh_forever())
+
+    async def stop(self):
+        await cancel_tasks(self.task)
+        self.task = None
+
+
+jwks_manager = JWKSManager(
+    settings.auth_jwks_url,
+    refresh_interval=settings.auth_jwks_refresh_interval,
+    min_refetch_interval=settings.auth_jwks_min_refetch_interval,
+    claims_cache_size=settings.auth_jwt_claims_cache_size,
+)
@@ -1,18 +1,42 @@
+import atexit
+import copy
 import logging
+import logging.handlers
+import queue
+import random
 import sys
+from contextvars import ContextVar, Token
+from datetime import datetime
+from typing import Dict
 from uuid import uuid4
 
-request_id = ''
+import ujson
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from dnsdig.libshared.metrics import Counter
 
-def set_request_id(new_request_id):
-    global request_id
-    request_id = new_request_id if new_request_id else uuid4()
+request_id: ContextVar[str] = ContextVar("request_id", default="")
+log_records_dropped = Counter("dnsdig_log_records_dropped", "Log records not written", ["reason"])
+
+
+def set_request_id(new_request_id) -> Token:
+    return request_id.set(str(new_request_id) if new_request_id else str(uuid4()))
+
+
+class LogSettings(BaseSettings):
+    log_level: str = "INFO"
+    log_format: str = "text"
+    log_queue_size: int = 10000
+    # Per level sampling rates, e.g. LOG_SAMPLE_RATES='{"INFO": 0.01}', levels not listed are always kept
+    log_sample_rates: Dict[str, float] = Field(default_factory=dict)
+
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 
 class RequestIdFilter(logging.Filter):
     def filter(self, record):
-        record.request_id = request_id
+        record.request_id = request_id.get()
         return True
 
 
@@ -25,22 +49,113 @@ class MaxLevelFilter(logging.Filter):
         return record.levelno < self.level
 
 
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = {logging.getLevelName(level.upper()): rate for level, rate in rates.items()}
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or rate >= 1:
+            return True
+        if random.random() < rate:
+            return True
+        log_records_dropped.inc("sampled")
+        return False
+
+
+_exc_formatter = logging.Formatter()
+_reserved_attrs = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "request_id"}
+
+
+def record_fields(record: logging.LogRecord) -> Dict:
+    return {k: v for k, v in record.__dict__.items() if k not in _reserved_attrs}
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if not fields:
+            return line
+        return f"{line} " + " ".join(f"{k}={v}" for k, v in fields.items())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "request_id": getattr(record, "request_id", ""),
+            "message": record.getMessage(),
+        }
+        payload.update(record_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return ujson.dumps(payload, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare the record is not formatted here, the formatter on the listener thread still
+        # sees the fields and the traceback on its own. Only the traceback is rendered now, before its frames change
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc("queue_full")
+
+
+log_settings = LogSettings()
+
 logging.root.setLevel(logging.INFO)
 logger = logging.getLogger('fastapi')
+logger.setLevel(log_settings.log_level.upper())
 logger.propagate = False
 
 # handlers, filter, format
-formatter = logging.Formatter('%(asctime)-15s %(request_id)s [%(levelname)s] %(message)s')
+if log_settings.log_format == "json":
+    formatter = JsonFormatter()
+else:
+    formatter = TextFormatter('%(asctime)-15s %(request_id)s [%(levelname)s] %(message)s')
+
 h_err = logging.StreamHandler(sys.stderr)
-h_err.addFilter(RequestIdFilter())
 h_err.setLevel(logging.WARNING)
 h_err.setFormatter(formatter)
 
 h_out = logging.StreamHandler(sys.stdout)
-h_out.addFilter(RequestIdFilter())
 h_out.addFilter(MaxLevelFilter(logging.WARNING))
-h_out.setLevel(logging.INFO)
+h_out.setLevel(logging.DEBUG)
 h_out.setFormatter(formatter)
 
+# Records are stamped and sampled on the calling side whether they are written right away or by the listener
+logger.addFilter(SamplingFilter(log_settings.log_sample_rates))
+logger.addFilter(RequestIdFilter())
 logger.addHandler(h_err)
 logger.addHandler(h_out)
+
+h_queue = DroppingQueueHandler(queue.Queue(maxsize=log_settings.log_queue_size))
+listener: logging.handlers.QueueListener | None = None
+
+
+def start_log_listener():
+    # Servers call this on startup, from then on stdout/stderr writes happen on the listener thread
+    global listener
+    if listener is not None:
+        return
+    listener = logging.handlers.QueueListener(h_queue.queue, h_err, h_out, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.removeHandler(h_err)
+    logger.removeHandler(h_out)
+    logger.addHandler(h_queue)
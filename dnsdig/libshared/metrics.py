@@ -0,0 +1,247 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    metric_type: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def snapshot(self) -> Dict:
+        raise NotImplementedError
+
+    def merge(self, snapshot: Dict):
+        raise NotImplementedError
+
+    def empty(self, registry: "Registry") -> "Metric":
+        return type(self)(self.name, self.documentation, self.labelnames, registry=registry)
+
+    @property
+    def family(self) -> str:
+        return self.name
+
+    def render(self) -> str:
+        # In the 0.0.4 text format HELP and TYPE name the series exactly as the samples do
+        lines = [f"# HELP {self.family} {self.documentation}", f"# TYPE {self.family} {self.metric_type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        # Recording happens on the event loop thread only, a plain dict update is enough
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues: str) -> float:
+        return self.values.get(labelvalues, 0)
+
+    @property
+    def family(self) -> str:
+        return f"{self.name}_total"
+
+    def snapshot(self) -> Dict:
+        return {"values": [[list(labels), value] for labels, value in self.values.items()]}
+
+    def merge(self, snapshot: Dict):
+        for labels, value in snapshot["values"]:
+            self.inc(*labels, amount=value)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.family}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None, aggregate: str = "sum"
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.values: Dict[LabelValues, float] = {}
+        self.callback: Callable[[], float] | None = None
+        # How workers are combined, "sum" for shares of a host total like connections, "max" for values that only
+        # make sense per process like lag or queue depth
+        if aggregate not in ("sum", "max"):
+            raise ValueError(f"Unknown gauge aggregate: {aggregate}")
+        self.aggregate = aggregate
+
+    def set(self, value: float, *labelvalues: str):
+        self.values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) - amount
+
+    def set_function(self, callback: Callable[[], float]):
+        self.callback = callback
+
+    def get(self, *labelvalues: str) -> float:
+        if self.callback:
+            return self.callback()
+        return self.values.get(labelvalues, 0)
+
+    def snapshot(self) -> Dict:
+        if self.callback:
+            return {"values": [[[], self.callback()]]}
+        return {"values": [[list(labels), value] for labels, value in self.values.items()]}
+
+    def empty(self, registry: "Registry") -> "Gauge":
+        return Gauge(self.name, self.documentation, self.labelnames, registry=registry, aggregate=self.aggregate)
+
+    def merge(self, snapshot: Dict):
+        for labels, value in snapshot["values"]:
+            labels = tuple(labels)
+            if self.aggregate == "max" and labels in self.values:
+                self.values[labels] = max(self.values[labels], value)
+            else:
+                self.inc(*labels, amount=value)
+
+    def samples(self) -> List[str]:
+        if self.callback:
+            return [f"{self.name} {_format_value(self.callback())}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry=None,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [bucket counts..., +Inf count], sum
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        counts = self.counts.get(labelvalues)
+        if counts is None:
+            counts = self.counts[labelvalues] = [0] * (len(self.buckets) + 1)
+            self.sums[labelvalues] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labelvalues] += value
+
+    def count(self, *labelvalues: str) -> int:
+        return sum(self.counts.get(labelvalues, ()))
+
+    def quantile(self, q: float, *labelvalues: str) -> float | None:
+        counts = self.counts.get(labelvalues)
+        if not counts:
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def empty(self, registry: "Registry") -> "Histogram":
+        return Histogram(self.name, self.documentation, self.labelnames, buckets=self.buckets, registry=registry)
+
+    def snapshot(self) -> Dict:
+        return {"counts": [[list(labels), counts, self.sums[labels]] for labels, counts in self.counts.items()]}
+
+    def merge(self, snapshot: Dict):
+        for labels, counts, total in snapshot["counts"]:
+            labels = tuple(labels)
+            merged = self.counts.get(labels)
+            if merged is None:
+                merged = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            if len(counts) != len(merged):
+                continue
+            for n, count in enumerate(counts):
+                merged[n] += count
+            self.sums[labels] += total
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicated metric: {metric.name}")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def merged(self, snapshots: List[Dict[str, Dict]]) -> "Registry":
+        registry = Registry()
+        for name, metric in self.metrics.items():
+            merged = metric.empty(registry)
+            for snapshot in snapshots:
+                if name in snapshot:
+                    merged.merge(snapshot[name])
+        return registry
+
+
+REGISTRY = Registry()
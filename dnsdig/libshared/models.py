@@ -1,19 +1,36 @@
 import asyncio
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, List
 
+import pydantic_core
 from beanie import Document, before_event, ValidateOnSave, Update
 from humps import camelize
 from pydantic import BaseModel, Field, ConfigDict
 from motor import motor_asyncio
 from fastapi import Request
+from fastapi.responses import JSONResponse
 
 from dnsdig.libshared.settings import settings, Environments
+from dnsdig.libshared.tracing import tracer
 
-client_options = {'appname': settings.app_name}
-mongo_client = motor_asyncio.AsyncIOMotorClient(settings.mongo_url, **client_options)
-mongo_client.get_io_loop = asyncio.get_running_loop
+
+@lru_cache()
+def get_mongo_client() -> motor_asyncio.AsyncIOMotorClient:
+    # Created on first use from a startup hook, not when the module is imported
+    client_options = {'appname': settings.app_name}
+    mongo_client = motor_asyncio.AsyncIOMotorClient(settings.mongo_url, **client_options)
+    mongo_client.get_io_loop = asyncio.get_running_loop
+    return mongo_client
+
+
+def __getattr__(name: str):
+    if name == "mongo_client":
+        return get_mongo_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class BaseRequestResponse(BaseModel):
@@ -22,6 +39,14 @@ class BaseRequestResponse(BaseModel):
     )
 
 
+class ModelJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        # Content we built from our own response models goes straight to JSON, FastAPI would validate it
+        # against the response model first and serialize it a second time
+        with tracer.span("response.serialize"):
+            return pydantic_core.to_json(content, by_alias=True)
+
+
 class BaseDatetimeMeta(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime | None = None
@@ -34,23 +59,90 @@ class BaseMongoDocument(Document, BaseDatetimeMeta):
         self.updated_at = datetime.utcnow()
 
 
+class LazyTransaction:
+    def __init__(self, client: motor_asyncio.AsyncIOMotorClient):
+        self.client = client
+        self.session: motor_asyncio.AsyncIOMotorClientSession | None = None
+        self.lock = asyncio.Lock()
+        self.callbacks: List[Callable[[], Awaitable]] = []
+
+    async def get_session(self) -> motor_asyncio.AsyncIOMotorClientSession:
+        # The session handshake only happens for the first write, requests that only read never pay for it
+        async with self.lock:
+            if self.session is None:
+                session = await self.client.start_session()
+                session.start_transaction()
+                self.session = session
+        return self.session
+
+    async def commit(self):
+        if self.session is not None and self.session.in_transaction:
+            await self.session.commit_transaction()
+
+    async def abort(self):
+        if self.session is not None and self.session.in_transaction:
+            await self.session.abort_transaction()
+
+    async def end(self):
+        if self.session is not None:
+            await self.session.end_session()
+            self.session = None
+
+    async def run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            await callback()
+
+
+current_transaction: ContextVar[LazyTransaction | None] = ContextVar("current_transaction", default=None)
+
+
+async def mongo_session() -> motor_asyncio.AsyncIOMotorClientSession | None:
+    transaction = current_transaction.get()
+    if transaction is None:
+        return None
+    return await transaction.get_session()
+
+
+def active_session() -> motor_asyncio.AsyncIOMotorClientSession | None:
+    # Reads join the transaction once a write started it, so a request reads its own writes
+    transaction = current_transaction.get()
+    return transaction.session if transaction is not None else None
+
+
+async def after_commit(callback: Callable[[], Awaitable]):
+    # Others must not see a change before it is committed, nor at all when it is rolled back
+    transaction = current_transaction.get()
+    if transaction is None or transaction.session is None:
+        await callback()
+    else:
+        transaction.callbacks.append(callback)
+
+
 class MongoClient:
-    def __init__(self):
-        self.client = mongo_client
+    @property
+    def client(self) -> motor_asyncio.AsyncIOMotorClient:
+        return get_mongo_client()
 
     @property
     def db_name(self) -> str:
         return settings.db_name
 
     @asynccontextmanager
-    async def transaction(self) -> motor_asyncio.AsyncIOMotorClientSession:
-        async with await self.client.start_session() as session:
-            async with session.start_transaction():
-                try:
-                    yield session
-                except Exception as exc:
-                    await session.abort_transaction()
-                    raise exc
+    async def transaction(self) -> LazyTransaction:
+        transaction = LazyTransaction(self.client)
+        token = current_transaction.set(transaction)
+        try:
+            yield transaction
+        except Exception as exc:
+            await transaction.abort()
+            raise exc
+        else:
+            await transaction.commit()
+            await transaction.run_callbacks()
+        finally:
+            current_transaction.reset(token)
+            await transaction.end()
 
 
 class MongoClientDependency:
@@ -1,10 +1,13 @@
 from typing import TypeVar, Any, Dict, List, Type, Tuple
 
 from beanie import Document
+from motor.motor_asyncio import AsyncIOMotorClientSession
 from pydantic import BaseModel
 from pymongo import ReturnDocument
 from pymongo.collation import Collation
 
+from dnsdig.libshared.models import active_session
+
 T = TypeVar("T", bound=BaseModel)
 TD = TypeVar("TD", bound=Document)
 
@@ -18,15 +21,17 @@ async def monq_find_many(
     limit: int = 0,
     sort: List[Tuple[str, int]] | None = None,
     collation: Dict[str, Any] | Collation = None,
+    session: AsyncIOMotorClientSession = None,
 ) -> List[T] | List[Dict] | List:
     coll = model.get_settings().motor_db[model.get_settings().name]
     if coll is None:
         raise EnvironmentError(f'Uninitialized collection: {model.Settings.name}')
 
+    session = session or active_session()
     if not collation:
-        _cursor = coll.find(query, skip=skip, limit=limit, sort=sort)
+        _cursor = coll.find(query, skip=skip, limit=limit, sort=sort, session=session)
     else:
-        _cursor = coll.find(query, skip=skip, limit=limit, sort=sort).collation(collation)
+        _cursor = coll.find(query, skip=skip, limit=limit, sort=sort, session=session).collation(collation)
 
     results = []
     async for doc in _cursor:
@@ -47,8 +52,11 @@ async def monq_find_one(
     *,
     project_to: Type[T] | None = None,
     collation: Dict[str, Any] | Collation = None,
+    session: AsyncIOMotorClientSession = None,
 ) -> T | Dict | None:
-    results = await monq_find_many(model=model, query=query, project_to=project_to, limit=1, collation=collation)
+    results = await monq_find_many(
+        model=model, query=query, project_to=project_to, limit=1, collation=collation, session=session
+    )
     if len(results) == 0:
         return None
     return results[0]
@@ -64,6 +72,25 @@ async def monq_delete_one(model: Type[TD], where: Dict[str, Any]) -> int:
     return result.deleted_count
 
 
+async def monq_find_one_and_delete(
+    model: Type[TD],
+    where: Dict[str, Any],
+    *,
+    project_to: Type[T] | None = None,
+    session: AsyncIOMotorClientSession = None,
+) -> T | Dict | None:
+    coll = model.get_settings().motor_db[model.get_settings().name]
+    if coll is None:
+        raise EnvironmentError(f'Uninitialized collection: {model.Settings.name}')
+
+    result = await coll.find_one_and_delete(where, session=session)
+
+    if result is None or not project_to:
+        return result
+
+    return project_to(**result)
+
+
 async def monq_lock_document(model: Type[TD], where: Dict[str, Any], lock_field: str) -> bool:
     coll = model.get_settings().motor_db[model.get_settings().name]
     if coll is None:
@@ -74,11 +101,11 @@ async def monq_lock_document(model: Type[TD], where: Dict[str, Any], lock_field:
     return result is not None
 
 
-async def monq_delete_many(model: Type[TD], where: Dict[str, Any]) -> int:
+async def monq_delete_many(model: Type[TD], where: Dict[str, Any], session: AsyncIOMotorClientSession = None) -> int:
     coll = model.get_settings().motor_db[model.get_settings().name]
     if coll is None:
         raise EnvironmentError(f'Uninitialized collection: {model.Settings.name}')
 
-    result = await coll.delete_many(where)
+    result = await coll.delete_many(where, session=session)
 
     return result.deleted_count
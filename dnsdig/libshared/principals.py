@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Set, Tuple
+
+import redis.asyncio as redis
+from pydantic import BaseModel
+from redis.exceptions import ConnectionError, TimeoutError
+
+from dnsdig.libaccount.models.mongo import User, UserApplication
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import Counter
+from dnsdig.libshared.settings import settings
+
+principal_lookups = Counter("dnsdig_principal_cache_lookups", "Principal cache lookups", ["result"])
+
+
+class Principal(BaseModel):
+    user: User
+    app: UserApplication | None = None
+    expires_at: datetime | None = None
+
+
+class PrincipalCache:
+    channel = "dnsdig-principals"
+    everyone = "*"
+
+    def __init__(self, size: int = 10000, ttl: float = 60):
+        self.size = size
+        self.ttl = ttl
+        # key -> (principal, user id, expires_at), least recently used first
+        self.entries: OrderedDict[str, Tuple[Principal, str, float]] = OrderedDict()
+        self.keys_by_user: Dict[str, Set[str]] = {}
+        self.redis_client: redis.Redis | None = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Principal | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            if entry is not None:
+                self.delete(key)
+            principal_lookups.inc("miss")
+            return None
+        self.entries.move_to_end(key)
+        principal_lookups.inc("hit")
+        # Handlers may change the user they are given, other requests must not see that
+        principal = entry[0]
+        return Principal(user=principal.user.model_copy(deep=True), app=principal.app, expires_at=principal.expires_at)
+
+    def set(self, key: str, principal: Principal, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self.delete(key)
+        user_id = str(principal.user.id)
+        self.entries[key] = (principal, user_id, time.monotonic() + ttl)
+        self.keys_by_user.setdefault(user_id, set()).add(key)
+        while len(self.entries) > self.size:
+            self.delete(next(iter(self.entries)))
+
+    def delete(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self.keys_by_user.get(entry[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_user[entry[1]]
+
+    def invalidate_user(self, user_id: str):
+        if user_id == self.everyone:
+            self.clear()
+            return
+        for key in list(self.keys_by_user.get(user_id, ())):
+            self.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.keys_by_user.clear()
+
+    def get_redis_client(self) -> redis.Redis:
+        if self.redis_client is None:
+            self.redis_client = redis.from_url(settings.redis_url, encoding="utf-8", decode_responses=True)
+        return self.redis_client
+
+    async def close(self):
+        if self.redis_client is not None:
+            await self.redis_client.close()
+            self.redis_client = None
+
+    async def publish(self, user_id: str):
+        # Dropped here first, the other workers follow when the message reaches them
+        self.invalidate_user(user_id)
+        try:
+            await self.get_redis_client().publish(self.channel, user_id)
+        except (ConnectionError, TimeoutError, OSError) as exc:
+            logger.error("Failed to publish principal invalidation", extra={"user_id": user_id, "error": repr(exc)})
+
+    async def listen_forever(self, retry_interval: float = 1.0):
+        while True:
+            pubsub = self.get_redis_client().pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                # Invalidations published while we were not listening are lost, start over
+                self.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.invalidate_user(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error("Lost principal invalidations", extra={"error": repr(exc)})
+            finally:
+                await pubsub.close()
+            self.clear()
+            await asyncio.sleep(retry_interval)
+
+
+principal_cache = PrincipalCache(size=settings.principal_cache_size, ttl=settings.principal_cache_ttl)
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from typing import Dict, List, Set
+
+import redis.asyncio as redis
+from fastapi import HTTPException, Request
+from redis.exceptions import ConnectionError, TimeoutError
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import Counter
+from dnsdig.libshared.settings import settings
+from dnsdig.libshared.tracing import tracer
+from dnsdig.libshared.utils import cancel_tasks
+
+rate_limited = Counter("dnsdig_rate_limited", "Requests rejected by a rate limiter", ["limiter", "reason"])
+
+
+class WindowCounter:
+    __slots__ = ("window", "synced", "pending", "flushing")
+
+    def __init__(self, window: int):
+        self.window = window
+        # Cluster wide count as of the last reconciliation, our own flushed requests included
+        self.synced = 0
+        # Requests this worker admitted that Redis has not heard of yet
+        self.pending = 0
+        self.flushing = 0
+
+    @property
+    def estimate(self) -> int:
+        return self.synced + self.pending
+
+
+class HybridRateLimiter:
+    def __init__(
+        self,
+        name: str,
+        times: int,
+        seconds: int,
+        sync_interval: float = 0.1,
+        overshoot: float = 0.1,
+        fail_open: bool = True,
+        stale_after: float = 5.0,
+    ):
+        self.name = name
+        self.times = times
+        self.seconds = seconds
+        self.sync_interval = sync_interval
+        # Each worker admits at most this many requests per key before it has to tell Redis, which bounds
+        # how far over the limit the cluster can go to about workers * overshoot * times
+        self.max_pending = max(1, int(times * overshoot))
+        self.fail_open = fail_open
+        self.stale_after = stale_after
+        self.counters: Dict[str, WindowCounter] = {}
+        self.dirty: Set[str] = set()
+        self.failing_since: float | None = None
+        self.redis_client: redis.Redis | None = None
+        self.task: asyncio.Task | None = None
+
+    def get_redis_client(self) -> redis.Redis:
+        if self.redis_client is None:
+            self.redis_client = redis.from_url(settings.redis_url, encoding="utf-8", decode_responses=True)
+        return self.redis_client
+
+    @property
+    def healthy(self) -> bool:
+        return self.failing_since is None or time.monotonic() - self.failing_since < self.stale_after
+
+    def redis_key(self, key: str, window: int) -> str:
+        return f"dnsdig-ratelimit#{self.name}#{key}#{window}"
+
+    def retry_after(self) -> int:
+        return max(1, int(self.seconds - time.time() % self.seconds))
+
+    def reject(self, reason: str):
+        rate_limited.inc(self.name, reason)
+        if reason == "unavailable":
+            raise HTTPException(status_code=503, detail="Rate limiter unavailable")
+        raise HTTPException(
+            status_code=429, detail="Too Many Requests", headers={"Retry-After": str(self.retry_after())}
+        )
+
+    def counter(self, key: str) -> WindowCounter:
+        window = int(time.time() // self.seconds)
+        counter = self.counters.get(key)
+        if counter is None or counter.window != window:
+            counter = self.counters[key] = WindowCounter(window)
+        return counter
+
+    async def hit(self, key: str, cost: int = 1):
+        with tracer.span("ratelimit.hit", limiter=self.name, cost=cost):
+            await self._hit(key, cost)
+
+    async def _hit(self, key: str, cost: int):
+        if not self.healthy and not self.fail_open:
+            self.reject("unavailable")
+
+        counter = self.counter(key)
+        if counter.estimate + cost > self.times:
+            self.reject("limit")
+
+        # This worker's share for the key is used up, ask Redis before admitting more
+        if counter.pending + cost > self.max_pending and self.failing_since is None:
+            await self.flush([key])
+            counter = self.counter(key)
+            if counter.estimate + cost > self.times:
+                self.reject("limit")
+
+        counter.pending += cost
+        self.dirty.add(key)
+
+    async def flush(self, keys: List[str] | None = None):
+        keys = list(self.dirty) if keys is None else keys
+        batch = []
+        for key in keys:
+            self.dirty.discard(key)
+            counter = self.counters.get(key)
+            # Requests already being sent by a concurrent flush are not sent twice
+            amount = counter.pending - counter.flushing if counter else 0
+            if amount > 0:
+                counter.flushing += amount
+                batch.append((key, counter, amount))
+        if not batch:
+            return
+
+        pipeline = self.get_redis_client().pipeline(transaction=False)
+        for key, counter, amount in batch:
+            redis_key = self.redis_key(key, counter.window)
+            pipeline.incrby(redis_key, amount)
+            pipeline.expire(redis_key, self.seconds * 2)
+        try:
+            results = await pipeline.execute()
+        except (ConnectionError, TimeoutError, OSError) as exc:
+            for key, counter, amount in batch:
+                counter.flushing -= amount
+                self.dirty.add(key)
+            if self.failing_since is None:
+                self.failing_since = time.monotonic()
+                logger.error("Rate limiter lost Redis", extra={"limiter": self.name, "error": repr(exc)})
+            return
+
+        if self.failing_since is not None:
+            logger.info("Rate limiter reached Redis again", extra={"limiter": self.name})
+        self.failing_since = None
+        for (key, counter, amount), total in zip(batch, results[::2]):
+            counter.flushing -= amount
+            counter.pending -= amount
+            counter.synced = max(counter.synced, total)
+
+    def expire(self):
+        window = int(time.time() // self.seconds)
+        for key in [key for key, counter in self.counters.items() if counter.window < window]:
+            del self.counters[key]
+            self.dirty.discard(key)
+
+    async def sync_forever(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            self.expire()
+            try:
+                await self.flush()
+            except Exception as exc:
+                logger.error("Rate limiter sync failed", extra={"limiter": self.name, "error": repr(exc)})
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.sync_forever())
+
+    async def stop(self):
+        await cancel_tasks(self.task)
+        self.task = None
+        # Requests admitted since the last sync still count for the other workers
+        await self.flush()
+        if self.redis_client is not None:
+            await self.redis_client.close()
+            self.redis_client = None
+
+
+def client_ip(request: Request) -> str:
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimiter:
+    def __init__(self, limiter: HybridRateLimiter):
+        self.limiter = limiter
+
+    async def __call__(self, request: Request):
+        await self.limiter.hit(f"ip:{client_ip(request)}")
+
+
+def build_limiter(name: str, times: int, seconds: int) -> HybridRateLimiter:
+    return HybridRateLimiter(
+        name,
+        times=times,
+        seconds=seconds,
+        sync_interval=settings.throttler_sync_interval_ms / 1000,
+        overshoot=settings.throttler_overshoot,
+        fail_open=settings.throttler_fail_open,
+        stale_after=settings.throttler_stale_after,
+    )
+
+
+public_limiter = build_limiter("public", settings.throttler_times, settings.throttler_seconds)
+app_limiter = build_limiter("app", settings.throttler_app_times, settings.throttler_seconds)
+doh_limiter = build_limiter("doh", settings.throttler_doh_times, settings.throttler_seconds)
+rate_limiters = [public_limiter, app_limiter, doh_limiter]
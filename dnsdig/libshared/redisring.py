@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import time
+from bisect import bisect
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+from dnsdig.libshared.logging import logger
+
+Command = Tuple[str, str, Tuple[Any, ...]]
+
+
+class NoHealthyNodes(ConnectionError):
+    pass
+
+
+class RedisNode:
+    def __init__(self, url: str, client: redis.Redis):
+        self.url = url
+        self.client = client
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+
+class HashRing:
+    def __init__(self, nodes: List[str], vnodes: int = 160):
+        # Ketama: every node owns many points on a 32 bit circle, adding or removing a node only moves
+        # the keys between its points and their neighbours, about 1/N of all keys
+        self.points: List[int] = []
+        self.owners: List[str] = []
+        ring = []
+        for node in nodes:
+            for replica in range(vnodes // 4):
+                digest = hashlib.md5(f"{node}-{replica}".encode()).digest()
+                for offset in range(0, 16, 4):
+                    ring.append((int.from_bytes(digest[offset : offset + 4], "little"), node))
+        for point, node in sorted(ring):
+            self.points.append(point)
+            self.owners.append(node)
+
+    @classmethod
+    def hash_key(cls, key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], "little")
+
+    def walk(self, key: str):
+        # Owners clockwise from the key, each node once, so callers can skip unhealthy ones
+        start = bisect(self.points, self.hash_key(key))
+        seen = set()
+        for index in range(len(self.points)):
+            node = self.owners[(start + index) % len(self.points)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+class ShardedRedis:
+    def __init__(
+        self,
+        urls: List[str],
+        vnodes: int = 160,
+        eject_failures: int = 3,
+        eject_seconds: float = 10.0,
+        pinned_prefixes: Tuple[str, ...] = (),
+    ):
+        self.nodes = {url: RedisNode(url, redis.from_url(url, encoding="utf-8", decode_responses=True)) for url in urls}
+        self.ring = HashRing(urls, vnodes=vnodes)
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        # Keys that only their own node holds, e.g. the blocklist, a miss on the next node would be a wrong answer
+        self.pinned_prefixes = pinned_prefixes
+
+    def node_for(self, key: str) -> RedisNode:
+        for url in self.ring.walk(key):
+            node = self.nodes[url]
+            if node.healthy:
+                return node
+            if key.startswith(self.pinned_prefixes):
+                raise NoHealthyNodes(f"Redis node {url} holding {key} is ejected")
+        raise NoHealthyNodes("No healthy Redis nodes")
+
+    def _succeeded(self, node: RedisNode):
+        node.failures = 0
+
+    def _failed(self, node: RedisNode, exc: Exception):
+        node.failures += 1
+        if node.failures >= self.eject_failures and node.healthy:
+            # Keys move to the next node on the ring until the node gets another chance
+            node.ejected_until = time.monotonic() + self.eject_seconds
+            logger.error("Ejected Redis node", extra={"node": node.url, "error": repr(exc)})
+
+    async def _call(self, key: str, method: str, *args, **kwargs) -> Any:
+        node = self.node_for(key)
+        try:
+            result = await getattr(node.client, method)(key, *args, **kwargs)
+        except (ConnectionError, TimeoutError, OSError) as exc:
+            self._failed(node, exc)
+            raise
+        self._succeeded(node)
+        return result
+
+    async def get(self, key: str) -> str | None:
+        return await self._call(key, "get")
+
+    async def set(self, key: str, value: Any, ex: int | None = None) -> Any:
+        return await self._call(key, "set", value, ex=ex)
+
+    async def delete(self, key: str) -> int:
+        return await self._call(key, "delete")
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        return await self._call(key, "expire", seconds)
+
+    async def hget(self, key: str, field: str) -> str | None:
+        return await self._call(key, "hget", field)
+
+    async def hset(self, key: str, field: str, value: Any) -> int:
+        return await self._call(key, "hset", field, value)
+
+    async def hgetall(self, key: str) -> Dict[str, str]:
+        return await self._call(key, "hgetall")
+
+    async def execute_many(self, commands: List[Command]) -> List[Any]:
+        # One pipeline per node, all nodes in parallel, results come back in the order of the commands
+        batches: Dict[str, List[Tuple[int, Command]]] = defaultdict(list)
+        for index, command in enumerate(commands):
+            batches[self.node_for(command[0]).url].append((index, command))
+
+        async def _run(url: str, batch: List[Tuple[int, Command]]) -> List[Tuple[int, Any]]:
+            node = self.nodes[url]
+            pipeline = node.client.pipeline(transaction=False)
+            for _, (key, method, args) in batch:
+                getattr(pipeline, method)(key, *args)
+            try:
+                results = await pipeline.execute()
+            except (ConnectionError, TimeoutError, OSError) as exc:
+                self._failed(node, exc)
+                raise
+            self._succeeded(node)
+            return [(index, result) for (index, _), result in zip(batch, results)]
+
+        results: List[Any] = [None] * len(commands)
+        for batch in await asyncio.gather(*[_run(url, batch) for url, batch in batches.items()]):
+            for index, result in batch:
+                results[index] = result
+        return results
+
+    async def mget(self, keys: List[str]) -> List[str | None]:
+        return await self.execute_many([(key, "get", ()) for key in keys])
+
+    async def close(self):
+        for node in self.nodes.values():
+            await node.client.close()
@@ -27,6 +27,9 @@ class Settings(BaseSettings):
     auth_jwks_url: str
     auth_jwt_algo: str
     auth_provider_host: str
+    auth_jwks_refresh_interval: int = 3600
+    auth_jwks_min_refetch_interval: int = 30
+    auth_jwt_claims_cache_size: int = 10000
     auth_provider_client_id: str
     auth_provider_client_secret: str
     auth_provider_redirect_uri: str
@@ -36,9 +39,48 @@ class Settings(BaseSettings):
     sentry_dsn: str | None = None
     sentry_sample_rate: float | None = 0.1
 
+    # Resolver
+    resolver_iterative: bool = False
+    resolver_batch_max_lookups: int = 1000
+    resolver_batch_concurrency: int = 20
+    resolver_batch_max_body_bytes: int = 1048576
+
+    # Response cache
+    response_cache_max_ttl: int = 3600
+    response_cache_negative_ttl: int = 30
+
+    # Resolver answers and geolocations shared by the workers of a host
+    shared_cache_path: str | None = "/dev/shm/dnsdig-shared-cache"
+    shared_cache_slots: int = 16384
+    shared_cache_slot_size: int = 2048
+    shared_cache_geo_ttl: int = 86400
+
+    # Metrics of the API workers of a host, merged by whichever worker serves /metrics
+    metrics_dir: str | None = "/dev/shm/dnsdig-metrics"
+    metrics_sync_interval: float = 5.0
+
+    # Tracing, off unless traces have somewhere to go
+    tracing_export_path: str | None = None
+    tracing_otlp_endpoint: str | None = None
+    tracing_slow_ms: float = 500.0
+    tracing_sample_rate: float = 0.01
+    tracing_max_spans: int = 256
+    tracing_queue_size: int = 1000
+    tracing_flush_interval: float = 5.0
+
+    # Principal cache
+    principal_cache_size: int = 10000
+    principal_cache_ttl: int = 60
+
     # Throttler
     throttler_times: int = 30
     throttler_seconds: int = 60
+    throttler_app_times: int = 0
+    throttler_doh_times: int = 600
+    throttler_sync_interval_ms: int = 100
+    throttler_overshoot: float = 0.1
+    throttler_fail_open: bool = True
+    throttler_stale_after: float = 5.0
 
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
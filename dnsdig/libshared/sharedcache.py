@@ -0,0 +1,145 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Tuple
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import Counter
+from dnsdig.libshared.settings import settings
+
+shared_cache_lookups = Counter("dnsdig_shared_cache_lookups", "Lookups in the cache shared by the workers", ["result"])
+
+MAGIC = b"DDSC0001"
+# magic, slots, slot size, ways
+FILE_HEADER = struct.Struct("<8sIII")
+# seq, key length, value length, crc, expires at, key hash
+SLOT_HEADER = struct.Struct("<IHIIdQ")
+SEQ = struct.Struct("<I")
+
+
+class SharedCache:
+    def __init__(self, path: str | None, slots: int = 16384, slot_size: int = 2048, ways: int = 4):
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        self.slots = self.buckets * ways
+        self.slot_size = slot_size
+        # Other workers may still have an older layout mapped, a file is never resized so each layout gets its own
+        self.path = f"{path}-{self.slots}x{slot_size}x{ways}" if path else path
+        self.size = FILE_HEADER.size + self.slots * slot_size
+        self.fd: int | None = None
+        self.mm: mmap.mmap | None = None
+        self.disabled = not path
+
+    def open(self) -> bool:
+        if self.mm is not None:
+            return True
+        if self.disabled:
+            return False
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            # Every worker opens the file, whoever comes first lays it out
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, FILE_HEADER.size, 0)
+            try:
+                expected = FILE_HEADER.pack(MAGIC, self.slots, self.slot_size, self.ways)
+                if os.fstat(self.fd).st_size == 0:
+                    os.ftruncate(self.fd, self.size)
+                    os.pwrite(self.fd, expected, 0)
+                elif os.pread(self.fd, FILE_HEADER.size, 0) != expected or os.fstat(self.fd).st_size != self.size:
+                    raise OSError(f"{self.path} is not laid out for this cache")
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, FILE_HEADER.size, 0)
+            self.mm = mmap.mmap(self.fd, self.size)
+        except OSError as exc:
+            logger.warning("Shared cache unavailable", extra={"path": self.path, "error": repr(exc)})
+            self.disabled = True
+            return False
+        return True
+
+    @classmethod
+    def hash_key(cls, key: bytes) -> int:
+        # hash() is salted per process, workers need the same slot for the same key
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+    def offset(self, bucket: int, way: int) -> int:
+        return FILE_HEADER.size + (bucket * self.ways + way) * self.slot_size
+
+    def get(self, key: str) -> Tuple[bytes, float] | None:
+        if not self.open():
+            return None
+        raw_key = key.encode()
+        key_hash = self.hash_key(raw_key)
+        bucket = key_hash % self.buckets
+        now = time.time()
+        for way in range(self.ways):
+            offset = self.offset(bucket, way)
+            # Seqlock read, an odd sequence or one that moved while copying means a writer was in the slot
+            seq, key_len, value_len, crc, expires_at, slot_hash = SLOT_HEADER.unpack_from(self.mm, offset)
+            if seq & 1 or slot_hash != key_hash or key_len != len(raw_key):
+                continue
+            start = offset + SLOT_HEADER.size
+            data = self.mm[start : start + key_len + value_len]
+            if SEQ.unpack_from(self.mm, offset)[0] != seq:
+                break
+            meta = SLOT_HEADER.pack(0, key_len, value_len, 0, expires_at, slot_hash)
+            if zlib.crc32(data, zlib.crc32(meta)) != crc or data[:key_len] != raw_key:
+                continue
+            if expires_at <= now:
+                break
+            shared_cache_lookups.inc("hit")
+            return data[key_len:], expires_at
+        shared_cache_lookups.inc("miss")
+        return None
+
+    def set(self, key: str, value: bytes, ttl: float):
+        if ttl <= 0 or not self.open():
+            return
+        raw_key = key.encode()
+        if SLOT_HEADER.size + len(raw_key) + len(value) > self.slot_size:
+            return
+        key_hash = self.hash_key(raw_key)
+        bucket = key_hash % self.buckets
+        bucket_start = self.offset(bucket, 0)
+        now = time.time()
+
+        # Writers take turns per bucket, readers never wait
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.ways * self.slot_size, bucket_start)
+        try:
+            # The same key, else a free or expired slot, else the one closest to expiring
+            candidates = []
+            for way in range(self.ways):
+                offset = self.offset(bucket, way)
+                seq, key_len, _, _, expires_at, slot_hash = SLOT_HEADER.unpack_from(self.mm, offset)
+                if slot_hash == key_hash and key_len == len(raw_key):
+                    candidates = [(float("-inf"), offset, seq)]
+                    break
+                candidates.append((expires_at if key_len and expires_at > now else 0.0, offset, seq))
+            _, offset, seq = min(candidates)
+
+            expires_at = now + ttl
+            data = raw_key + value
+            meta = SLOT_HEADER.pack(0, len(raw_key), len(value), 0, expires_at, key_hash)
+            crc = zlib.crc32(data, zlib.crc32(meta))
+            # Odd while writing, also when a writer died half way through the slot before
+            writing = ((seq + 1) | 1) & 0xFFFFFFFF
+            SEQ.pack_into(self.mm, offset, writing)
+            SLOT_HEADER.pack_into(self.mm, offset, writing, len(raw_key), len(value), crc, expires_at, key_hash)
+            start = offset + SLOT_HEADER.size
+            self.mm[start : start + len(data)] = data
+            SEQ.pack_into(self.mm, offset, (writing + 1) & 0xFFFFFFFF)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.ways * self.slot_size, bucket_start)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            os.close(self.fd)
+            self.mm, self.fd = None, None
+
+
+shared_cache = SharedCache(
+    settings.shared_cache_path, slots=settings.shared_cache_slots, slot_size=settings.shared_cache_slot_size
+)
@@ -0,0 +1,259 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from contextvars import ContextVar, Token
+from typing import Any, Deque, Dict, List, Tuple, Type
+
+import ujson
+
+from dnsdig.libshared.logging import logger
+from dnsdig.libshared.metrics import Counter
+from dnsdig.libshared.settings import settings
+from dnsdig.libshared.utils import cancel_tasks
+
+traces = Counter("dnsdig_traces", "Finished traces by tail sampling decision", ["decision"])
+
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "dropped")
+
+    def __init__(self, trace_id: str | None = None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.spans: List["Span"] = []
+        self.dropped = 0
+
+
+class Span:
+    __slots__ = (
+        "tracer",
+        "trace",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "expected",
+        "start_ns",
+        "end_ns",
+        "error",
+        "token",
+    )
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        trace: Trace,
+        name: str,
+        parent_id: str | None,
+        attributes: Dict[str, Any],
+        expected: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.tracer = tracer
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.expected = expected
+        self.start_ns = self.end_ns = 0
+        self.error = False
+        self.token: Token | None = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.start_ns = time.time_ns()
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.attributes["exception"] = repr(exc)
+            # Client errors and answers like NXDOMAIN are part of normal traffic, they should not force a trace out
+            client_error = getattr(exc, "status_code", 500) < 500
+            self.error = not (client_error or issubclass(exc_type, (asyncio.CancelledError, *self.expected)))
+        # Spans are only kept when the whole trace is, a runaway trace stops growing instead
+        if len(self.trace.spans) < self.tracer.max_spans:
+            self.trace.spans.append(self)
+        else:
+            self.trace.dropped += 1
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": STATUS_ERROR if self.error else STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def __enter__(self) -> "NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def parse_traceparent(header: str | None) -> tuple[str | None, str | None]:
+    # W3C trace context, version-traceid-parentid-flags
+    parts = (header or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None, None
+    return parts[1], parts[2]
+
+
+class Tracer:
+    def __init__(
+        self,
+        service: str,
+        export_path: str | None = None,
+        otlp_endpoint: str | None = None,
+        slow_ms: float = 500.0,
+        sample_rate: float = 0.01,
+        max_spans: int = 256,
+        queue_size: int = 1000,
+        flush_interval: float = 5.0,
+    ):
+        self.service = service
+        self.export_path = export_path
+        self.otlp_endpoint = otlp_endpoint
+        self.enabled = bool(export_path or otlp_endpoint)
+        self.slow_ns = slow_ms * 1e6
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.flush_interval = flush_interval
+        self.pending: Deque[List[Span]] = deque(maxlen=queue_size)
+        self.task: asyncio.Task | None = None
+
+    def span(self, name: str, expected: Tuple[Type[BaseException], ...] = (), **attributes) -> Span | NoopSpan:
+        # Outside a request there is nothing to attach to, and that path has to stay close to free
+        parent = current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(self, parent.trace, name, parent.span_id, attributes, expected)
+
+    def root(self, name: str, traceparent: str | None = None, **attributes) -> Span | NoopSpan:
+        if not self.enabled:
+            return NOOP_SPAN
+        trace_id, parent_id = parse_traceparent(traceparent)
+        return Span(self, Trace(trace_id), name, parent_id, attributes)
+
+    def keep(self, root: Span) -> bool:
+        # Tail sampling, decided once the whole request is known: slow and failed requests are always kept
+        if root.error or any(span.error for span in root.trace.spans):
+            return True
+        if root.end_ns - root.start_ns >= self.slow_ns:
+            return True
+        return random.random() < self.sample_rate
+
+    def finish(self, root: Span | NoopSpan):
+        if not isinstance(root, Span):
+            return
+        if not self.keep(root):
+            traces.inc("dropped")
+            return
+        if len(self.pending) == self.pending.maxlen:
+            traces.inc("overflow")
+        traces.inc("kept")
+        self.pending.append(root.trace.spans)
+
+    def payload(self, batch: List[List[Span]]) -> Dict[str, Any]:
+        resource = {"attributes": [{"key": "service.name", "value": {"stringValue": self.service}}]}
+        spans = [span.to_otlp() for trace in batch for span in trace]
+        return {
+            "resourceSpans": [{"resource": resource, "scopeSpans": [{"scope": {"name": "dnsdig"}, "spans": spans}]}]
+        }
+
+    def write(self, body: str):
+        with open(self.export_path, "a") as export:
+            export.write(body + "\n")
+
+    async def export(self, session=None):
+        if not self.pending:
+            return
+        batch = [self.pending.popleft() for _ in range(len(self.pending))]
+        body = ujson.dumps(self.payload(batch))
+        if self.export_path:
+            await asyncio.to_thread(self.write, body)
+        if self.otlp_endpoint and session is not None:
+            headers = {"Content-Type": "application/json"}
+            async with session.post(self.otlp_endpoint, data=body, headers=headers) as response:
+                if response.status >= 400:
+                    logger.error("Trace export rejected", extra={"status": response.status})
+
+    async def export_forever(self):
+        import aiohttp
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            try:
+                while True:
+                    await asyncio.sleep(self.flush_interval)
+                    try:
+                        await self.export(session)
+                    except Exception as exc:
+                        logger.error("Failed to export traces", extra={"error": repr(exc)})
+            finally:
+                # Traces kept since the last batch still go out when the worker shuts down
+                try:
+                    await self.export(session)
+                except Exception as exc:
+                    logger.error("Failed to export traces", extra={"error": repr(exc)})
+
+    def start(self):
+        if self.enabled and self.task is None:
+            self.task = asyncio.create_task(self.export_forever())
+
+    async def stop(self):
+        await cancel_tasks(self.task)
+        self.task = None
+
+
+tracer = Tracer(
+    service=settings.app_name,
+    export_path=settings.tracing_export_path,
+    otlp_endpoint=settings.tracing_otlp_endpoint,
+    slow_ms=settings.tracing_slow_ms,
+    sample_rate=settings.tracing_sample_rate,
+    max_spans=settings.tracing_max_spans,
+    queue_size=settings.tracing_queue_size,
+    flush_interval=settings.tracing_flush_interval,
+)
@@ -1,6 +1,15 @@
+import asyncio
 import random
 import string
 
 
 def random_chars(length: int = 7) -> str:
     return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length)).lower()
+
+
+async def cancel_tasks(*tasks: asyncio.Task | None):
+    tasks = [task for task in tasks if task is not None]
+    for task in tasks:
+        task.cancel()
+    # Waiting lets each task run its cleanup, closing the clients it opened, before the loop goes away
+    await asyncio.gather(*tasks, return_exceptions=True)
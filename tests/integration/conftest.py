@@ -15,7 +15,7 @@ from dnsdig.appdnsdigapi.web import app as dnsdig_app
 from dnsdig.libaccount.domains.account import Account
 from dnsdig.libaccount.models.auth import resolver_role, Permissions
 from dnsdig.libaccount.models.mongo import User, OAuthSession
-from dnsdig.libshared.models import mongo_client
+from dnsdig.libshared.models import get_mongo_client
 from dnsdig.libshared.settings import settings
 from dnsdig.libshared.utils import random_chars
 
@@ -29,7 +29,7 @@ def event_loop():
 
 @pytest_asyncio.fixture(scope="session", autouse=True)
 async def beanie():
-    await init_beanie(database=mongo_client[settings.db_name], document_models=[User, OAuthSession])
+    await init_beanie(database=get_mongo_client()[settings.db_name], document_models=[User, OAuthSession])
 
 
 @pytest_asyncio.fixture(scope="function")
@@ -80,6 +80,9 @@ class FakeContext:
             current_user=current_user,
         )
 
+    async def charge(self, cost: int):
+        pass
+
     @classmethod
     @asynccontextmanager
     async def public(cls, mongo_session: motor_asyncio.AsyncIOMotorClientSession | None = None):
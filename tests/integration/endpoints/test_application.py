@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from faker import Faker
 from fastapi.testclient import TestClient
 
@@ -158,3 +160,60 @@ def test_exchange_refresh_token(client: TestClient):
         assert new_refresh_token != refresh_token
         assert resp_body.get("expiresIn")
         assert resp_body.get("tokenType") == "bearer"
+
+        payload = {"refresh_token": refresh_token, "grant_type": "refresh_token"}
+        response = client.post("/v1/oauth2/token", json=payload)
+
+        assert response.status_code == 400
+
+
+def test_exchange_refresh_token_concurrently(client: TestClient):
+    with client:
+        headers = {"authorization": "Bearer 123"}
+        payload = {"name": f"{fake.first_name()} {fake.last_name()}", "description": fake.sentence()}
+        resp_body = client.post("/v1/me/applications", headers=headers, json=payload).json()
+
+        payload = {
+            "client_id": resp_body.get("clientId"),
+            "client_secret": resp_body.get("clientSecret"),
+            "grant_type": "client_credentials",
+        }
+        refresh_token = client.post("/v1/oauth2/token", json=payload).json().get("refreshToken")
+
+        payload = {"refresh_token": refresh_token, "grant_type": "refresh_token"}
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            responses = list(executor.map(lambda _: client.post("/v1/oauth2/token", json=payload), range(5)))
+
+        assert sorted(response.status_code for response in responses) == [200, 400, 400, 400, 400]
+
+
+def test_revoke_application_tokens(client: TestClient):
+    with client:
+        headers = {"authorization": "Bearer 123"}
+        payload = {"name": f"{fake.first_name()} {fake.last_name()}", "description": fake.sentence()}
+        response = client.post("/v1/me/applications", headers=headers, json=payload)
+        resp_body = response.json()
+        client_id = resp_body.get("clientId")
+        client_secret = resp_body.get("clientSecret")
+
+        payload = {"client_id": client_id, "client_secret": client_secret, "grant_type": "client_credentials"}
+        response = client.post("/v1/oauth2/token", json=payload)
+        refresh_token = response.json().get("refreshToken")
+
+        assert response.status_code == 200
+
+        response = client.delete(f"/v1/me/applications/{client_id}/tokens", headers=headers)
+        resp_body = response.json()
+
+        assert response.status_code == 200
+        assert resp_body.get("clientId") == client_id
+        assert resp_body.get("revoked") == 2
+
+        payload = {"refresh_token": refresh_token, "grant_type": "refresh_token"}
+        response = client.post("/v1/oauth2/token", json=payload)
+
+        assert response.status_code == 400
+
+        response = client.delete("/v1/me/applications/m2m-unknown/tokens", headers=headers)
+
+        assert response.status_code == 404
@@ -22,3 +22,13 @@ def test_api_docs(client: TestClient):
         response = client.get("/docs")
 
         assert response.status_code == 200
+
+
+def test_metrics(client: TestClient):
+    with client:
+        client.get("/healthcheck")
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'dnsdig_http_requests_total{method="GET",route="/healthcheck",status="200"}' in response.text
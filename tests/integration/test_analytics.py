@@ -0,0 +1,108 @@
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List
+
+import pytest
+from beanie import init_beanie
+from dns.rdatatype import RdataType
+
+from dnsdig.appdnsdigd.analyticsmongo import (
+    Analytics,
+    AnalyticsHourRollup,
+    AnalyticsMeta,
+    AnalyticsMinuteRollup,
+    LatencySketch,
+    SketchBin,
+    StatsTimeframes,
+)
+from dnsdig.libshared.models import get_mongo_client
+from dnsdig.libshared.settings import settings
+
+
+def sketch_of(values: List[float]) -> List[SketchBin]:
+    return [SketchBin(index=index, count=count) for index, count in Counter(map(LatencySketch.index, values)).items()]
+
+
+async def init_analytics():
+    collections = [Analytics, AnalyticsMinuteRollup, AnalyticsHourRollup]
+    await init_beanie(database=get_mongo_client()[settings.db_name], document_models=collections)
+
+
+def test_latency_sketch_quantiles_are_within_its_accuracy():
+    rng = random.Random(5)
+    values = [rng.lognormvariate(3, 1) for _ in range(10000)]
+    first, second = Counter(map(LatencySketch.index, values[:3000])), Counter(map(LatencySketch.index, values[3000:]))
+
+    # Merging is adding up bins, the merged sketch is the sketch of all values
+    merged = first + second
+    assert merged == Counter(map(LatencySketch.index, values))
+
+    ranked = sorted(values)
+    qs = [0.5, 0.75, 0.99]
+    for q, estimate in zip(qs, LatencySketch.quantiles(merged, qs)):
+        exact = ranked[int(q * (len(values) - 1))]
+        assert abs(estimate - exact) <= exact * LatencySketch.relative_accuracy
+
+
+@pytest.mark.asyncio
+async def test_rollups_merge_sketches():
+    await init_analytics()
+    # An hour no other run writes to, the rollups of it are read back directly
+    hour = datetime(2001, 1, 1) + timedelta(hours=random.randint(0, 100000))
+    minutes = {hour + timedelta(minutes=1): [1.0, 2.0, 3.0, 4.0], hour + timedelta(minutes=2): [10.0, 100.0]}
+    await Analytics.insert_many(
+        [
+            Analytics(
+                created_at=minute + timedelta(seconds=second),
+                meta=AnalyticsMeta(name="example.com.", record_type=RdataType.A),
+                resolve_time=value,
+                ttl=300,
+            )
+            for minute, values in minutes.items()
+            for second, value in enumerate(values)
+        ]
+    )
+
+    await Analytics.rollup(since=hour, until=hour + timedelta(hours=1))
+    await AnalyticsMinuteRollup.rollup(since=hour, until=hour + timedelta(hours=1))
+
+    for minute, values in minutes.items():
+        rollup = await AnalyticsMinuteRollup.find_one(AnalyticsMinuteRollup.bucket == minute)
+        assert (rollup.samples, rollup.total) == (len(values), sum(values))
+        assert (rollup.minimum, rollup.maximum) == (min(values), max(values))
+        assert {(b.index, b.count) for b in rollup.sketch} == {(b.index, b.count) for b in sketch_of(values)}
+
+    rollup = await AnalyticsHourRollup.find_one(AnalyticsHourRollup.bucket == hour)
+    values = [value for values in minutes.values() for value in values]
+    assert (rollup.samples, rollup.total, rollup.minimum, rollup.maximum) == (6, 120.0, 1.0, 100.0)
+    assert {(b.index, b.count) for b in rollup.sketch} == {(b.index, b.count) for b in sketch_of(values)}
+
+
+@pytest.mark.asyncio
+async def test_statistics_merge_the_sketches_of_the_timeframe():
+    await init_analytics()
+    await AnalyticsMinuteRollup.delete_all()
+    rng = random.Random(9)
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    fast, slow = [rng.uniform(1, 5) for _ in range(900)], [rng.uniform(50, 500) for _ in range(100)]
+    for minute, values in ((now - timedelta(minutes=2), fast), (now - timedelta(minutes=1), slow)):
+        await AnalyticsMinuteRollup(
+            bucket=minute,
+            record_type=RdataType.A,
+            samples=len(values),
+            total=sum(values),
+            minimum=min(values),
+            maximum=max(values),
+            sketch=sketch_of(values),
+        ).insert()
+
+    stats = await Analytics.statistics(StatsTimeframes.Minutes15)
+
+    # A weighted mean of the two medians would be far above every fast query, the real median is a fast one
+    ranked = sorted(fast + slow)
+    assert stats.average == pytest.approx(sum(ranked) / len(ranked))
+    assert (stats.minimum, stats.maximum) == (ranked[0], ranked[-1])
+    assert stats.median == pytest.approx(ranked[499], rel=LatencySketch.relative_accuracy)
+    assert stats.percentiles[0] == pytest.approx(ranked[749], rel=LatencySketch.relative_accuracy)
+    assert stats.percentiles[1] == pytest.approx(ranked[989], rel=LatencySketch.relative_accuracy)
@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import dns.rdata
+import pytest
+import ujson
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from dnsdig.appdnsdigapi import batch, views
+from dnsdig.appdnsdigapi.batch import LimitedBodyRoute
+from dnsdig.appdnsdigapi.cache import ResponseCache
+from dnsdig.libdns.domains.resolver import Resolver
+from dnsdig.libaccount.models.auth import Permissions
+from dnsdig.libdns.models.resolver import BatchLookup, BatchResolveRequest
+from dnsdig.libshared.context import Context
+from dnsdig.libshared.ratelimit import app_limiter
+from dnsdig.libshared.settings import settings
+from tests.integration.test_response_cache import DictRedis
+
+
+@pytest.mark.asyncio
+async def test_batch_streams_unique_lookups_with_bounded_concurrency(monkeypatch):
+    cache = ResponseCache("redis://localhost")
+    cache.redis_client = DictRedis()
+    monkeypatch.setattr(batch, "response_cache", cache)
+
+    running, peak, calls = 0, 0, []
+    others_done = asyncio.Event()
+
+    async def resolve_record(cls, hostname, record_type, **kwargs):
+        nonlocal running, peak
+        calls.append((hostname, record_type))
+        running += 1
+        peak = max(peak, running)
+        # The slow name only finishes once every other lookup did, lines come back in completion order
+        if hostname == "slow.example.com":
+            await others_done.wait()
+        else:
+            await asyncio.sleep(0)
+        running -= 1
+        if len(calls) == 14 and running == 1:
+            others_done.set()
+        if hostname == "broken.example.com":
+            raise TimeoutError()
+        return {
+            "metadata": [],
+            "google": [Resolver._parse_txt_result(dns.rdata.from_text("IN", "TXT", f'"{hostname}"'), 300)],
+        }
+
+    monkeypatch.setattr(Resolver, "resolve_record", classmethod(resolve_record))
+
+    payload = BatchResolveRequest.model_validate(
+        {
+            "lookups": [
+                {"name": "slow.example.com", "types": ["TXT"]},
+                {"name": "Example.com.", "types": ["TXT", "MX"]},
+                {"name": "example.com", "types": ["TXT"]},
+                {"name": "broken.example.com", "types": ["TXT"]},
+            ]
+            + [{"name": f"{n}.example.com", "types": ["TXT"]} for n in range(10)]
+        }
+    )
+    lookups = batch.unique_lookups(payload.lookups)
+    lines = [ujson.loads(line) async for line in batch.stream_lookups(lookups, concurrency=3)]
+
+    assert len(lookups) == len(lines) == len(calls) == 14
+    assert peak <= 3
+    assert lines[-1]["name"] == "slow.example.com"
+    assert lines[0]["result"] == {"metadata": [], "google": [{"txt": "example.com", "ttl": 300}]}
+    assert [line["error"] for line in lines if line["name"] == "broken.example.com"] == ["TimeoutError()"]
+
+
+def test_oversized_batches_are_refused_before_they_are_parsed():
+    class SmallBodyRoute(LimitedBodyRoute):
+        max_body_bytes = 64
+
+    router = APIRouter(route_class=SmallBodyRoute)
+
+    @router.post("/resolve/batch")
+    async def resolve_batch(payload: BatchResolveRequest):
+        return len(payload.lookups)
+
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+    small = {"lookups": [{"name": "example.com"}]}
+    large = ujson.dumps({"lookups": [{"name": "example.com"}] * 10}).encode()
+
+    assert client.post("/resolve/batch", json=small).json() == 1
+    assert client.post("/resolve/batch", content=large).status_code == 413
+    # Without a Content-Length the body is counted while it is read
+    assert client.post("/resolve/batch", content=iter([large[:50], large[50:]])).status_code == 413
+
+    with pytest.raises(ValidationError):
+        BatchResolveRequest.model_validate({"lookups": [{"name": "example.com"}] * 1001})
+    with pytest.raises(ValidationError):
+        BatchLookup.model_validate({"name": "example.com", "types": ["A"] * 20})
+
+
+def test_batches_are_authenticated_before_their_size_is_checked(monkeypatch):
+    async def m2m_principal(self):
+        app = SimpleNamespace(client_id="app-1", permissions=[Permissions.ReadResolver])
+        return SimpleNamespace(user=SimpleNamespace(is_blocked=False), app=app, expires_at=datetime.max)
+
+    async def hit(key: str, cost: int = 1):
+        charged.append((key, cost))
+
+    async def resolve_line(name, record_type) -> bytes:
+        return ujson.dumps({"name": name, "type": record_type.value}).encode() + b"\n"
+
+    charged = []
+    monkeypatch.setattr(Context, "_m2m_principal", m2m_principal)
+    monkeypatch.setattr(app_limiter, "times", 100)
+    monkeypatch.setattr(app_limiter, "hit", hit)
+    monkeypatch.setattr(batch, "resolve_line", resolve_line)
+    monkeypatch.setattr(settings, "resolver_batch_max_lookups", 2)
+    app = FastAPI()
+    app.include_router(views.batch_router)
+    client = TestClient(app)
+    headers = {"authorization": "Bearer m2m-token"}
+    too_many = {"lookups": [{"name": "example.com", "types": ["A", "AAAA", "MX"]}]}
+
+    assert client.post("/resolve/batch", json=too_many).status_code == 401
+    assert client.post("/resolve/batch", json=too_many, headers=headers).status_code == 413
+    assert charged == []
+
+    response = client.post(
+        "/resolve/batch", json={"lookups": [{"name": "example.com", "types": ["A", "MX"]}]}, headers=headers
+    )
+    assert len(response.text.splitlines()) == 2
+    assert charged == [("app:app-1", 2)]
@@ -0,0 +1,72 @@
+import pytest
+from aiohttp import web
+
+from dnsdig.appdnsdigbench.loadgen import HttpLoadGenerator, LoadGenerator, QueryMix
+from dnsdig.appdnsdigbench.report import BenchmarkReport, parse_metrics, cache_summary
+from dnsdig.appdnsdigbench.stubupstream import StubUpstream, StubUpstreamConfig, serve_udp
+
+
+@pytest.mark.asyncio
+async def test_loadgen_against_stub_upstream():
+    upstream = StubUpstream(StubUpstreamConfig(latency_ms=1, latency_jitter_ms=0.5))
+    transport = await serve_udp(upstream, host="127.0.0.1", port=15300)
+
+    try:
+        generator = LoadGenerator(host="127.0.0.1", port=15300, qps=500, duration=1, mix=QueryMix(names=100))
+        result = await generator.run()
+    finally:
+        transport.close()
+
+    report = BenchmarkReport.from_result(result, target="127.0.0.1:15300", qps_target=500)
+
+    assert result.sent > 0
+    assert result.received == upstream.queries
+    assert report.timeouts == 0
+    assert report.latency_ms.p50 <= report.latency_ms.p99 <= report.latency_ms.p999
+
+
+@pytest.mark.asyncio
+async def test_http_loadgen_against_a_local_server():
+    requested = []
+
+    async def freesolve(request: web.Request) -> web.Response:
+        requested.append(request.match_info["name"])
+        # Every tenth request is throttled
+        if len(requested) % 10 == 0:
+            return web.json_response({"detail": "Too Many Requests"}, status=429)
+        return web.json_response({"A": []})
+
+    server = web.Application()
+    server.router.add_get("/v1/freesolve/{name}", freesolve)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 15380).start()
+
+    try:
+        generator = HttpLoadGenerator(
+            base_url="http://127.0.0.1:15380", path="/v1/freesolve/{name}", rps=200, duration=1, mix=QueryMix(names=50)
+        )
+        result = await generator.run()
+    finally:
+        await runner.cleanup()
+
+    assert result.sent == len(requested) > 0
+    assert all(name.endswith(".bench.test") for name in requested)
+    assert result.errors == len(requested) // 10
+    assert result.received + result.errors == result.sent
+    assert len(result.latencies_ms) == result.received
+
+
+def test_cache_summary():
+    before = parse_metrics('dnsdigd_queries_total{qtype="A",rcode="NOERROR"} 10\n')
+    after = parse_metrics(
+        'dnsdigd_queries_total{qtype="A",rcode="NOERROR"} 110\n'
+        'dnsdigd_upstream_rtt_seconds_count{nameserver="127.0.0.1"} 25\n'
+        'dnsdigd_cache_requests_total{tier="l2",result="hit"} 75\n'
+        'dnsdigd_cache_requests_total{tier="l2",result="miss"} 25\n'
+    )
+
+    summary = cache_summary(before, after)
+
+    assert summary.hit_ratio == 0.75
+    assert summary.tiers == {"l2": 0.75}
@@ -0,0 +1,138 @@
+import asyncio
+import base64
+import time
+
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from dnsdig.appdnsdigapi import doh
+from dnsdig.appdnsdigapi.doh import DNS_MESSAGE, message_ttl, parse_base64url, parse_json, render
+from dnsdig.appdnsdigd.engine import DNSEngine, encode_cached
+
+
+class DictRedis:
+    def __init__(self):
+        self.values = {}
+
+    def node_for(self, key: str):
+        return None
+
+    async def get(self, key: str):
+        return self.values.get(key)
+
+    async def set(self, key: str, value: str, ex: int | None = None):
+        self.values[key] = value
+
+
+class SlowUpstreamEngine(DNSEngine):
+    def __init__(self):
+        super().__init__(use_cache=False)
+        self.redis_client = DictRedis()
+        self.upstream_queries = 0
+
+    async def query_upstream(self, message, nameserver, forwarded=False):
+        self.upstream_queries += 1
+        await asyncio.sleep(0.01)
+        response = dns.message.make_response(message)
+        response.answer.append(dns.rrset.from_text(message.question[0].name, 300, "IN", "A", "93.184.216.34"))
+        return response
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_upstream_query():
+    engine = SlowUpstreamEngine()
+
+    responses = await asyncio.gather(*[engine.resolve(dns.message.make_query("example.com.", "A")) for _ in range(5)])
+
+    assert engine.upstream_queries == 1
+    assert engine.inflight == {}
+    assert len({response.to_wire() for response in responses}) == 1
+    assert "dnsdigd-cache#example.com.#1" in engine.redis_client.values
+
+
+def test_doh_wire_and_json_rendering():
+    query = dns.message.make_query("example.com.", "A")
+    encoded = base64.urlsafe_b64encode(query.to_wire()).decode().rstrip("=")
+
+    assert parse_base64url(encoded).question == query.question
+    assert parse_json(b'{"Question": [{"name": "example.com.", "type": 1}]}').question == query.question
+    with pytest.raises(HTTPException) as exc:
+        parse_base64url("not-a-dns-message")
+    assert exc.value.status_code == 400
+
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text("example.com.", 300, "IN", "A", "93.184.216.34"))
+    response.authority.append(dns.rrset.from_text("example.com.", 120, "IN", "NS", "ns.example.com."))
+
+    assert message_ttl(response) == 120
+    wire = render(response, as_json=False)
+    assert wire.media_type == "application/dns-message"
+    assert wire.headers["cache-control"] == "max-age=120"
+    assert dns.message.from_wire(wire.body).answer == response.answer
+    assert b'"data":"93.184.216.34"' in render(response, as_json=True).body
+
+    nxdomain = dns.message.make_response(query)
+    nxdomain.set_rcode(dns.rcode.NXDOMAIN)
+    assert render(nxdomain, as_json=False).headers["cache-control"] == "max-age=0"
+
+
+@pytest.mark.asyncio
+async def test_cached_answers_are_served_with_the_ttl_they_have_left():
+    engine = SlowUpstreamEngine()
+    query = dns.message.make_query("example.com.", "A")
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text("example.com.", 300, "IN", "A", "93.184.216.34"))
+
+    # Cached 200 seconds ago with a TTL of 300
+    engine.redis_client.values["dnsdigd-cache#example.com.#1"] = encode_cached(response, time.time() + 100)
+    from_redis = await engine.resolve(dns.message.make_query("example.com.", "A"))
+    from_near_cache = await engine.resolve(dns.message.make_query("example.com.", "A"))
+
+    assert engine.upstream_queries == 0
+    assert 99 <= from_redis.answer[0].ttl <= 100
+    assert 99 <= from_near_cache.answer[0].ttl <= 100
+    assert render(from_near_cache, as_json=False).headers["cache-control"] in ("max-age=99", "max-age=100")
+
+
+@pytest.mark.asyncio
+async def test_a_cancelled_query_releases_the_queries_waiting_for_it():
+    engine = SlowUpstreamEngine()
+
+    first = asyncio.create_task(engine.resolve(dns.message.make_query("example.com.", "A")))
+    await asyncio.sleep(0)
+    waiting = asyncio.create_task(engine.resolve(dns.message.make_query("example.com.", "A")))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    response = await asyncio.wait_for(waiting, timeout=1)
+
+    assert first.cancelled()
+    assert response.answer[0][0].address == "93.184.216.34"
+    assert engine.upstream_queries == 2
+    assert engine.inflight == {}
+
+
+def test_post_bodies_larger_than_a_dns_message_are_refused(monkeypatch):
+    async def answer(query: dns.message.Message) -> dns.message.Message:
+        return dns.message.make_response(query)
+
+    monkeypatch.setattr(doh, "answer", answer)
+    app = FastAPI()
+    app.include_router(doh.router)
+    client = TestClient(app)
+    wire = dns.message.make_query("example.com.", "A").to_wire()
+    oversized = wire + b"\0" * 65536
+
+    response = client.post("/dns-query", content=wire, headers={"content-type": DNS_MESSAGE})
+    assert response.status_code == 200
+    assert dns.message.from_wire(response.content).question[0].name.to_text() == "example.com."
+
+    assert client.post("/dns-query", content=oversized, headers={"content-type": DNS_MESSAGE}).status_code == 413
+    # Without a Content-Length the body is counted while it is read
+    chunks = iter([oversized[:40000], oversized[40000:]])
+    assert client.post("/dns-query", content=chunks, headers={"content-type": DNS_MESSAGE}).status_code == 413
+    assert client.post("/dns-query", content=wire, headers={"content-type": "text/plain"}).status_code == 415
@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+import dns.rdata
+import dns.resolver
+import pytest
+import ujson
+
+from dnsdig.appdnsdigapi import events
+from dnsdig.appdnsdigapi.cache import ResponseCache
+from dnsdig.appdnsdigapi.views import resolve_all
+from dnsdig.libdns.constants import RecordTypes
+from dnsdig.libdns.domains.resolver import Resolver
+from dnsdig.libgeoip.domains.ip2geolocation import IP2Geo
+from dnsdig.libgeoip.models import IPLocationResult
+from dnsdig.libshared.models import ModelJSONResponse
+from tests.integration.test_response_cache import DictRedis
+
+ANSWERS = {
+    RecordTypes.A: ["93.184.216.34"],
+    RecordTypes.MX: ["10 mx.example.com."],
+    RecordTypes.TXT: ['"v=spf1 ~all"'],
+    RecordTypes.SOA: ["ns.example.com. dns.example.com. 1 7200 3600 1209600 300"],
+}
+DELAYS = {"cloudflare": 0.001, "google": 0.01, "opendns": 0.02}
+
+
+class FakeAnswer(list):
+    chaining_result = SimpleNamespace(minimum_ttl=300)
+
+
+async def query(cls, name, where, qname, rdtype):
+    await asyncio.sleep(DELAYS[name])
+    if rdtype not in ANSWERS:
+        raise dns.resolver.NoAnswer()
+    return FakeAnswer(dns.rdata.from_text("IN", rdtype.value, text) for text in ANSWERS[rdtype])
+
+
+async def parse_a_result(cls, result, ttl):
+    await asyncio.sleep(0.05)
+    return IPLocationResult(ip=result, country_iso_code="US", ttl=ttl)
+
+
+def parse_events(body: bytes):
+    for chunk in body.strip().split(b"\n\n"):
+        event, data = chunk.split(b"\n")
+        yield event.removeprefix(b"event: ").decode(), data.removeprefix(b"data: ")
+
+
+@pytest.mark.asyncio
+async def test_stream_sends_providers_as_they_answer_and_ends_with_the_resolve_body(monkeypatch):
+    monkeypatch.setattr(Resolver, "iterative", None)
+    monkeypatch.setattr(Resolver, "_query", classmethod(query))
+    monkeypatch.setattr(Resolver, "_parse_a_result", classmethod(parse_a_result))
+    cache = ResponseCache("redis://localhost")
+    cache.redis_client = DictRedis()
+    monkeypatch.setattr(events, "response_cache", cache)
+
+    stream = [event async for event in events.stream_resolve("example.com")]
+    received = list(parse_events(b"".join(stream)))
+    kinds = [kind for kind, _ in received]
+    first = ujson.loads(received[0][1])
+
+    assert (first["provider"], kinds[0]) == ("cloudflare", "answer")
+    assert kinds.count("answer") == 12 and kinds.count("enrichment") == 3 and kinds.count("error") == 3
+    assert kinds.index("enrichment") > kinds.index("answer")
+    assert received[-1][1] == ModelJSONResponse(await resolve_all("example.com")).body
+    assert ujson.loads(received[-1][1])["AAAA"] == {"metadata": [f"example.com - {dns.resolver.NoAnswer()}"]}
+
+    # A cached result is sent as the only event
+    cached = [event async for event in events.stream_resolve("example.com")]
+    assert cached == [stream[-1]]
+
+
+@pytest.mark.asyncio
+async def test_stream_ends_and_skips_the_cache_when_a_provider_fails(monkeypatch):
+    async def ip_to_location(cls, ip, ttl):
+        raise TimeoutError("ipinfo timed out")
+
+    monkeypatch.setattr(Resolver, "iterative", None)
+    monkeypatch.setattr(Resolver, "_query", classmethod(query))
+    monkeypatch.setattr(IP2Geo, "ip_to_location", classmethod(ip_to_location))
+    cache = ResponseCache("redis://localhost")
+    cache.redis_client = DictRedis()
+    monkeypatch.setattr(events, "response_cache", cache)
+
+    stream = [event async for event in events.stream_resolve("example.com", [RecordTypes.A, RecordTypes.AAAA])]
+    received = list(parse_events(b"".join(stream)))
+    kinds = [kind for kind, _ in received]
+
+    assert kinds.count("answer") == 3 and kinds.count("error") == 6 and kinds[-1] == "result"
+    assert ujson.loads(received[-1][1])["A"] == {"metadata": ["example.com - ipinfo timed out"]}
+    assert not cache.redis_client.values
@@ -0,0 +1,31 @@
+import re
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+# Cumulative import time budgets in microseconds, generous enough for slow CI machines
+BUDGETS = {"dnsdig.appdnsdigd.dnsdigd": 1_500_000, "dnsdig.appdnsdigapi.web": 4_000_000}
+# Only needed once the process is up, they must be imported lazily
+LAZY = {
+    "dnsdig.appdnsdigd.dnsdigd": ["beanie", "motor", "dnsdig.appdnsdigd.analyticsmongo"],
+    "dnsdig.appdnsdigapi.web": ["sentry_sdk"],
+}
+
+_line = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)")
+
+
+def import_times(module: str) -> Dict[str, int]:
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    return {match.group(2): int(match.group(1)) for match in map(_line.match, process.stderr.splitlines()) if match}
+
+
+@pytest.mark.parametrize("module", BUDGETS)
+def test_import_budget(module: str):
+    times = import_times(module)
+
+    assert times[module] < BUDGETS[module]
+    assert [lazy for lazy in LAZY[module] if lazy in times] == []
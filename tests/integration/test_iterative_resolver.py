@@ -0,0 +1,114 @@
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rrset
+import pytest
+import pytest_asyncio
+from dns.rdatatype import RdataType
+
+from dnsdig.appdnsdigbench.stubauthority import StubAuthority, serve_authority
+from dnsdig.libdns.domains.iterative import IterativeResolver
+
+PORT = 15353
+SOA = "@ 3600 IN SOA ns hostmaster 1 3600 600 86400 300\n"
+
+root_zone = (
+    SOA
+    + """
+@ 3600 IN NS a.root.
+a.root. 3600 IN A 127.0.0.2
+test. 3600 IN NS ns1.test.
+ns1.test. 3600 IN A 127.0.0.3
+"""
+)
+test_zone = (
+    SOA
+    + """
+@ 3600 IN NS ns1
+ns1 3600 IN A 127.0.0.3
+example 3600 IN NS ns1.example
+example 3600 IN NS ns2.example
+ns1.example 3600 IN A 127.0.0.4
+ns2.example 3600 IN A 127.0.0.9
+other 3600 IN NS ns.example.test.
+"""
+)
+example_zone = (
+    SOA
+    + """
+@ 3600 IN NS ns1
+ns 300 IN A 127.0.0.4
+www 300 IN A 192.0.2.10
+alias 300 IN CNAME www.other.test.
+"""
+)
+other_zone = (
+    SOA
+    + """
+@ 3600 IN NS ns.example.test.
+www 300 IN A 192.0.2.20
+"""
+)
+
+
+@pytest_asyncio.fixture
+async def hierarchy():
+    servers = [
+        ("127.0.0.2", StubAuthority.from_text((".", root_zone))),
+        ("127.0.0.3", StubAuthority.from_text(("test.", test_zone))),
+        ("127.0.0.4", StubAuthority.from_text(("example.test.", example_zone), ("other.test.", other_zone))),
+    ]
+    transports = [await serve_authority(authority, host=host, port=PORT) for host, authority in servers]
+    yield {host: authority for host, authority in servers}
+    for transport in transports:
+        transport.close()
+
+
+@pytest.mark.asyncio
+async def test_follows_referrals_and_caches_delegations(hierarchy):
+    resolver = IterativeResolver(root_hints={"a.root.": "127.0.0.2"}, port=PORT, timeout=0.2)
+
+    response = await resolver.resolve("www.example.test.", RdataType.A)
+    queries = sum(authority.queries for authority in hierarchy.values())
+    again = await resolver.resolve("www.example.test.", RdataType.A)
+
+    assert [rdata.address for rdata in response.answer[0]] == ["192.0.2.10"]
+    assert again.answer == response.answer
+    # The second lookup goes straight to the example.test. servers
+    assert sum(authority.queries for authority in hierarchy.values()) == queries + 1
+    assert resolver.stats.srtt["127.0.0.4"] < resolver.stats.srtt.get("127.0.0.9", resolver.timeout)
+
+
+@pytest.mark.asyncio
+async def test_resolves_glueless_delegations_and_cnames(hierarchy):
+    resolver = IterativeResolver(root_hints={"a.root.": "127.0.0.2"}, port=PORT, timeout=0.2)
+
+    response = await resolver.resolve("alias.example.test.", RdataType.A)
+    missing = await resolver.resolve("missing.example.test.", RdataType.A)
+
+    assert [rrset.rdtype for rrset in response.answer] == [RdataType.CNAME, RdataType.A]
+    assert [rdata.address for rdata in response.answer[1]] == ["192.0.2.20"]
+    assert missing.rcode() == dns.rcode.NXDOMAIN
+    assert missing.authority[0].rdtype == RdataType.SOA
+
+
+@pytest.mark.asyncio
+async def test_ignores_records_outside_the_zone_of_the_answering_server(hierarchy):
+    authority = hierarchy["127.0.0.4"]
+    answer = authority.answer
+
+    def poisoning_answer(wire: bytes) -> bytes:
+        response = dns.message.from_wire(answer(wire))
+        if response.question[0].name == dns.name.from_text("alias.example.test."):
+            # The example.test. server also "answers" for the CNAME target and for an unrelated name
+            response.answer.append(dns.rrset.from_text("www.other.test.", 300, "IN", "A", "203.0.113.66"))
+            response.answer.append(dns.rrset.from_text("victim.test.", 300, "IN", "A", "203.0.113.66"))
+        return response.to_wire()
+
+    authority.answer = poisoning_answer
+    resolver = IterativeResolver(root_hints={"a.root.": "127.0.0.2"}, port=PORT, timeout=0.2)
+
+    response = await resolver.resolve("alias.example.test.", RdataType.A)
+
+    assert [rrset.name.to_text() for rrset in response.answer] == ["alias.example.test.", "www.other.test."]
+    assert [rdata.address for rdata in response.answer[1]] == ["192.0.2.20"]
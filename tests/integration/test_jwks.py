@@ -0,0 +1,136 @@
+import time
+
+import jwt
+import pytest
+import ujson
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from dnsdig.libshared.jwks import JWKSManager
+
+
+class CountingJWKSManager(JWKSManager):
+    def __init__(self, jwks, **kwargs):
+        super().__init__("https://auth.example.com/.well-known/jwks.json", **kwargs)
+        self.jwks = jwks
+        self.downloads = 0
+
+    async def download(self):
+        self.downloads += 1
+        return self.jwks
+
+
+def make_key(kid: str):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = ujson.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": kid, "alg": "RS256", "use": "sig"})
+    return private_key, jwk
+
+
+def sign(private_key, kid: str, **claims) -> str:
+    claims.setdefault("exp", int(time.time()) + 60)
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.mark.asyncio
+async def test_jwks_manager_caches_verified_claims(monkeypatch):
+    private_key, jwk = make_key("first")
+    manager = CountingJWKSManager({"keys": [jwk]})
+    await manager.fetch()
+    token = sign(private_key, "first", sub="kp_123")
+
+    claims = await manager.decode(token, algorithms=["RS256"])
+
+    assert claims["sub"] == "kp_123"
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("Signature verified twice")
+
+    monkeypatch.setattr(jwt, "decode", _fail)
+
+    cached = await manager.decode(token, algorithms=["RS256"])
+    cached["sub"] = "changed"
+
+    assert await manager.decode(token, algorithms=["RS256"]) == claims
+    assert manager.downloads == 1
+
+
+@pytest.mark.asyncio
+async def test_jwks_manager_keeps_cached_claims_across_refetches(monkeypatch):
+    private_key, jwk = make_key("first")
+    manager = CountingJWKSManager({"keys": [jwk]}, min_refetch_interval=0)
+    await manager.fetch()
+    token = sign(private_key, "first", sub="kp_123")
+    await manager.decode(token, algorithms=["RS256"])
+
+    # A made up kid forces a refetch of the same key set, the refresh does the same every interval
+    with pytest.raises(jwt.PyJWKClientError):
+        await manager.decode(sign(private_key, "made-up"), algorithms=["RS256"])
+    await manager.fetch()
+    assert manager.downloads == 3
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("Signature verified twice")
+
+    monkeypatch.setattr(jwt, "decode", _fail)
+
+    assert (await manager.decode(token, algorithms=["RS256"]))["sub"] == "kp_123"
+
+
+@pytest.mark.asyncio
+async def test_jwks_manager_checks_nbf_of_cached_claims(monkeypatch):
+    private_key, jwk = make_key("first")
+    manager = CountingJWKSManager({"keys": [jwk]})
+    await manager.fetch()
+    now = time.time()
+    token = sign(private_key, "first", sub="kp_123", nbf=int(now) - 1)
+    await manager.decode(token, algorithms=["RS256"])
+
+    # The clock stepped back before the token became valid, the cache must not vouch for it
+    def _immature(*args, **kwargs):
+        raise jwt.ImmatureSignatureError("The token is not yet valid (nbf)")
+
+    monkeypatch.setattr(time, "time", lambda: now - 3600)
+    monkeypatch.setattr(jwt, "decode", _immature)
+
+    with pytest.raises(jwt.ImmatureSignatureError):
+        await manager.decode(token, algorithms=["RS256"])
+
+
+@pytest.mark.asyncio
+async def test_jwks_manager_stops_trusting_cached_claims_of_removed_keys():
+    private_key, jwk = make_key("first")
+    manager = CountingJWKSManager({"keys": [jwk]}, min_refetch_interval=60)
+    await manager.fetch()
+    token = sign(private_key, "first", sub="kp_123")
+    assert (await manager.decode(token, algorithms=["RS256"]))["sub"] == "kp_123"
+
+    # The provider revokes the key, the next refresh drops it
+    manager.load({"keys": [make_key("second")[1]]})
+
+    with pytest.raises(jwt.PyJWKClientError):
+        await manager.decode(token, algorithms=["RS256"])
+
+
+@pytest.mark.asyncio
+async def test_jwks_manager_rate_limits_unknown_kids():
+    first_key, first_jwk = make_key("first")
+    second_key, second_jwk = make_key("second")
+    manager = CountingJWKSManager({"keys": [first_jwk]}, min_refetch_interval=60)
+    manager.fetched_at = time.monotonic() - 120
+    manager.load({"keys": [first_jwk]})
+
+    # Rotated keys are picked up on the first unknown kid
+    manager.jwks = {"keys": [first_jwk, second_jwk]}
+    claims = await manager.decode(sign(second_key, "second", sub="rotated"), algorithms=["RS256"])
+
+    assert claims["sub"] == "rotated"
+    assert manager.downloads == 1
+
+    for _ in range(5):
+        with pytest.raises(jwt.PyJWKClientError):
+            await manager.decode(sign(first_key, "made-up"), algorithms=["RS256"])
+
+    assert manager.downloads == 1
+
+    with pytest.raises(jwt.InvalidSignatureError):
+        await manager.decode(sign(first_key, "second"), algorithms=["RS256"])
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import queue
+import random
+import sys
+
+import pytest
+import ujson
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from dnsdig.appdnsdigapi.requestid import RequestIdMiddleware
+from dnsdig.libshared.logging import (
+    DroppingQueueHandler,
+    JsonFormatter,
+    RequestIdFilter,
+    SamplingFilter,
+    log_records_dropped,
+    request_id,
+    set_request_id,
+)
+
+
+def make_record(level: int = logging.INFO, msg: str = "Resolved %s", args=("example.com.",), **fields):
+    record = logging.LogRecord("fastapi", level, __file__, 1, msg, args, None)
+    record.__dict__.update(fields)
+    return record
+
+
+def failed_record() -> logging.LogRecord:
+    try:
+        raise ValueError("upstream went away")
+    except ValueError:
+        record = logging.LogRecord("fastapi", logging.ERROR, __file__, 1, "Failed %s", ("query",), sys.exc_info())
+    record.qname = "example.com."
+    return record
+
+
+def test_sampling_filter(monkeypatch):
+    assert not SamplingFilter({"DEBUG": 0}).filter(make_record(logging.DEBUG))
+
+    sampler = SamplingFilter({"info": 0.25, "WARNING": 1})
+    monkeypatch.setattr(random, "random", iter([0.1, 0.5, 0.9, 0.2]).__next__)
+    sampled = log_records_dropped.get("sampled")
+
+    assert [sampler.filter(make_record()) for _ in range(4)] == [True, False, False, True]
+    assert log_records_dropped.get("sampled") == sampled + 2
+    assert sampler.filter(make_record(logging.WARNING))
+    assert sampler.filter(make_record(logging.ERROR))
+
+
+def test_json_formatter():
+    line = ujson.loads(JsonFormatter().format(make_record(qname="example.com.", elapsed_ms=1.5)))
+
+    assert line["level"] == "INFO"
+    assert line["message"] == "Resolved example.com."
+    assert line["qname"] == "example.com." and line["elapsed_ms"] == 1.5
+    assert "exc" not in line
+
+    line = ujson.loads(JsonFormatter().format(failed_record()))
+
+    assert line["message"] == "Failed query"
+    assert "ValueError: upstream went away" in line["exc"]
+
+
+def test_queued_records_keep_their_traceback_apart_from_the_message():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    dropped = log_records_dropped.get("queue_full")
+    handler.handle(failed_record())
+    handler.handle(make_record())
+
+    queued = handler.queue.get_nowait()
+    line = ujson.loads(JsonFormatter().format(queued))
+
+    assert queued.exc_info is None
+    assert line["message"] == "Failed query"
+    assert line["qname"] == "example.com."
+    assert "ValueError: upstream went away" in line["exc"]
+    assert log_records_dropped.get("queue_full") == dropped + 1
+
+
+@pytest.mark.asyncio
+async def test_request_id_follows_each_request():
+    stamper = RequestIdFilter()
+
+    async def _request(new_request_id: str | None) -> str:
+        set_request_id(new_request_id)
+        await asyncio.sleep(0)
+        record = make_record()
+        stamper.filter(record)
+        return record.request_id
+
+    first, second, generated = await asyncio.gather(_request("first"), _request("second"), _request(None))
+
+    assert (first, second) == ("first", "second")
+    assert len(generated) == 36
+    assert request_id.get() == ""
+
+
+def test_request_id_middleware_sets_the_id_for_the_request_only():
+    app = FastAPI()
+    app.add_middleware(RequestIdMiddleware)
+
+    @app.get("/whoami")
+    async def whoami():
+        return {"request_id": request_id.get()}
+
+    client = TestClient(app)
+
+    response = client.get("/whoami", headers={"x-request-id": "abc-123"})
+    assert response.json() == {"request_id": "abc-123"}
+    assert response.headers["x-request-id"] == "abc-123"
+
+    # Ids that would garble the log lines are replaced
+    first, second = (client.get("/whoami", headers={"x-request-id": "a b\n"}) for _ in range(2))
+    assert len(first.json()["request_id"]) == 36
+    assert first.json()["request_id"] != second.json()["request_id"]
+    assert first.headers["x-request-id"] == first.json()["request_id"]
+
+
+@pytest.mark.asyncio
+async def test_request_id_middleware_resets_the_id_afterwards():
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(request_id.get())
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        await RequestIdMiddleware(app)({"type": "http", "headers": [(b"x-request-id", b"abc-123")]}, None, None)
+
+    assert seen == ["abc-123"]
+    assert request_id.get() == ""
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+import ujson
+
+from dnsdig.appdnsdigapi.metrics import WorkerMetrics
+from dnsdig.libshared.metrics import Counter, Gauge, Histogram, Registry
+
+
+def build_registry() -> Registry:
+    registry = Registry()
+    Counter("dnsdig_http_requests", "HTTP requests", ["route"], registry=registry)
+    Gauge("dnsdig_connections", "Open connections", registry=registry)
+    Gauge("dnsdig_queue_depth", "Pending jobs", registry=registry, aggregate="max")
+    Histogram("dnsdig_latency_seconds", "Latency", ["route"], buckets=(0.1, 1.0), registry=registry)
+    return registry
+
+
+def record(registry: Registry, requests: int, latency: float, connections: int):
+    registry.metrics["dnsdig_http_requests"].inc("/resolve", amount=requests)
+    registry.metrics["dnsdig_connections"].set(connections)
+    registry.metrics["dnsdig_queue_depth"].set(connections * 10)
+    registry.metrics["dnsdig_latency_seconds"].observe(latency, "/resolve")
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_merged_across_the_workers_of_a_host(tmp_path):
+    this_worker, other_worker = build_registry(), build_registry()
+    record(this_worker, requests=2, latency=0.05, connections=3)
+    record(other_worker, requests=5, latency=0.5, connections=4)
+
+    # A live worker and one that is gone
+    (tmp_path / f"{os.getppid()}.json").write_text(ujson.dumps(other_worker.snapshot()))
+    (tmp_path / "999999999.json").write_text(ujson.dumps(other_worker.snapshot()))
+
+    body = await WorkerMetrics(this_worker, str(tmp_path)).render()
+
+    assert "# TYPE dnsdig_http_requests_total counter" in body
+    assert 'dnsdig_http_requests_total{route="/resolve"} 7' in body
+    assert "dnsdig_connections 7" in body
+    assert "dnsdig_queue_depth 40" in body
+    assert 'dnsdig_latency_seconds_bucket{route="/resolve",le="0.1"} 1' in body
+    assert 'dnsdig_latency_seconds_bucket{route="/resolve",le="1"} 2' in body
+    assert 'dnsdig_latency_seconds_count{route="/resolve"} 2' in body
+    assert not (tmp_path / "999999999.json").exists()
+
+    # The worker's own numbers are current, not those of its last written snapshot
+    WorkerMetrics(this_worker, str(tmp_path)).write(ujson.dumps(this_worker.snapshot()))
+    record(this_worker, requests=1, latency=0.05, connections=3)
+    assert 'dnsdig_http_requests_total{route="/resolve"} 8' in await WorkerMetrics(this_worker, str(tmp_path)).render()
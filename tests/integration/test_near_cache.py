@@ -0,0 +1,48 @@
+import time
+
+from dnsdig.appdnsdigd.cache import NearCache, InvalidationTracker
+
+
+def test_near_cache_evicts_and_expires():
+    cache = NearCache(size=2, max_ttl=60)
+    cache.set("a", b"a", ttl=30)
+    cache.set("b", b"b", ttl=30)
+    cache.get("a")
+    cache.set("c", b"c", ttl=30)
+    cache.set("expired", b"x", ttl=0)
+
+    assert cache.get("a") == b"a"
+    assert cache.get("b") is None
+    assert cache.get("expired") is None
+    assert cache.entries["a"][1] <= time.time() + 60
+
+
+def test_near_cache_snapshot_round_trip(tmp_path):
+    cache = NearCache()
+    cache.set("hot", b"hot", ttl=30)
+    cache.set("cold", b"cold", ttl=30)
+    for _ in range(3):
+        cache.get("hot")
+    cache.save(tmp_path / "snapshot.gz", limit=1)
+
+    restored = NearCache()
+
+    assert restored.load(tmp_path / "snapshot.gz") == 1
+    assert restored.get("hot") == b"hot"
+    assert restored.get("cold") is None
+    assert restored.load(tmp_path / "missing.gz") == 0
+
+
+def test_invalidation_tracker_skips_own_writes():
+    invalidated = []
+    tracker = InvalidationTracker(
+        redis_url="redis://localhost", prefixes=["dnsdigd-cache#"], on_invalidate=invalidated.append
+    )
+    tracker.active = True
+    tracker.wrote("dnsdigd-cache#ours")
+
+    tracker.invalidate(["dnsdigd-cache#ours", "dnsdigd-cache#theirs"])
+    tracker.invalidate(["dnsdigd-cache#ours"])
+    tracker.invalidate(None)
+
+    assert invalidated == [["dnsdigd-cache#theirs"], ["dnsdigd-cache#ours"], None]
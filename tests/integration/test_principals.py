@@ -0,0 +1,140 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from beanie import PydanticObjectId
+
+from dnsdig.libaccount.models.mongo import User
+from dnsdig.libshared.models import MongoClient, after_commit, mongo_session
+from dnsdig.libshared.monq import monq_find_one
+from dnsdig.libshared.principals import Principal, PrincipalCache
+
+
+def make_principal() -> Principal:
+    user = User.model_construct(id=PydanticObjectId(), email="dev@example.com", applications=[], blocked_at=None)
+    return Principal(user=user)
+
+
+def test_principal_cache_hands_out_copies():
+    cache = PrincipalCache(size=10, ttl=60)
+    principal = make_principal()
+    cache.set("sub:1", principal)
+
+    cached = cache.get("sub:1")
+    cached.user.applications.append("changed")
+
+    assert cached.user.email == "dev@example.com"
+    assert cache.get("sub:1").user.applications == []
+
+
+def test_principal_cache_invalidates_by_user():
+    cache = PrincipalCache(size=10, ttl=60)
+    first, second = make_principal(), make_principal()
+    cache.set("m2m:a", first)
+    cache.set("m2m:b", first)
+    cache.set("sub:2", second)
+
+    cache.invalidate_user(str(first.user.id))
+
+    assert cache.get("m2m:a") is None
+    assert cache.get("m2m:b") is None
+    assert cache.get("sub:2")
+
+    cache.invalidate_user(PrincipalCache.everyone)
+
+    assert len(cache) == 0
+
+
+def test_principal_cache_expires_and_evicts():
+    cache = PrincipalCache(size=2, ttl=60)
+    cache.set("m2m:a", make_principal(), ttl=0.01)
+    cache.set("m2m:b", make_principal())
+    cache.set("m2m:c", make_principal())
+    time.sleep(0.02)
+
+    assert cache.get("m2m:a") is None
+    assert cache.get("m2m:b")
+    assert cache.get("m2m:c")
+
+    cache.set("m2m:d", make_principal(), ttl=-1)
+
+    assert cache.get("m2m:d") is None
+    assert len(cache.keys_by_user) == 2
+
+
+class FakeSession:
+    def __init__(self):
+        self.in_transaction = False
+
+    def start_transaction(self):
+        self.in_transaction = True
+
+    async def commit_transaction(self):
+        self.in_transaction = False
+
+    async def abort_transaction(self):
+        self.in_transaction = False
+
+    async def end_session(self):
+        pass
+
+
+class FakeMongoClient:
+    async def start_session(self):
+        return FakeSession()
+
+
+@pytest.mark.asyncio
+async def test_invalidations_are_published_after_the_commit(monkeypatch):
+    monkeypatch.setattr(MongoClient, "client", property(lambda self: FakeMongoClient()))
+    published = []
+
+    async def publish():
+        published.append(len(published))
+
+    async with MongoClient().transaction():
+        await mongo_session()
+        await after_commit(publish)
+        assert published == []
+    assert published == [0]
+
+    with pytest.raises(RuntimeError):
+        async with MongoClient().transaction():
+            await mongo_session()
+            await after_commit(publish)
+            raise RuntimeError()
+    assert published == [0]
+
+    # Outside of a transaction, or before anything was written in one, there is nothing to wait for
+    await after_commit(publish)
+    async with MongoClient().transaction():
+        await after_commit(publish)
+        assert published == [0, 1, 2]
+
+
+class FakeCollection:
+    def __init__(self):
+        self.sessions = []
+
+    def find(self, query, session=None, **kwargs):
+        self.sessions.append(session)
+        return self.cursor()
+
+    async def cursor(self):
+        for document in []:
+            yield document
+
+
+@pytest.mark.asyncio
+async def test_reads_join_the_transaction_once_a_write_started_it(monkeypatch):
+    monkeypatch.setattr(MongoClient, "client", property(lambda self: FakeMongoClient()))
+    collection = FakeCollection()
+    model = SimpleNamespace(get_settings=lambda: SimpleNamespace(motor_db={"users": collection}, name="users"))
+
+    await monq_find_one(model=model, query={})
+    async with MongoClient().transaction():
+        await monq_find_one(model=model, query={})
+        session = await mongo_session()
+        await monq_find_one(model=model, query={})
+
+    assert collection.sessions == [None, None, session]
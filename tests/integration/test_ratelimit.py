@@ -0,0 +1,114 @@
+import pytest
+from fastapi import HTTPException
+from redis.exceptions import ConnectionError
+
+from dnsdig.libshared.ratelimit import HybridRateLimiter
+
+
+class SharedCounters:
+    def __init__(self):
+        self.values = {}
+        self.down = False
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+    def pipeline(self, transaction: bool = False):
+        return SharedPipeline(self)
+
+
+class SharedPipeline:
+    def __init__(self, counters: SharedCounters):
+        self.counters = counters
+        self.commands = []
+
+    def incrby(self, key: str, amount: int):
+        self.commands.append(("incrby", key, amount))
+
+    def expire(self, key: str, seconds: int):
+        self.commands.append(("expire", key, seconds))
+
+    async def execute(self):
+        if self.counters.down:
+            raise ConnectionError("Redis is down")
+        results = []
+        for command, key, value in self.commands:
+            if command == "incrby":
+                self.counters.values[key] = self.counters.values.get(key, 0) + value
+                results.append(self.counters.values[key])
+            else:
+                results.append(True)
+        return results
+
+
+def make_limiter(counters: SharedCounters, **kwargs) -> HybridRateLimiter:
+    limiter = HybridRateLimiter("test", times=kwargs.pop("times", 20), seconds=3600, **kwargs)
+    limiter.redis_client = counters
+    return limiter
+
+
+async def admitted(limiter: HybridRateLimiter, key: str, attempts: int) -> int:
+    count = 0
+    for _ in range(attempts):
+        try:
+            await limiter.hit(key)
+            count += 1
+        except HTTPException as exc:
+            assert exc.status_code == 429
+    return count
+
+
+@pytest.mark.asyncio
+async def test_workers_share_the_limit_within_the_overshoot():
+    counters = SharedCounters()
+    first, second = make_limiter(counters, overshoot=0.1), make_limiter(counters, overshoot=0.1)
+
+    total = 0
+    for _ in range(10):
+        total += await admitted(first, "ip:10.0.0.1", 5)
+        total += await admitted(second, "ip:10.0.0.1", 5)
+        await first.flush()
+        await second.flush()
+
+    # Each worker may run ahead of Redis by its local share, 2 requests here
+    assert 20 <= total <= 24
+    assert await admitted(first, "ip:10.0.0.2", 5) == 5
+
+
+@pytest.mark.asyncio
+async def test_fail_open_and_fail_closed():
+    counters = SharedCounters()
+    counters.down = True
+    fail_open = make_limiter(counters, times=5, stale_after=0)
+    fail_closed = make_limiter(counters, times=5, stale_after=0, fail_open=False)
+
+    # Without Redis every worker still enforces the limit on its own
+    assert await admitted(fail_open, "app:m2m-1", 10) == 5
+
+    await fail_closed.hit("app:m2m-1")
+    await fail_closed.flush()
+    with pytest.raises(HTTPException) as exc:
+        await fail_closed.hit("app:m2m-1")
+    assert exc.value.status_code == 503
+
+    counters.down = False
+    await fail_closed.flush()
+
+    assert fail_closed.healthy
+    assert counters.values == {fail_closed.redis_key("app:m2m-1", fail_closed.counters["app:m2m-1"].window): 1}
+
+
+@pytest.mark.asyncio
+async def test_stop_flushes_the_last_counts_and_closes_the_client():
+    counters = SharedCounters()
+    limiter = make_limiter(counters, times=5)
+    limiter.start()
+    task = limiter.task
+
+    await limiter.hit("ip:10.0.0.1")
+    await limiter.stop()
+
+    assert task.cancelled() and limiter.task is None
+    assert counters.values == {limiter.redis_key("ip:10.0.0.1", limiter.counters["ip:10.0.0.1"].window): 1}
+    assert counters.closed and limiter.redis_client is None
@@ -0,0 +1,74 @@
+import dns.message
+import pytest
+from redis.exceptions import ConnectionError
+
+from dnsdig.appdnsdigd.cache import BLOCKLIST_PREFIX, blocklist_key
+from dnsdig.appdnsdigd.engine import DNSEngine
+from dnsdig.appdnsdigd.settings import dnsdigd_settings
+from dnsdig.libshared.redisring import HashRing, ShardedRedis, NoHealthyNodes
+
+nodes = [f"redis://redis-{index}:6379" for index in range(4)]
+keys = [f"dnsdigd-cache#host{index}.example.com.#1" for index in range(4000)]
+
+
+def test_ring_spreads_keys_and_moves_few_on_resize():
+    ring = HashRing(nodes)
+    owners = {key: next(ring.walk(key)) for key in keys}
+    grown = HashRing(nodes + ["redis://redis-4:6379"])
+    moved = [key for key in keys if next(grown.walk(key)) != owners[key]]
+
+    assert all(len(keys) / 8 < list(owners.values()).count(node) < len(keys) / 2 for node in nodes)
+    assert len(moved) < len(keys) / 3
+    assert all(next(grown.walk(key)) == "redis://redis-4:6379" for key in moved)
+
+
+class FailingClient:
+    async def get(self, key: str):
+        raise ConnectionError("Connection refused")
+
+
+@pytest.mark.asyncio
+async def test_failing_node_is_ejected():
+    client = ShardedRedis(urls=nodes[:2], eject_failures=2, eject_seconds=60)
+    key = keys[0]
+    node = client.node_for(key)
+    node.client = FailingClient()
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await client.get(key)
+
+    assert not node.healthy
+    assert client.node_for(key).url != node.url
+
+    client.nodes[client.node_for(key).url].ejected_until = node.ejected_until
+    with pytest.raises(NoHealthyNodes):
+        client.node_for(key)
+
+
+@pytest.mark.asyncio
+async def test_blocklist_keys_are_not_read_from_another_node():
+    client = ShardedRedis(urls=nodes, pinned_prefixes=(BLOCKLIST_PREFIX,))
+    key = blocklist_key("ads.example.com")
+    client.node_for(key).ejected_until = float("inf")
+
+    # The next node holds nothing for this bucket, a miss there would let a blocked host resolve
+    with pytest.raises(NoHealthyNodes):
+        await client.hget(key, "ads.example.com")
+    with pytest.raises(NoHealthyNodes):
+        await client.execute_many([(key, "hget", ("ads.example.com",))])
+
+    # Cache keys of the same node still move on to the next one
+    ejected = next(client.ring.walk(key))
+    cache_key = next(key for key in keys if next(client.ring.walk(key)) == ejected)
+    assert client.node_for(cache_key).url != ejected
+
+
+@pytest.mark.asyncio
+async def test_adblocker_does_not_fail_open_on_an_ejected_node(monkeypatch):
+    monkeypatch.setattr(dnsdigd_settings, "redis_urls", nodes)
+    engine = DNSEngine(use_cache=True, use_adblocker=True)
+    engine.redis_client.node_for(blocklist_key("ads.example.com")).ejected_until = float("inf")
+
+    with pytest.raises(NoHealthyNodes):
+        await engine.resolve(dns.message.make_query("ads.example.com.", "A"))
@@ -1,6 +1,7 @@
 from unittest import mock
 from unittest.mock import AsyncMock
 
+import dns.rdata
 import pytest
 from pydantic.networks import IPvAnyAddress, IPv4Address, IPv6Address
 
@@ -112,6 +113,26 @@ async def test_resolver_txt():
         assert len(items) > 0
 
 
+def test_parse_rdata():
+    txt = Resolver._parse_txt_result(dns.rdata.from_text("IN", "TXT", '"v=DKIM1; k=rsa; " "p=MIGf\\"MA"'), 300)
+    soa = Resolver._parse_soa_result(
+        dns.rdata.from_text("IN", "SOA", "ns.example.com. john\\.doe.example.com. 1 7200 3600 1209600 300"), 300
+    )
+    srv = Resolver._parse_srv_result(dns.rdata.from_text("IN", "SRV", "10 5 5060 sip.example.com."), 300)
+
+    assert txt.txt == 'v=DKIM1; k=rsa; p=MIGf"MA'
+    assert (soa.primary_ns, soa.email, soa.serial, soa.minimum) == ("ns.example.com.", "john.doe@example.com.", 1, 300)
+    assert (srv.priority, srv.weight, srv.port, srv.target) == (10, 5, 5060, "sip.example.com")
+    assert (
+        Resolver._parse_mx_result(dns.rdata.from_text("IN", "MX", "10 mx.example.com."), 300).hostname
+        == "mx.example.com"
+    )
+    assert (
+        Resolver._parse_ptr_result(dns.rdata.from_text("IN", "PTR", "one.one.one.one."), 300).hostname
+        == "one.one.one.one"
+    )
+
+
 # @pytest.mark.asyncio
 # async def test_resolver6_aaaa():
 #     records = await Resolver.resolve_record6(hostname="google.com", record_type=RecordTypes.AAAA)
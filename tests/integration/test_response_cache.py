@@ -0,0 +1,71 @@
+import dns.rdata
+import pytest
+from starlette.requests import Request
+
+from dnsdig.appdnsdigapi.cache import ResponseCache, minimum_ttl
+from dnsdig.libdns.domains.resolver import Resolver
+
+
+class DictRedis:
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key: str):
+        return self.values.get(key, (None,))[0]
+
+    async def set(self, key: str, value: bytes, ex: int | None = None):
+        self.values[key] = (value, ex)
+
+
+def make_request(headers: dict | None = None) -> Request:
+    raw = [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw})
+
+
+def test_minimum_ttl():
+    results = {
+        "metadata": [],
+        "google": [Resolver._parse_mx_result(dns.rdata.from_text("IN", "MX", "10 mx.example.com."), 300)],
+        "cloudflare": [Resolver._parse_txt_result(dns.rdata.from_text("IN", "TXT", '"v=spf1 ~all"'), 120)],
+    }
+
+    assert minimum_ttl(results) == 120
+    assert minimum_ttl({"metadata": ["example.com. - NXDOMAIN"]}) is None
+
+
+@pytest.mark.asyncio
+async def test_response_cache_serves_stored_bytes_and_304():
+    cache = ResponseCache("redis://localhost", max_ttl=60, negative_ttl=5)
+    cache.redis_client = DictRedis()
+    key = ResponseCache.key("Example.com.", "MX", use_ipv6=False)
+    calls = []
+
+    async def resolve():
+        calls.append(1)
+        return {
+            "metadata": [],
+            "google": [Resolver._parse_mx_result(dns.rdata.from_text("IN", "MX", "10 mx.example.com."), 300)],
+        }
+
+    first = await cache.respond(make_request(), key, resolve)
+    second = await cache.respond(make_request(), key, resolve)
+
+    assert len(calls) == 1
+    assert key == "dnsdig-api-response#example.com#MX#4"
+    assert cache.redis_client.values[key][1] == 60
+    assert first.body == second.body
+    assert first.headers["etag"] == second.headers["etag"]
+    assert 0 < int(second.headers["cache-control"].removeprefix("max-age=")) <= 60
+
+    not_modified = await cache.respond(make_request({"If-None-Match": f'"x", {first.headers["etag"]}'}), key, resolve)
+
+    assert not_modified.status_code == 304
+    assert not_modified.body == b""
+
+    negative = await cache.respond(make_request(), "negative", lambda: _nxdomain())
+
+    assert negative.headers["cache-control"] == "max-age=5"
+
+
+async def _nxdomain():
+    return {"metadata": ["example.com. - NXDOMAIN"]}
@@ -0,0 +1,42 @@
+from typing import Dict
+
+import dns.rdata
+import pytest
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from dnsdig.libdns.constants import RecordTypes
+from dnsdig.libdns.domains.resolver import Resolver, ResolverResult
+from dnsdig.libgeoip.models import IPLocationResult, GeoObject
+from dnsdig.libshared.models import ModelJSONResponse
+
+
+@pytest.mark.asyncio
+async def test_model_json_response_matches_validated_response():
+    location = IPLocationResult(ip="1.1.1.1", country_iso_code="AU", geo=GeoObject(coordinates=(1.0, 2.0)), ttl=300)
+    results = {
+        RecordTypes.A: {"metadata": [], "google": [location]},
+        RecordTypes.AAAA: {"metadata": ["example.com. - The DNS response does not contain an answer"]},
+        RecordTypes.MX: {
+            "metadata": [],
+            "google": [Resolver._parse_mx_result(dns.rdata.from_text("IN", "MX", "10 mx.example.com."), 300)],
+        },
+        RecordTypes.TXT: {
+            "metadata": [],
+            "google": [Resolver._parse_txt_result(dns.rdata.from_text("IN", "TXT", '"v=spf1 ~all"'), 300)],
+        },
+        RecordTypes.SOA: {
+            "metadata": [],
+            "google": [
+                Resolver._parse_soa_result(
+                    dns.rdata.from_text("IN", "SOA", "ns.example.com. dns.example.com. 1 7200 3600 1209600 300"), 300
+                )
+            ],
+        },
+    }
+
+    field = create_response_field(name="Response", type_=Dict[RecordTypes, ResolverResult], mode="serialization")
+    validated = await serialize_response(field=field, response_content=results, is_coroutine=True)
+
+    assert ModelJSONResponse(results).body == JSONResponse(validated).body
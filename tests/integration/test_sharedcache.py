@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import time
+
+import dns.message
+import dns.rdataclass
+import dns.resolver
+import dns.rrset
+import pytest
+
+from dnsdig.libdns.constants import RecordTypes
+from dnsdig.libdns.domains import resolver
+from dnsdig.libdns.domains.resolver import Resolver
+from dnsdig.libshared.sharedcache import SharedCache
+
+
+def write_forever(path: str, rounds: int):
+    cache = SharedCache(path, slots=8, slot_size=512, ways=2)
+    for n in range(rounds):
+        cache.set("hot", (b"a" if n % 2 else b"b") * (100 + n % 300), ttl=60)
+
+
+def test_workers_see_each_others_entries(tmp_path):
+    path = str(tmp_path / "cache")
+    first, second = SharedCache(path, slots=64, slot_size=256), SharedCache(path, slots=64, slot_size=256)
+
+    first.set("answer#google#example.com#1", b"wire", ttl=60)
+    first.set("too-big", b"x" * 256, ttl=60)
+    first.set("expired", b"x", ttl=0.01)
+    time.sleep(0.02)
+
+    value, expires_at = second.get("answer#google#example.com#1")
+    assert value == b"wire" and expires_at > time.time()
+    assert second.get("too-big") is None
+    assert second.get("expired") is None
+
+    second.set("answer#google#example.com#1", b"newer", ttl=60)
+    assert first.get("answer#google#example.com#1")[0] == b"newer"
+
+    # Other settings get a file of their own, the one mapped by the running workers is left alone
+    resized = SharedCache(path, slots=128, slot_size=256)
+    assert resized.get("answer#google#example.com#1") is None
+    assert resized.path != first.path and os.path.getsize(first.path) == first.size
+    assert first.get("answer#google#example.com#1")[0] == b"newer"
+
+    # A file that is not laid out for this cache is never truncated under the workers mapping it
+    with open(f"{path}-8x512x2", "wb") as foreign:
+        foreign.write(b"x" * 100)
+    assert SharedCache(path, slots=8, slot_size=512, ways=2).get("answer#google#example.com#1") is None
+    assert os.path.getsize(f"{path}-8x512x2") == 100
+
+
+def test_readers_never_see_torn_writes(tmp_path):
+    path = str(tmp_path / "cache")
+    reader = SharedCache(path, slots=8, slot_size=512, ways=2)
+    reader.open()
+
+    writer = multiprocessing.get_context("fork").Process(target=write_forever, args=(path, 20000))
+    writer.start()
+    reads = 0
+    while writer.is_alive():
+        cached = reader.get("hot")
+        if cached:
+            reads += 1
+            assert len(set(cached[0])) == 1
+    writer.join()
+
+    assert writer.exitcode == 0
+    assert reads > 0
+
+
+@pytest.mark.asyncio
+async def test_resolver_answers_from_the_shared_cache(tmp_path, monkeypatch):
+    cache = SharedCache(str(tmp_path / "cache"), slots=64, slot_size=1024)
+    monkeypatch.setattr(resolver, "shared_cache", cache)
+
+    query = dns.message.make_query("example.com.", "MX")
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text("example.com.", 3600, "IN", "MX", "10 mx.example.com."))
+    cache.set(Resolver._answer_key("google", "192.0.2.1", "example.com.", 15), response.to_wire(), ttl=300)
+
+    answer = await Resolver._query(name="google", where="192.0.2.1", qname="Example.com", rdtype=RecordTypes.MX)
+
+    assert 299 <= answer.chaining_result.minimum_ttl <= 300
+    assert [record.hostname for record in await Resolver._parse_answer(answer, RecordTypes.MX)] == ["mx.example.com"]
+
+
+@pytest.mark.asyncio
+async def test_resolver_keeps_answers_of_each_nameserver_apart(tmp_path, monkeypatch):
+    monkeypatch.setattr(resolver, "shared_cache", SharedCache(str(tmp_path / "cache"), slots=64, slot_size=1024))
+    addresses = {"192.0.2.1": "10.0.0.1", "192.0.2.2": "10.0.0.2", "2001:db8::1": "10.0.0.6"}
+    asked = []
+
+    async def _resolve_at(where, qname, rdtype):
+        asked.append(where)
+        query = dns.message.make_query(qname, rdtype)
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(qname, 300, "IN", "A", addresses[where]))
+        response = dns.message.from_wire(response.to_wire())
+        return dns.resolver.Answer(query.question[0].name, rdtype, dns.rdataclass.IN, response)
+
+    monkeypatch.setattr(resolver.dns.asyncresolver, "resolve_at", _resolve_at)
+
+    for _ in range(2):
+        for where, address in addresses.items():
+            answer = await Resolver._query(name="google", where=where, qname="example.com.", rdtype=RecordTypes.A)
+            assert [rdata.address for rdata in answer] == [address]
+
+    # Each nameserver was asked once, the repeats came from the cache
+    assert asked == list(addresses)
@@ -0,0 +1,99 @@
+import random
+
+from dnsdig.appdnsdigd.sketches import TrafficSketches, SketchDimensions, HeavyHitters, SpaceSaving, registrable_domain
+
+
+def test_registrable_domain():
+    assert registrable_domain("www.mail.example.com.") == "example.com"
+    assert registrable_domain("www.example.co.uk.") == "example.co.uk"
+    assert registrable_domain("localhost.") == "localhost"
+
+
+def test_heavy_hitters_finds_top_names():
+    rng = random.Random(7)
+    hitters = HeavyHitters(capacity=16, width=256)
+    for _ in range(5000):
+        hitters.add(f"host{rng.randint(0, 500)}.example.com.")
+    for _ in range(1000):
+        hitters.add("popular.example.com.")
+    for _ in range(500):
+        hitters.add("second.example.com.")
+
+    top = hitters.top(2)
+
+    assert [row["key"] for row in top] == ["popular.example.com.", "second.example.com."]
+    assert top[0]["count"] >= 1000
+    assert hitters.total == 6500
+
+
+def test_space_saving_evicts_the_smallest_count():
+    rng = random.Random(11)
+    summary = SpaceSaving(capacity=8)
+    counts, errors = {}, {}
+    for _ in range(3000):
+        key, count = f"key{rng.randint(0, 40)}", rng.randint(1, 3)
+        summary.add(key, count)
+
+        # The plain scan over every counter the heap replaces
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < 8:
+            counts[key], errors[key] = count, 0
+        else:
+            evicted = min(counts, key=lambda name: (counts[name], name))
+            floor = counts.pop(evicted)
+            del errors[evicted]
+            counts[key], errors[key] = floor + count, floor
+
+    assert summary.counts == counts
+    assert summary.errors == errors
+
+    restored = SpaceSaving.load(summary.dump())
+    restored.add("newcomer")
+    assert min(counts.values()) + 1 == restored.counts["newcomer"]
+
+
+def test_space_saving_merge_keeps_the_true_counts_within_the_error():
+    first, second = SpaceSaving(capacity=2), SpaceSaving(capacity=2)
+    for key, count in (("a", 5), ("b", 4)):
+        first.add(key, count)
+    # b is evicted from the second summary, which still saw it once
+    for key, count in (("b", 1), ("x", 3), ("y", 3)):
+        second.add(key, count)
+    truth = {"a": 5, "b": 5, "x": 3, "y": 3}
+
+    first.merge(second)
+
+    # Every count stays an upper bound and every count minus its error a lower bound of the real count
+    assert len(first.counts) == 2
+    for key, count, error in first.top(2):
+        assert count - error <= truth[key] <= count
+
+
+def test_traffic_sketches_merge_snapshots():
+    first = TrafficSketches(worker="first", capacity=16, width=256)
+    second = TrafficSketches(worker="second", capacity=16, width=256)
+    for _ in range(10):
+        first.record(qname="a.example.com.", qtype="A", client="10.0.0.1")
+        second.record(qname="b.example.org.", qtype="AAAA", client="10.0.0.2")
+    second.record(qname="b.example.org.", qtype="AAAA", client="10.0.0.2")
+
+    snapshots = [TrafficSketches.load_bucket(second.dump_bucket(bucket)) for bucket in second.dirty]
+    hitters = first.merged(SketchDimensions.Domain, window_seconds=300, extra=snapshots)
+
+    assert hitters.total == 21
+    assert [row["key"] for row in hitters.top(2)] == ["example.org", "example.com"]
+    assert first.top(SketchDimensions.QType, n=1)[0] == {"key": "A", "count": 10, "error": 0}
+
+
+def test_restarted_worker_restores_its_snapshot():
+    before = TrafficSketches(worker="dnsdigd-1", capacity=16, width=256)
+    before.record(qname="a.example.com.", qtype="A", client="10.0.0.1")
+    snapshots = {(bucket, before.worker): before.dump_bucket(bucket) for bucket in before.dirty}
+
+    after = TrafficSketches(worker="dnsdigd-1", capacity=16, width=256)
+    for bucket in after.window_buckets(300):
+        if (bucket, after.worker) in snapshots:
+            after.restore_bucket(bucket, snapshots[(bucket, after.worker)])
+
+    assert after.top(SketchDimensions.QName, n=1)[0]["key"] == "a.example.com."
@@ -0,0 +1,60 @@
+import random
+import time
+
+from dnsdig.appdnsdigd import metrics
+from dnsdig.appdnsdigd.spans import QuerySpans, SlowQueryLog
+
+
+def make_spans(monkeypatch, *stages_ms: float, stage_names=("parse", "log", "upstream")) -> QuerySpans:
+    clock = [0]
+    for duration in stages_ms:
+        clock.append(clock[-1] + int(duration * 1e6))
+    ticks = iter(clock)
+    monkeypatch.setattr(time, "perf_counter_ns", lambda: next(ticks))
+
+    spans = QuerySpans()
+    for stage in stage_names[: len(stages_ms)]:
+        spans.mark(stage)
+    return spans
+
+
+def test_time_between_marks_goes_to_the_stage(monkeypatch):
+    spans = make_spans(monkeypatch, 1, 2, 30, 4, stage_names=("parse", "log", "upstream", "log"))
+
+    assert spans.stages == {"parse": 1_000_000, "log": 6_000_000, "upstream": 30_000_000}
+    assert spans.elapsed_ns == 37_000_000
+
+    before = metrics.query_stage_duration.count("upstream")
+    spans.record()
+    assert metrics.query_stage_duration.count("upstream") == before + 1
+
+
+def test_slow_query_log_keeps_queries_over_the_threshold(monkeypatch):
+    slow_queries = SlowQueryLog(threshold_ms=10, size=2)
+
+    slow_queries.maybe_record(make_spans(monkeypatch, 1, 2, 3), qname="fast.", qtype="A", rcode="NOERROR")
+    assert slow_queries.dump() == []
+
+    for qname in ("first.", "second.", "third."):
+        slow_queries.maybe_record(make_spans(monkeypatch, 1, 2, 30), qname=qname, qtype="A", rcode="NOERROR")
+
+    # The ring buffer keeps the latest entries only
+    entries = slow_queries.dump()
+    assert [entry["qname"] for entry in entries] == ["second.", "third."]
+    assert entries[-1]["elapsed_ms"] == 33
+    assert entries[-1]["stages_ms"] == {"parse": 1, "log": 2, "upstream": 30}
+
+    # Disabled without a threshold
+    disabled = SlowQueryLog(threshold_ms=None)
+    disabled.maybe_record(make_spans(monkeypatch, 1000), qname="slow.", qtype="A", rcode="NOERROR")
+    assert disabled.dump() == []
+
+
+def test_slow_query_log_samples(monkeypatch):
+    slow_queries = SlowQueryLog(threshold_ms=10, sample_rate=0.5)
+    for qname in ("kept.", "dropped."):
+        spans = make_spans(monkeypatch, 20)
+        monkeypatch.setattr(random, "random", lambda: 0.25 if qname == "kept." else 0.75)
+        slow_queries.maybe_record(spans, qname=qname, qtype="A", rcode="NOERROR")
+
+    assert [entry["qname"] for entry in slow_queries.dump()] == ["kept."]
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+import ujson
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from dnsdig.appdnsdigapi.tracing import TracingMiddleware
+from dnsdig.libshared.models import ModelJSONResponse
+from dnsdig.libshared.tracing import tracer, NOOP_SPAN
+
+UPSTREAM = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/resolve/{name}", response_class=ModelJSONResponse)
+    async def resolve(name: str, delay: float = 0):
+        with tracer.span("dns.query", provider="google"):
+            await asyncio.sleep(delay)
+        # A provider answering NXDOMAIN is not a failed request
+        with pytest.raises(LookupError):
+            with tracer.span("dns.query", (LookupError,), provider="opendns"):
+                raise LookupError()
+        return ModelJSONResponse({"name": name})
+
+    @app.get("/broken")
+    async def broken():
+        with tracer.span("geo.lookup"):
+            raise RuntimeError("ipinfo down")
+
+    return app
+
+
+def test_tail_sampling_keeps_slow_and_failed_requests(tmp_path, monkeypatch):
+    export_path = tmp_path / "traces.ndjson"
+    monkeypatch.setattr(tracer, "enabled", True)
+    monkeypatch.setattr(tracer, "export_path", str(export_path))
+    monkeypatch.setattr(tracer, "slow_ns", 50e6)
+    monkeypatch.setattr(tracer, "sample_rate", 0.0)
+    tracer.pending.clear()
+
+    client = TestClient(build_app(), raise_server_exceptions=False)
+    fast = client.get("/resolve/example.com")
+    client.get("/resolve/example.com", params={"delay": 0.06}, headers={"traceparent": UPSTREAM})
+    client.get("/broken")
+
+    assert fast.status_code == 200 and fast.headers["traceparent"].endswith("-01")
+    assert len(tracer.pending) == 2
+    asyncio.run(tracer.export())
+    assert not tracer.pending
+
+    payload = ujson.loads(export_path.read_text())
+    spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    slow = [span for span in spans if span["traceId"] == UPSTREAM.split("-")[1]]
+    roots = {span["spanId"]: span for span in slow if span["name"] == "GET /resolve/{name}"}
+    root = roots.popitem()[1]
+    assert root["parentSpanId"] == "b7ad6b7169203331" and root["status"]["code"] == 1
+    assert {span["name"] for span in slow} == {"GET /resolve/{name}", "dns.query", "response.serialize"}
+    assert {span["parentSpanId"] for span in slow if span["name"] == "dns.query"} == {root["spanId"]}
+
+    failed = [span for span in spans if span["traceId"] != root["traceId"]]
+    assert {span["name"]: span["status"]["code"] for span in failed} == {"GET /broken": 2, "geo.lookup": 2}
+
+
+def test_spans_outside_a_request_cost_nothing():
+    with tracer.span("dns.query", provider="google") as span:
+        span.set("cached", True)
+    assert span is NOOP_SPAN
@@ -0,0 +1,51 @@
+import dns.message
+import dns.name
+import dns.rcode
+from dns.rdatatype import RdataType
+
+from dnsdig.appdnsdigd.zones import ZoneTable, SuffixTrie
+
+ZONE = """
+$TTL 300
+@ IN SOA ns hostmaster 1 3600 600 86400 300
+@ IN NS ns
+ns IN A 10.0.0.53
+www IN A 10.0.0.80
+web IN CNAME www
+a.b IN A 10.0.0.1
+"""
+
+
+def _ask(table: ZoneTable, name: str, rdtype: RdataType) -> dns.message.Message:
+    query = dns.message.make_query(name, rdtype)
+    return table.local_zone(query.question[0].name).answer(query)
+
+
+def test_suffix_trie_longest_match():
+    trie = SuffixTrie()
+    trie.insert(dns.name.from_text("corp."), "corp")
+    trie.insert(dns.name.from_text("lab.corp."), "lab")
+
+    assert trie.longest_match(dns.name.from_text("db.LAB.corp.")) == "lab"
+    assert trie.longest_match(dns.name.from_text("mail.corp.")) == "corp"
+    assert trie.longest_match(dns.name.from_text("example.com.")) is None
+
+
+def test_local_zone_answers(tmp_path):
+    zone_file = tmp_path / "corp.internal.zone"
+    zone_file.write_text(ZONE)
+    table = ZoneTable.load([str(zone_file)], {"lab.internal.": ["10.1.0.53@5353"]})
+
+    answer = _ask(table, "web.corp.internal.", RdataType.A)
+    missing = _ask(table, "nope.corp.internal.", RdataType.A)
+    nodata = _ask(table, "www.corp.internal.", RdataType.AAAA)
+    empty_non_terminal = _ask(table, "b.corp.internal.", RdataType.A)
+    below_empty_non_terminal = _ask(table, "c.b.corp.internal.", RdataType.A)
+
+    assert [rrset.rdtype for rrset in answer.answer] == [RdataType.CNAME, RdataType.A]
+    assert missing.rcode() == dns.rcode.NXDOMAIN
+    assert nodata.rcode() == dns.rcode.NOERROR and nodata.authority[0].rdtype == RdataType.SOA
+    assert empty_non_terminal.rcode() == dns.rcode.NOERROR and not empty_non_terminal.answer
+    assert below_empty_non_terminal.rcode() == dns.rcode.NXDOMAIN
+    assert table.local_zone(dns.name.from_text("example.com.")) is None
+    assert table.route(dns.name.from_text("db.lab.internal.")).nameservers == ["10.1.0.53@5353"]